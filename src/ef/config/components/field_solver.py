@@ -0,0 +1,61 @@
+__all__ = ["FieldSolverConf", "FieldSolverSection"]
+
+from collections import namedtuple
+
+from ef.config.component import ConfigComponent
+from ef.config.section import ConfigSection, boolean
+from ef.field.solvers import field_solver_options
+
+
+class FieldSolverConf(ConfigComponent):
+    def __init__(self, solver='default', preconditioner='none', tolerance=1e-10, max_iterations=1000,
+                 memory_limit=1 << 30, vacuum_superposition=True, extrapolate=False,
+                 operator='auto', cache_dir='', recycle_size=0, recycle_memory_limit=1 << 28,
+                 workers=1, subdomains=0, assembly_memory_limit=1 << 30):
+        if solver not in field_solver_options.FieldSolverOptions.solvers:
+            raise ValueError("Unexpected field solver: {}".format(solver))
+        if preconditioner not in field_solver_options.FieldSolverOptions.preconditioners:
+            raise ValueError("Unexpected field solver preconditioner: {}".format(preconditioner))
+        if operator not in field_solver_options.FieldSolverOptions.operators:
+            raise ValueError("Unexpected field solver operator: {}".format(operator))
+        self.solver = solver
+        self.preconditioner = preconditioner
+        self.tolerance = float(tolerance)
+        self.max_iterations = int(max_iterations)
+        self.memory_limit = int(memory_limit)
+        self.vacuum_superposition = bool(vacuum_superposition)
+        self.extrapolate = bool(extrapolate)
+        self.operator = operator
+        self.cache_dir = cache_dir
+        self.recycle_size = int(recycle_size)
+        self.recycle_memory_limit = int(recycle_memory_limit)
+        self.workers = int(workers)
+        self.subdomains = int(subdomains)
+        self.assembly_memory_limit = int(assembly_memory_limit)
+
+    def to_conf(self):
+        return FieldSolverSection(self.solver, self.preconditioner, self.tolerance, self.max_iterations,
+                                  self.memory_limit, self.vacuum_superposition, self.extrapolate, self.operator,
+                                  self.cache_dir, self.recycle_size, self.recycle_memory_limit, self.workers,
+                                  self.subdomains, self.assembly_memory_limit)
+
+    def make(self):
+        return field_solver_options.FieldSolverOptions(self.solver, self.preconditioner, self.tolerance,
+                                                       self.max_iterations, self.memory_limit,
+                                                       self.vacuum_superposition, self.extrapolate, self.operator,
+                                                       self.cache_dir, self.recycle_size, self.recycle_memory_limit,
+                                                       self.workers, self.subdomains, self.assembly_memory_limit)
+
+
+class FieldSolverSection(ConfigSection):
+    section = "FieldSolver"
+    ContentTuple = namedtuple("FieldSolverTuple", ('solver', 'preconditioner', 'tolerance', 'max_iterations',
+                                                  'memory_limit', 'vacuum_superposition', 'extrapolate', 'operator',
+                                                  'cache_dir', 'recycle_size', 'recycle_memory_limit', 'workers',
+                                                  'subdomains', 'assembly_memory_limit'))
+    ContentTuple.__new__.__defaults__ = ('default', 'none', 1e-10, 1000, 1 << 30, True, False, 'auto', '', 0, 1 << 28,
+                                         1, 0, 1 << 30)
+    convert = ContentTuple(str, str, float, int, int, boolean, boolean, str, str, int, int, int, int, int)
+
+    def make(self):
+        return FieldSolverConf(*self.content)
@@ -10,10 +10,16 @@ from ef.config.section import NamedConfigSection
 
 
 class InnerRegionConf(ConfigComponent):
-    def __init__(self, name="InnerRegion1", shape=Box(), potential=0):
+    def __init__(self, name="InnerRegion1", shape=Box(), potential=0, potential_expression='', potential_table=()):
+        """
+        :param potential_expression: optional expression of time `t` for a time-dependent potential
+        :param potential_table: optional sequence of (time, potential) pairs to interpolate linearly
+        """
         self.name = name
         self.shape = shape
         self.potential = float(potential)
+        self.potential_expression = potential_expression
+        self.potential_table = tuple((float(t), float(v)) for t, v in potential_table)
 
     def visualize(self, visualizer):
         self.shape.visualize(visualizer, facecolors=visualizer.potential_mapper.to_rgba(self.potential),
@@ -39,23 +45,37 @@ class InnerRegionConf(ConfigComponent):
             cls = InnerRegionConeAlongZSection
         else:
             raise TypeError("Config can not represent inner region shape", self.shape)
-        return cls(self.name, *(shape_args + [self.potential]))
+        return cls(self.name, *(shape_args + [self.potential, self.potential_expression,
+                                              format_potential_table(self.potential_table)]))
 
     def make(self):
-        return inner_region.InnerRegion(self.name, self.shape, self.potential)
+        return inner_region.InnerRegion(self.name, self.shape, self.potential,
+                                        potential_expression=self.potential_expression,
+                                        potential_table=self.potential_table)
+
+
+def format_potential_table(table):
+    return '; '.join('{} {}'.format(t, v) for t, v in table)
+
+
+def parse_potential_table(string):
+    """ Parse 'time potential' pairs separated with semicolons, like '0 0; 1e-9 100'. """
+    return tuple(tuple(float(x) for x in pair.split()) for pair in string.split(';') if pair.strip())
 
 
 class InnerRegionBoxSection(NamedConfigSection):
     section = "InnerRegionBox"
     ContentTuple = namedtuple("InnerRegionBoxTuple", ('box_x_left', 'box_x_right', 'box_y_bottom',
                                                       'box_y_top', 'box_z_near', 'box_z_far',
-                                                      'potential'))
-    convert = ContentTuple(*[float] * 7)
+                                                      'potential', 'potential_expression', 'potential_table'))
+    ContentTuple.__new__.__defaults__ = ('', '')
+    convert = ContentTuple(*[float] * 7, str, str)
 
     def make(self):
         l, r, b, t, n, f = self.content[:6]
         box = Box((r, b, n), (l - r, t - b, f - n))
-        return InnerRegionConf(self.name, box, self.content.potential)
+        return InnerRegionConf(self.name, box, self.content.potential, self.content.potential_expression,
+                               parse_potential_table(self.content.potential_table))
 
 
 class InnerRegionCylinderSection(NamedConfigSection):
@@ -63,12 +83,15 @@ class InnerRegionCylinderSection(NamedConfigSection):
     ContentTuple = namedtuple("InnerRegionCylinderTuple", ('cylinder_axis_start_x', 'cylinder_axis_start_y',
                                                            'cylinder_axis_start_z', 'cylinder_axis_end_x',
                                                            'cylinder_axis_end_y', 'cylinder_axis_end_z',
-                                                           'cylinder_radius', 'potential'))
-    convert = ContentTuple(*[float] * 8)
+                                                           'cylinder_radius', 'potential',
+                                                           'potential_expression', 'potential_table'))
+    ContentTuple.__new__.__defaults__ = ('', '')
+    convert = ContentTuple(*[float] * 8, str, str)
 
     def make(self):
         cylinder = Cylinder(self.content[:3], self.content[3:6], self.content.cylinder_radius)
-        return InnerRegionConf(self.name, cylinder, self.content.potential)
+        return InnerRegionConf(self.name, cylinder, self.content.potential, self.content.potential_expression,
+                               parse_potential_table(self.content.potential_table))
 
 
 class InnerRegionTubeSection(NamedConfigSection):
@@ -77,23 +100,28 @@ class InnerRegionTubeSection(NamedConfigSection):
                                                        'tube_axis_start_z', 'tube_axis_end_x',
                                                        'tube_axis_end_y', 'tube_axis_end_z',
                                                        'tube_inner_radius', 'tube_outer_radius',
-                                                       'potential'))
-    convert = ContentTuple(*[float] * 9)
+                                                       'potential', 'potential_expression', 'potential_table'))
+    ContentTuple.__new__.__defaults__ = ('', '')
+    convert = ContentTuple(*[float] * 9, str, str)
 
     def make(self):
         tube = Tube(self.content[:3], self.content[3:6], self.content.tube_inner_radius, self.content.tube_outer_radius)
-        return InnerRegionConf(self.name, tube, self.content.potential)
+        return InnerRegionConf(self.name, tube, self.content.potential, self.content.potential_expression,
+                               parse_potential_table(self.content.potential_table))
 
 
 class InnerRegionSphereSection(NamedConfigSection):
     section = "Inner_region_sphere"
     ContentTuple = namedtuple("InnerRegionSphereTuple", ('sphere_origin_x', 'sphere_origin_y',
-                                                         'sphere_origin_z', 'sphere_radius', 'potential'))
-    convert = ContentTuple(*[float] * 5)
+                                                         'sphere_origin_z', 'sphere_radius', 'potential',
+                                                         'potential_expression', 'potential_table'))
+    ContentTuple.__new__.__defaults__ = ('', '')
+    convert = ContentTuple(*[float] * 5, str, str)
 
     def make(self):
         sphere = Sphere(self.content[:3], self.content.sphere_radius)
-        return InnerRegionConf(self.name, sphere, self.content.potential)
+        return InnerRegionConf(self.name, sphere, self.content.potential, self.content.potential_expression,
+                               parse_potential_table(self.content.potential_table))
 
 
 class InnerRegionConeAlongZSection(NamedConfigSection):
@@ -103,8 +131,9 @@ class InnerRegionConeAlongZSection(NamedConfigSection):
                                'cone_axis_start_z', 'cone_axis_end_z',
                                'cone_start_inner_radius', 'cone_start_outer_radius',
                                'cone_end_inner_radius', 'cone_end_outer_radius',
-                               'potential'))
-    convert = ContentTuple(*[float] * 9)
+                               'potential', 'potential_expression', 'potential_table'))
+    ContentTuple.__new__.__defaults__ = ('', '')
+    convert = ContentTuple(*[float] * 9, str, str)
 
     def make(self):
         cone = Cone((self.content.cone_axis_x,
@@ -115,4 +144,5 @@ class InnerRegionConeAlongZSection(NamedConfigSection):
                      self.content.cone_start_outer_radius),
                     (self.content.cone_end_inner_radius,
                      self.content.cone_end_outer_radius))
-        return InnerRegionConf(self.name, cone, self.content.potential)
+        return InnerRegionConf(self.name, cone, self.content.potential, self.content.potential_expression,
+                               parse_potential_table(self.content.potential_table))
@@ -8,22 +8,34 @@ from ef.config.section import ConfigSection
 
 
 class ParticleInteractionModelConf(ConfigComponent):
-    def __init__(self, model="PIC"):
-        if model not in ("PIC", 'noninteracting', 'binary'):
+    def __init__(self, model="PIC", binary_tile_memory=1 << 26, binary_threads=1, tree_opening_angle=0.7,
+                 p3m_cutoff=2.5):
+        if model not in ("PIC", 'noninteracting', 'binary', 'tree', 'p3m'):
             raise ValueError("Unexpected particle interaction model: {}".format(model))
+        if not 0 < float(tree_opening_angle) <= 1:
+            raise ValueError("Expect 0 < tree_opening_angle <= 1")
         self.model = model
+        self.binary_tile_memory = int(binary_tile_memory)
+        self.binary_threads = int(binary_threads)
+        self.tree_opening_angle = float(tree_opening_angle)
+        self.p3m_cutoff = float(p3m_cutoff)
 
     def to_conf(self):
-        return ParticleInteractionModelSection(self.model)
+        return ParticleInteractionModelSection(self.model, self.binary_tile_memory, self.binary_threads,
+                                                self.tree_opening_angle, self.p3m_cutoff)
 
     def make(self):
-        return particle_interaction_model.ParticleInteractionModel(self.model)
+        return particle_interaction_model.ParticleInteractionModel(self.model, self.binary_tile_memory,
+                                                                   self.binary_threads, self.tree_opening_angle,
+                                                                   self.p3m_cutoff)
 
 
 class ParticleInteractionModelSection(ConfigSection):
     section = "ParticleInteractionModel"
-    ContentTuple = namedtuple("ParticleInteractionModelTuple", ('particle_interaction_model',))
-    convert = ContentTuple(str)
+    ContentTuple = namedtuple("ParticleInteractionModelTuple", ('particle_interaction_model', 'binary_tile_memory',
+                                                                'binary_threads', 'tree_opening_angle', 'p3m_cutoff'))
+    ContentTuple.__new__.__defaults__ = (1 << 26, 1, 0.7, 2.5)
+    convert = ContentTuple(str, int, int, float, float)
 
     def make(self):
-        return ParticleInteractionModelConf(self.content.particle_interaction_model)
+        return ParticleInteractionModelConf(*self.content)
@@ -0,0 +1,31 @@
+__all__ = ["ParticleSortingConf", "ParticleSortingSection"]
+
+from collections import namedtuple
+
+from ef import particle_sorter
+from ef.config.component import ConfigComponent
+from ef.config.section import ConfigSection
+
+
+class ParticleSortingConf(ConfigComponent):
+    def __init__(self, sort_every=0, order='morton'):
+        if order not in particle_sorter.ParticleSorter.orders:
+            raise ValueError("Unexpected particle sort order: {}".format(order))
+        self.sort_every = int(sort_every)
+        self.order = order
+
+    def to_conf(self):
+        return ParticleSortingSection(self.sort_every, self.order)
+
+    def make(self):
+        return particle_sorter.ParticleSorter(self.sort_every, self.order)
+
+
+class ParticleSortingSection(ConfigSection):
+    section = "ParticleSorting"
+    ContentTuple = namedtuple("ParticleSortingTuple", ('sort_every_n_steps', 'sort_order'))
+    ContentTuple.__new__.__defaults__ = (0, 'morton')
+    convert = ContentTuple(int, str)
+
+    def make(self):
+        return ParticleSortingConf(*self.content)
@@ -8,9 +8,13 @@ from ef.util.data_class import DataClass
 
 
 class Config(DataClass):
+    # config sections that may be omitted, they are only exported when different from defaults
+    optional_singletons = (ParticleSortingConf, FieldSolverConf)
+
     def __init__(self, time_grid=TimeGridConf(), spatial_mesh=SpatialMeshConf(), sources=(), inner_regions=(),
                  output_file=OutputFileConf(), boundary_conditions=BoundaryConditionsConf(),
-                 particle_interaction_model=ParticleInteractionModelConf(), external_fields=()):
+                 particle_interaction_model=ParticleInteractionModelConf(), external_fields=(),
+                 particle_sorting=ParticleSortingConf(), field_solver=FieldSolverConf()):
         self.time_grid = time_grid
         self.spatial_mesh = spatial_mesh
         self.sources = list(sources)
@@ -19,6 +23,8 @@ class Config(DataClass):
         self.boundary_conditions = boundary_conditions
         self.particle_interaction_model = particle_interaction_model
         self.external_fields = list(external_fields)
+        self.particle_sorting = particle_sorting
+        self.field_solver = field_solver
 
     @classmethod
     def from_components(cls, components):
@@ -26,8 +32,10 @@ class Config(DataClass):
                    'sources': ParticleSourceConf, 'inner_regions': InnerRegionConf,
                    'output_file': OutputFileConf, 'boundary_conditions': BoundaryConditionsConf,
                    'particle_interaction_model': ParticleInteractionModelConf,
-                   'external_fields': FieldConf}
-        singletons = TimeGridConf, SpatialMeshConf, OutputFileConf, BoundaryConditionsConf, ParticleInteractionModelConf
+                   'external_fields': FieldConf, 'particle_sorting': ParticleSortingConf,
+                   'field_solver': FieldSolverConf}
+        singletons = TimeGridConf, SpatialMeshConf, OutputFileConf, BoundaryConditionsConf, \
+            ParticleInteractionModelConf, ParticleSortingConf, FieldSolverConf
         kwargs = {}
         for arg, parent in parents.items():
             children = [c for c in components if isinstance(c, parent)]
@@ -35,6 +43,8 @@ class Config(DataClass):
                 if len(children) > 1:
                     raise Exception("Several {} configured, cannot init Config".format(parent))
                 if len(children) < 1:
+                    if parent in cls.optional_singletons:
+                        continue
                     raise Exception("No {} configuration found, cannot init Config".format(parent))
                 kwargs[arg] = children[0]
             else:
@@ -65,8 +75,10 @@ class Config(DataClass):
 
     @property
     def components(self):
+        optional = [c for c in (self.particle_sorting, self.field_solver) if c != type(c)()]
         return [self.time_grid, self.spatial_mesh] + self.sources + self.inner_regions + \
-               [self.output_file, self.boundary_conditions, self.particle_interaction_model] + self.external_fields
+               [self.output_file, self.boundary_conditions, self.particle_interaction_model] + \
+               self.external_fields + optional
 
     def get_potentials(self):
         bc = self.boundary_conditions
@@ -109,7 +121,9 @@ class Config(DataClass):
         magnetic_fields = [s.make() for s in self.external_fields if s.electric_or_magnetic == 'magnetic']
         model = self.particle_interaction_model.make()
         return simulation.Simulation(grid, mesh, regions, sources, electric_fields, magnetic_fields, model,
-                                     self.output_file.prefix, self.output_file.suffix)
+                                     self.output_file.prefix, self.output_file.suffix,
+                                     particle_sorter=self.particle_sorting.make(),
+                                     field_solver_options=self.field_solver.make())
 
 
 def main():
@@ -1,13 +1,22 @@
 from collections import namedtuple
+from configparser import ConfigParser
 
 from ef.util.data_class import DataClass
 from ef.util.subclasses import get_all_subclasses
 
 
+def boolean(value):
+    """ Convert config strings like 'yes', 'off', 'True' into booleans, as ConfigParser.getboolean does. """
+    if value.lower() not in ConfigParser.BOOLEAN_STATES:
+        raise ValueError("Not a boolean: {}".format(value))
+    return ConfigParser.BOOLEAN_STATES[value.lower()]
+
+
 class ConfigSection(DataClass):
     _section_map = None  # dictionary of section_header_string: section class
     section = "Section header string goes here"
     ContentTuple = namedtuple("ConfigSectionTuple", ())  # expected content of the config section as a namedtuple
+    # trailing fields with defaults (ContentTuple.__new__.__defaults__) are optional in config files
     convert = ContentTuple()  # tuple of types to convert config strings into
 
     @staticmethod
@@ -27,23 +36,31 @@ class ConfigSection(DataClass):
     def _from_section(cls, section):
         if section.name != cls.section:
             raise ValueError("Unexpected config section name: {}".format(section.name))
-        if set(section.keys()) != set(cls.ContentTuple._fields):
-            unexpected = set(section.keys()) - set(cls.ContentTuple._fields)
-            if unexpected:
-                raise ValueError("Unexpected config variables {} in section {}".
-                                 format(tuple(unexpected), section.name))
-            missing = set(cls.ContentTuple._fields) - set(section.keys())
-            if missing:
-                raise ValueError("Missing config variables {} in section {}".
-                                 format(tuple(missing), section.name))
-
-        data = {arg: cls.convert._asdict()[arg](section[arg]) for arg in cls.convert._fields}
-        return cls(**data)
+        return cls(**cls._section_content(section))
+
+    @classmethod
+    def optional_fields(cls):
+        defaults = cls.ContentTuple.__new__.__defaults__ or ()
+        return dict(zip(cls.ContentTuple._fields[len(cls.ContentTuple._fields) - len(defaults):], defaults))
+
+    @classmethod
+    def _section_content(cls, section):
+        unexpected = set(section.keys()) - set(cls.ContentTuple._fields)
+        if unexpected:
+            raise ValueError("Unexpected config variables {} in section {}".
+                             format(tuple(unexpected), section.name))
+        missing = set(cls.ContentTuple._fields) - set(section.keys()) - set(cls.optional_fields())
+        if missing:
+            raise ValueError("Missing config variables {} in section {}".
+                             format(tuple(missing), section.name))
+        return {arg: cls.convert._asdict()[arg](section[arg]) for arg in cls.convert._fields if arg in section}
 
     def add_section_to_parser(self, conf):
         conf.add_section(self.section)
+        optional = self.optional_fields()
         for k, v in self.content._asdict().items():
-            conf.set(self.section, k, str(v))
+            if k not in optional or v != optional[k]:
+                conf.set(self.section, k, str(v))
 
     def make(self):
         raise NotImplementedError()
@@ -60,15 +77,4 @@ class NamedConfigSection(ConfigSection):
         category, name = section.name.split('.', 1)
         if category != cls.section:
             raise ValueError("Unexpected config section name: {}".format(section.name))
-        if set(section.keys()) != set(cls.ContentTuple._fields):
-            unexpected = set(section.keys()) - set(cls.ContentTuple._fields)
-            if unexpected:
-                raise ValueError("Unexpected config variables {} in section {}".
-                                 format(tuple(unexpected), section.name))
-            missing = set(cls.ContentTuple._fields) - set(section.keys())
-            if missing:
-                raise ValueError("Missing config variables {} in section {}".
-                                 format(tuple(missing), section.name))
-
-        data = {arg: cls.convert._asdict()[arg](section[arg]) for arg in cls.convert._fields}
-        return cls(name, **data)
+        return cls(name, **cls._section_content(section))
@@ -9,3 +9,6 @@ class ExternalField(SerializableH5):
 
     def get_at_points(self, positions, time):
         raise NotImplementedError()
+
+    def get_at_particles(self, particles, time):
+        return self.get_at_points(particles.positions, time)
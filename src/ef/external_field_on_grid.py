@@ -30,6 +30,10 @@ class ExternalFieldOnGrid(ExternalField):
         step = np.min(dist[dist > 0], axis=0)
         self.grid = MeshGrid.from_step(size, step, origin)
         self.field = mesh[:, 3:].reshape((*self.grid.n_nodes, 3))
+        self._padded_field = self.grid.pad_with_ghost_layer(self.field)
 
     def get_at_points(self, positions, time):
         return self.grid.interpolate_field_at_positions(self.field, positions)
+
+    def get_at_particles(self, particles, time):
+        return self.grid.interpolate_padded_field(self._padded_field, particles.mesh_stencil(self.grid))
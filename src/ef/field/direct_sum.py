@@ -0,0 +1,50 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# bytes of temporary arrays per source-point pair: difference vectors, squared distances and their inverse cubes
+_bytes_per_pair = 5 * 8
+
+
+def coulomb_field_at_points(source_positions, charge, points, memory_limit=1 << 26, n_threads=1):
+    """
+    Electric field of equal point charges, summed directly in tiles of sources and points
+    so that temporary arrays never exceed the memory limit.
+    Sources coinciding with a point are excluded from its field (no self-interaction).
+
+    :param source_positions: array of shape (ns, 3)
+    :param charge: scalar charge of each source
+    :param points: array of shape (np, 3)
+    :param memory_limit: approximate limit on temporary memory per thread, bytes
+    :param n_threads: number of threads to spread point tiles over
+    :return: array of shape (np, 3)
+    """
+    sources = np.asarray(source_positions, dtype=float).reshape(-1, 3)
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    result = np.zeros_like(points)
+    if len(sources) == 0 or len(points) == 0:
+        return result
+    pairs_per_tile = max(1, memory_limit // _bytes_per_pair)
+    points_per_tile = int(min(len(points), max(1, np.sqrt(pairs_per_tile)),
+                              -(-len(points) // max(1, n_threads))))
+    sources_per_tile = max(1, pairs_per_tile // points_per_tile)
+
+    def field_at_tile(start):
+        tile = slice(start, start + points_per_tile)
+        p = points[tile]
+        for s in range(0, len(sources), sources_per_tile):
+            diff = p[np.newaxis] - sources[s:s + sources_per_tile, np.newaxis]  # (ts, tp, 3)
+            dist2 = np.einsum('stk,stk->st', diff, diff)  # (ts, tp)
+            inv_dist3 = np.zeros_like(dist2)
+            np.power(dist2, -1.5, out=inv_dist3, where=dist2 > 0)
+            result[tile] += np.einsum('st,stk->tk', inv_dist3, diff)
+
+    starts = range(0, len(points), points_per_tile)
+    if n_threads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(n_threads) as executor:
+            list(executor.map(field_at_tile, starts))
+    else:
+        for start in starts:
+            field_at_tile(start)
+    result *= charge
+    return result
@@ -0,0 +1,110 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from ef.field.solvers.dst import DSTSolver
+
+
+class MeshPairField:
+    """
+    Field that the mesh gives between two unit charges away from the domain boundaries:
+    cloud-in-cell deposition, the 7-point Poisson equation, the central difference gradient
+    and cloud-in-cell interpolation.
+
+    The mesh field of a unit charge on a node is tabulated once for node offsets up to reach,
+    solved with the DST in a grounded box with margin more cells on each side.
+    Between two particles it is the sum of the table over the nodes of both cells,
+    weighted with the cloud-in-cell weights of both particles.
+    """
+    margin = 16  # cells between the tabulated offsets and the grounded box
+
+    def __init__(self, cell, reach):
+        """
+        :param cell: mesh cell size
+        :param reach: largest node offset along each axis to tabulate
+        """
+        self.cell = np.asarray(cell, dtype=float)
+        self.reach = np.broadcast_to(np.asarray(reach, dtype=int), 3)
+        center = self.reach + 1 + self.margin  # node of the charge, boundary nodes included
+        n_interior = 2 * center - 1
+        rhs = np.zeros(n_interior)
+        rhs[tuple(center - 1)] = -4 * np.pi * self.cell.prod()  # FieldSolver right-hand side of density 1 / volume
+        solution = DSTSolver(n_interior, self.cell).solve(rhs.ravel('F'))
+        potential = np.zeros(n_interior + 2)
+        potential[1:-1, 1:-1, 1:-1] = solution.reshape(n_interior, order='F')
+        field = -np.stack(np.gradient(potential, *self.cell), -1)
+        self.table = field[tuple(slice(c - r, c + r + 1) for c, r in zip(center, self.reach))]
+
+    @classmethod
+    def within(cls, cell, cutoff):
+        """ :return: MeshPairField covering every pair of particles closer than the cutoff """
+        return cls(cell, np.ceil(cutoff / np.asarray(cell, dtype=float)).astype(int) + 1)
+
+    def field(self, point_nodes, point_weights, source_nodes, source_weights):
+        """
+        :param point_nodes: array of shape (n, 3), lowest nodes of the cells of the points, see MeshStencil
+        :param point_weights: array of shape (n, 3), relative positions of the points inside their cells
+        :param source_nodes: array of shape (n, 3), same for the unit charges, one for each point
+        :param source_weights: array of shape (n, 3)
+        :return: array of shape (n, 3), mesh field of each charge at its point
+        """
+        offsets = point_nodes - source_nodes + self.reach - 1
+        p, s = point_weights, source_weights
+        # weights of node offsets -1, 0 and 1 from the offset of the lowest nodes, along each axis
+        axis_weights = np.stack([(1 - p) * s, (1 - p) * (1 - s) + p * s, p * (1 - s)])  # (3, n, 3)
+        result = np.zeros(offsets.shape)
+        for d in np.ndindex(3, 3, 3):
+            weight = axis_weights[d[0], :, 0] * axis_weights[d[1], :, 1] * axis_weights[d[2], :, 2]
+            index = offsets + d
+            result += weight[:, np.newaxis] * self.table[index[:, 0], index[:, 1], index[:, 2]]
+        return result
+
+
+class ShortRangeCorrection:
+    """
+    Particle-particle part of P3M: difference between the exact Coulomb field and the mesh field
+    of every source closer to a point than the cutoff. The sources are put in a k-d tree once,
+    and fields at many sets of points are found with the cost proportional to the number of close pairs.
+    Sources coinciding with a point are excluded from its field (no self-interaction).
+    """
+    points_per_batch = 1 << 14  # points whose neighbor pairs are kept in memory at once
+
+    def __init__(self, source_positions, source_charges, grid, cutoff, mesh_pair_field=None):
+        """
+        :param source_positions: array of shape (ns, 3)
+        :param source_charges: charges of the sources, scalar or array of shape (ns,)
+        :param grid: MeshGrid the mesh field is solved on
+        :param cutoff: correction radius
+        :param mesh_pair_field: MeshPairField covering the cutoff on this grid, built if not given
+        """
+        self.sources = np.asarray(source_positions, dtype=float).reshape(-1, 3)
+        self.charges = np.broadcast_to(np.asarray(source_charges, dtype=float), len(self.sources))
+        self.grid = grid
+        self.cutoff = cutoff
+        if mesh_pair_field is None:
+            mesh_pair_field = MeshPairField.within(grid.cell, cutoff)
+        self.mesh_pair_field = mesh_pair_field
+        self._source_stencil = grid.stencil(self.sources)
+        self._tree = cKDTree(self.sources)
+
+    def field_at_points(self, points):
+        """
+        :param points: array of shape (np, 3), inside the grid
+        :return: array of shape (np, 3)
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        result = np.zeros_like(points)
+        if len(self.sources) == 0 or len(points) == 0:
+            return result
+        stencil = self.grid.stencil(points)
+        for start in range(0, len(points), self.points_per_batch):
+            batch = points[start:start + self.points_per_batch]
+            pairs = cKDTree(batch).sparse_distance_matrix(self._tree, self.cutoff, output_type='ndarray')
+            pairs = pairs[pairs['v'] > 0]
+            i, j, distance = pairs['i'], pairs['j'], pairs['v']
+            coulomb = (batch[i] - self.sources[j]) / distance[:, np.newaxis] ** 3
+            mesh = self.mesh_pair_field.field(stencil.nodes[start + i], stencil.weights[start + i],
+                                              self._source_stencil.nodes[j], self._source_stencil.weights[j])
+            field = self.charges[j, np.newaxis] * (coulomb - mesh)
+            for k in range(3):
+                result[start:start + len(batch), k] = np.bincount(i, field[:, k], minlength=len(batch))
+        return result
@@ -0,0 +1,112 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import scipy.sparse
+
+from ef.util.data_class import DataClass
+
+
+def fingerprint(value):
+    """ JSON-compatible representation of nested DataClass objects, dicts, arrays and sequences. """
+    if isinstance(value, DataClass):
+        return [type(value).__name__, {k: fingerprint(v) for k, v in sorted(value.dict.items())}]
+    elif isinstance(value, dict):
+        return {k: fingerprint(v) for k, v in value.items()}
+    elif isinstance(value, np.ndarray):
+        return value.tolist()
+    elif isinstance(value, (list, tuple)):
+        return [fingerprint(v) for v in value]
+    elif isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class SolverCache:
+    """
+    Content-addressed directory of FieldSolver artifacts: node masks, matrices and factorizations.
+
+    Artifacts are stored as .npy files in a subdirectory named by the hash of everything they depend on,
+    and loaded memory-mapped, so later runs with the same geometry skip building them.
+    Without a directory every artifact is computed.
+    """
+    version = 1  # bump when artifacts change their meaning or layout
+
+    def __init__(self, directory, key):
+        """
+        :param directory: cache root directory, or None to disable caching
+        :param key: fingerprint of the geometry the artifacts depend on
+        """
+        self.directory = directory
+        if directory:
+            digest = hashlib.sha256(json.dumps([self.version, key], sort_keys=True).encode()).hexdigest()
+            self.path = os.path.join(directory, digest[:32])
+        else:
+            self.path = None
+
+    def arrays(self, name, compute):
+        """
+        :param name: artifact name
+        :param compute: function returning a dict of arrays and CSR or CSC matrices, called if it is not cached
+        :return: the dict, arrays memory-mapped read-only if loaded from the cache
+        """
+        if self.path is None:
+            return compute()
+        artifact = os.path.join(self.path, name)
+        if os.path.isdir(artifact):
+            try:
+                return self._load(artifact)
+            except (OSError, ValueError) as err:
+                logging.warning(f"Ignoring unreadable field solver cache {artifact}: {err}")
+        arrays = compute()
+        self._save(artifact, arrays)
+        return arrays
+
+    def array(self, name, compute):
+        return self.arrays(name, lambda: {'array': compute()})['array']
+
+    def sparse(self, name, compute):
+        return self.arrays(name, lambda: {'matrix': compute()})['matrix']
+
+    @staticmethod
+    def _load(artifact):
+        files = {f[:-4]: np.load(os.path.join(artifact, f), mmap_mode='r')
+                 for f in os.listdir(artifact) if f.endswith('.npy')}
+        result = {k: v for k, v in files.items() if '@' not in k}
+        # sparse matrices are stored by their component arrays, named key@component
+        for key in {k.split('@')[0] for k in files if '@' in k}:
+            cls = scipy.sparse.csr_matrix if str(files[key + '@format']) == 'csr' else scipy.sparse.csc_matrix
+            matrix = cls((files[key + '@data'], files[key + '@indices'], files[key + '@indptr']),
+                         shape=tuple(files[key + '@shape']), copy=False)
+            # saved in canonical format, scipy would otherwise try to sort the read-only indices in place
+            matrix.has_canonical_format = True
+            result[key] = matrix
+        return result
+
+    @staticmethod
+    def _save(artifact, arrays):
+        # write into a temporary directory and rename it, concurrent runs never see partial artifacts
+        temporary = None
+        try:
+            os.makedirs(os.path.dirname(artifact), exist_ok=True)
+            temporary = tempfile.mkdtemp(dir=os.path.dirname(artifact))
+            for key, value in arrays.items():
+                if scipy.sparse.issparse(value):
+                    value = value.copy()
+                    value.sum_duplicates()
+                    components = {'data': value.data, 'indices': value.indices, 'indptr': value.indptr,
+                                  'shape': np.array(value.shape), 'format': np.array(value.format)}
+                    for component, array in components.items():
+                        np.save(os.path.join(temporary, f"{key}@{component}.npy"), array)
+                else:
+                    np.save(os.path.join(temporary, key + '.npy'), np.asarray(value))
+            os.rename(temporary, artifact)
+        except OSError as err:
+            if temporary is not None:
+                shutil.rmtree(temporary, ignore_errors=True)
+            if not os.path.isdir(artifact):  # another run may have saved it first
+                logging.warning(f"Could not write field solver cache {artifact}: {err}")
@@ -0,0 +1,75 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+class DirectSolver:
+    """
+    Sparse factorization of the constant equation matrix, computed once and reused by every solve.
+
+    Uses a CHOLMOD Cholesky factorization when scikit-sparse is installed and the matrix is symmetric,
+    SuperLU otherwise.
+    """
+    # SuperLU with minimum degree ordering fills about 25 N^(4/3) entries for 3D 7-point stencils
+    fill_coefficient = 30
+    bytes_per_entry = 12  # value and row index
+
+    def __init__(self, matrix=None, factors=None):
+        """
+        :param matrix: sparse equation matrix to factorize
+        :param factors: alternatively, the dict returned by the factors attribute of an earlier DirectSolver
+        """
+        if factors is not None:
+            self._init_from_factors(factors)
+            return
+        matrix = scipy.sparse.csc_matrix(matrix)
+        self.method = 'lu'
+        if abs(matrix - matrix.T).max() == 0:
+            try:
+                from sksparse.cholmod import cholesky
+            except ImportError:
+                pass
+            else:
+                # the Laplacian is negative definite
+                factor = cholesky(-matrix)
+                self.solve = lambda rhs: -factor(rhs)
+                self.method = 'cholesky'
+                self.memory = factor.L().nnz * self.bytes_per_entry
+                lower = scipy.sparse.csc_matrix(factor.L())
+                order = factor.P()
+                # -A[order][:, order] = L L^T
+                self.factors = {'lower': lower, 'upper': lower.T.tocsc(), 'row_order': order, 'column_order': order,
+                                'sign': np.array(-1.)}
+                return
+        factor = scipy.sparse.linalg.splu(matrix, permc_spec='MMD_AT_PLUS_A')
+        self.solve = factor.solve
+        self.memory = factor.nnz * self.bytes_per_entry
+        # A[row_order][:, column_order] = L U
+        self.factors = {'lower': factor.L.tocsc(), 'upper': factor.U.tocsc(), 'row_order': np.argsort(factor.perm_r),
+                        'column_order': np.argsort(factor.perm_c), 'sign': np.array(1.)}
+
+    def _init_from_factors(self, factors):
+        """ Rebuild the solver from stored triangular factors, without ordering and factorizing the matrix again. """
+        self.factors = factors
+        self.method = 'factors'
+        # a triangular matrix is its own LU factor, this gives fast triangular solves
+        lower, upper = (scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(factors[k]), permc_spec='NATURAL',
+                                                 diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+                        for k in ('lower', 'upper'))
+        row_order, column_order = np.asarray(factors['row_order']), np.asarray(factors['column_order'])
+        sign = float(factors['sign'])
+
+        def solve(rhs):
+            solution = np.empty(len(rhs))
+            solution[column_order] = sign * upper.solve(lower.solve(np.asarray(rhs, dtype=float)[row_order]))
+            return solution
+
+        self.solve = solve
+        self.memory = (factors['lower'].nnz + factors['upper'].nnz) * self.bytes_per_entry
+
+    @classmethod
+    def estimate_memory(cls, n_unknowns):
+        """
+        :return: expected size of the factorization of an n_unknowns 3D Poisson problem, bytes
+        """
+        return int(cls.fill_coefficient * n_unknowns ** (4 / 3) * cls.bytes_per_entry)
@@ -1,30 +1,136 @@
-from logging import warning
+from collections import namedtuple
+from logging import debug, info, warning
+from time import perf_counter
 
 import numpy as np
 import scipy.sparse
 import scipy.sparse.linalg
 
+from ef.field.solvers.cache import SolverCache, fingerprint
+from ef.field.solvers.direct import DirectSolver
+from ef.field.solvers.dst import DSTSolver
+from ef.field.solvers.field_solver_options import FieldSolverOptions
+from ef.field.solvers.multigrid import MultigridSolver
+from ef.field.solvers.preconditioners import make_preconditioner, ilu_upper_factor, ilu_upper_preconditioner
+from ef.field.solvers.recycling import SolutionSpace
+from ef.field.solvers.schwarz import SchwarzSolver
+from ef.field.solvers.stencil import StencilOperator
+
+
+SolveReport = namedtuple('SolveReport', ('solver', 'iterations', 'residual', 'wall_time', 'converged'))
+SolveReport.__doc__ = """
+Outcome of one linear solve: iterations are CG iterations or multigrid cycles (0 for direct solvers),
+residual is the relative residual norm (NaN when the DST solver did not assemble the matrix), wall time in seconds.
+"""
+
 
 class FieldSolver:
-    def __init__(self, spat_mesh, inner_regions):
-        if inner_regions:
-            print("WARNING: field-solver: inner region support is untested")
-            print("WARNING: proceed with caution")
-        self._double_index = self.double_index(spat_mesh.n_nodes)
+    # (solver, preconditioner) pairs benchmarked by the 'auto' solver, unsuitable ones are skipped
+    autotune_candidates = (('dst', 'none'), ('multigrid', 'none'), ('cg', 'multigrid'), ('cg', 'ilu'),
+                           ('direct', 'none'))
+    # attributes set by create_solver_and_preconditioner
+    _solver_state = ('solver', 'preconditioner_kind', 'preconditioner', 'multigrid', 'matrix_free', '_direct', '_dst',
+                     '_recycled', '_schwarz')
+
+    def __init__(self, spat_mesh, inner_regions, options=None, expected_solves=1):
+        """
+        :param options: FieldSolverOptions
+        :param expected_solves: number of Poisson solves in the run, the 'auto' solver optimizes their total time
+        """
+        self.options = FieldSolverOptions() if options is None else options
+        self.solver = self.choose_solver(self.options.solver, inner_regions)
+        self.preconditioner_kind = self.options.preconditioner
+        if self.solver == 'auto' and self.options.autotuned:
+            self.solver, self.preconditioner_kind = self.options.autotuned.split('/')
         nrows = (spat_mesh.n_nodes - 2).prod()
-        self.A = self.construct_equation_matrix(spat_mesh, inner_regions)
-        self.phi_vec = np.empty(nrows, dtype='f')
-        self.rhs = np.empty_like(self.phi_vec)
+        self._spat_mesh = spat_mesh
+        self._inner_regions = list(inner_regions)
+        self._A = None
+        self._coupling = None
+        self._cache = SolverCache(self.options.cache_dir or None, self.cache_key(spat_mesh, inner_regions))
+        # interior nodes inside each region, raveled in Fortran order like the equation unknowns
+        self._region_masks = list(self._cache.array('region_masks', lambda: np.array(
+            [mask.ravel('F') for mask in self.nodes_inside_each_object(spat_mesh, inner_regions)],
+            dtype=bool).reshape(len(inner_regions), nrows)))
+        self._inside = np.zeros(nrows, dtype=bool)
+        for mask in self._region_masks:
+            self._inside |= mask
+        self._free = np.logical_not(self._inside)
+        self._vacuum_rhs = None
+        self._vacuum_phi_vec = None
+        self._electrode_basis = []  # (time-dependent region, its nodes, its unit potential solution)
+        self._charge_phi_vec = np.zeros(nrows)
+        self._previous_solution = None  # per-step solution before the last one, for extrapolation
+        self.phi_vec = np.zeros(nrows)
+        self.rhs = np.zeros(nrows)
+        self.last_report = None  # SolveReport of the latest linear solve
+        self.expected_solves = expected_solves
         self.create_solver_and_preconditioner()
 
-    def construct_equation_matrix(self, spat_mesh, inner_regions):
+    @staticmethod
+    def cache_key(spat_mesh, inner_regions):
+        """
+        Everything the cached matrices, masks and factorizations depend on.
+        Boundary and region potentials only enter the right-hand side and are left out.
+        """
+        return fingerprint({'mesh': spat_mesh.mesh, 'regions': [[ir.shape, ir.inverted] for ir in inner_regions]})
+
+    @staticmethod
+    def choose_solver(solver, inner_regions):
+        if solver == 'default':
+            return 'cg' if inner_regions else 'dst'
+        if solver == 'dst' and inner_regions:
+            raise ValueError("DST field solver does not support inner regions")
+        return solver
+
+    @property
+    def A(self):
+        """
+        Equation matrix over the free nodes, only assembled when a solver needs it.
+        Nodes inside inner regions have known potentials and are eliminated, so the matrix stays symmetric.
+        """
+        if self._A is None and self.matrix_free:
+            self._A = StencilOperator(self._spat_mesh.n_nodes - 2, self._spat_mesh.cell, self._free)
+        elif self._A is None:
+            self.assemble_matrices()
+        return self._A
+
+    @property
+    def coupling(self):
+        """ Equation matrix entries in the rows of the free nodes and the columns of the eliminated nodes. """
+        if self._coupling is None:
+            self.assemble_matrices()
+        return self._coupling
+
+    def assemble_matrices(self):
+        """ Build, or load from the cache, the sparse equation matrix A and the coupling matrix. """
+        def assemble():
+            free_rows = self.construct_laplacian_matrix(self._spat_mesh)[self._free]
+            return {'A': free_rows[:, self._free].tocsr(), 'coupling': free_rows[:, self._inside].tocsr()}
+
+        matrices = self._cache.arrays('matrix', assemble)
+        self._coupling = matrices['coupling']
+        if self._A is None:  # a matrix-free operator is kept
+            self._A = matrices['A']
+
+    def construct_laplacian_matrix(self, spat_mesh):
         nx, ny, nz = spat_mesh.n_nodes - 2
         cx, cy, cz = spat_mesh.cell ** 2
         dx, dy, dz = cy * cz, cx * cz, cx * cy
-        matrix = dx * self.construct_d2dx2_in_3d(nx, ny, nz) + \
-            dy * self.construct_d2dy2_in_3d(nx, ny, nz) + \
-            dz * self.construct_d2dz2_in_3d(nx, ny, nz)
-        return self.zero_nondiag_for_nodes_inside_objects(matrix, spat_mesh, inner_regions)
+        return (dx * self.construct_d2dx2_in_3d(nx, ny, nz) +
+                dy * self.construct_d2dy2_in_3d(nx, ny, nz) +
+                dz * self.construct_d2dz2_in_3d(nx, ny, nz)).tocsr()
+
+    def reduced_rhs(self, rhs):
+        """
+        :param rhs: right-hand side over all interior nodes, potentials of the nodes inside inner regions included
+        :return: right-hand side of the equations for the free nodes, with the known potentials moved into it
+        """
+        if not self._inside.any():
+            return rhs
+        if self.matrix_free:
+            return rhs[self._free] - self.A.apply_to_full(np.where(self._inside, rhs, 0))[self._free]
+        return rhs[self._free] - self.coupling @ rhs[self._inside]
 
     @staticmethod
     def construct_d2dx2_in_3d(nx, ny, nz):
@@ -49,40 +155,256 @@ class FieldSolver:
         return scipy.sparse.diags([1.0, -2.0, 1.0], [-diag_offset, 0, diag_offset], shape=(block_size, block_size),
                                   format='csr')
 
-    def zero_nondiag_for_nodes_inside_objects(self, matrix, mesh, inner_regions):
-        for ir in inner_regions:
-            for n, i, j, k in self._double_index:
-                xyz = mesh.cell * (i, j, k)
-                if ir.check_if_points_inside(xyz):
-                    csr_row_start = matrix.indptr[n]
-                    csr_row_end = matrix.indptr[n + 1]
-                    for t in range(csr_row_start, csr_row_end):
-                        if matrix.indices[t] != n:
-                            matrix.data[t] = 0
-                        else:
-                            matrix.data[t] = 1
-        return matrix
+    def region_masks(self, spat_mesh, inner_regions):
+        """
+        :return: list of boolean vectors over the unknowns, nodes inside each region, cached for the solver regions
+        """
+        if spat_mesh is self._spat_mesh and len(inner_regions) == len(self._inner_regions) and \
+                all(a is b for a, b in zip(inner_regions, self._inner_regions)):
+            return self._region_masks
+        return [mask.ravel('F') for mask in self.nodes_inside_each_object(spat_mesh, inner_regions)]
 
     def create_solver_and_preconditioner(self):
-        self.maxiter = 1000
-        self.tol = 1e-10
-        # abstol = 0
-        # verbose = true
-        # monitor(rhs, iteration_limit, rtol, abstol, verbose)
-        # precond(A.num_rows, A.num_rows)
+        self.maxiter = self.options.max_iterations
+        self.tol = self.options.tolerance
+        self.preconditioner = None
+        self.multigrid = None
+        self._recycled = None
+        if getattr(self, '_schwarz', None) is not None:
+            self.close()
+        self._schwarz = None
+        n_free = np.count_nonzero(self._free)
+        if self.solver in ('direct', 'schwarz') and self.options.operator == 'matrix_free':
+            raise ValueError(f"{self.solver.capitalize()} field solver needs an assembled matrix")
+        # the Schwarz solver factorizes parts of the matrix, it is always assembled
+        self.matrix_free = self.solver != 'schwarz' and (self.options.operator == 'matrix_free' or (
+            self.options.operator == 'auto' and
+            StencilOperator.assembly_memory(n_free) > self.options.assembly_memory_limit))
+        if self.matrix_free and self.options.operator == 'auto':
+            info(f"Field solver uses the matrix-free operator, assembling the matrix would take about "
+                 f"{StencilOperator.assembly_memory(n_free) / 2 ** 20:.0f} MiB, more than the "
+                 f"{self.options.assembly_memory_limit / 2 ** 20:.0f} MiB assembly_memory_limit")
+        if self.solver == 'direct':
+            estimate = DirectSolver.estimate_memory(n_free)
+            if estimate > self.options.memory_limit:
+                warning(f"Direct field solver would need about {estimate / 2 ** 20:.0f} MiB, "
+                        f"more than the {self.options.memory_limit / 2 ** 20:.0f} MiB limit, using CG instead")
+                self.solver = 'cg'
+            else:
+                self._direct = self.make_direct_solver()
+        if self.solver == 'multigrid' or self.solver == 'cg' and self.preconditioner_kind == 'multigrid':
+            self.multigrid = MultigridSolver(self._spat_mesh.n_nodes - 2, self._spat_mesh.cell,
+                                             self._inside.reshape(self._spat_mesh.n_nodes - 2, order='F'),
+                                             self.tol, self.maxiter)
+        if self.solver == 'schwarz' or self.solver == 'cg' and self.preconditioner_kind == 'schwarz' and \
+                not self.matrix_free:
+            counts = self._free.reshape(self._spat_mesh.n_nodes - 2, order='F').sum(axis=(0, 1))
+            self._schwarz = SchwarzSolver(self.A, np.concatenate([[0], np.cumsum(counts)]),
+                                          self.options.subdomains or self.options.workers, self.options.workers)
+        if self.solver == 'cg':
+            if self.preconditioner_kind == 'multigrid':
+                self.preconditioner = self.multigrid.as_preconditioner(self._free)
+            elif self._schwarz is not None:
+                self.preconditioner = self._schwarz.as_preconditioner()
+            elif self.matrix_free and self.preconditioner_kind in ('ilu', 'amg', 'schwarz'):
+                warning(f"{self.preconditioner_kind} preconditioner needs an assembled matrix, "
+                        f"using Jacobi with the matrix-free operator")
+                self.preconditioner = make_preconditioner('jacobi', self.A)
+            elif self.preconditioner_kind == 'ilu':
+                self.preconditioner = ilu_upper_preconditioner(self._cache.sparse('ilu',
+                                                                                  lambda: ilu_upper_factor(self.A)))
+            else:
+                self.preconditioner = make_preconditioner(self.preconditioner_kind, self.A)
+            size = min(self.options.recycle_size, SolutionSpace.max_size(n_free, self.options.recycle_memory_limit))
+            if size > 0:
+                self._recycled = SolutionSpace(n_free, size)
+        elif self.solver == 'dst':
+            self._dst = DSTSolver(self._spat_mesh.n_nodes - 2, self._spat_mesh.cell)
+
+    def autotune(self, rhs):
+        """
+        Benchmark the candidate solvers on the right-hand side and keep the one with the least setup time
+        plus solve time multiplied by the expected number of solves.
+        Candidates that fail are logged and skipped.
+        The options keep 'auto', the choice is recorded in their autotuned field,
+        so it is saved with the simulation and reused on restart.
+        """
+        n_free = np.count_nonzero(self._free)
+        coarsest = np.prod(MultigridSolver.coarsest_shape(self._spat_mesh.n_nodes - 2))
+        best, best_rank, costs = None, None, {}
+        best_state = {k: getattr(self, k, None) for k in self._solver_state}
+        for solver, preconditioner in self.autotune_candidates:
+            if solver == 'dst' and self._inside.any() or \
+                    solver == 'direct' and (DirectSolver.estimate_memory(n_free) > self.options.memory_limit or
+                                            self.options.operator == 'matrix_free') or \
+                    'multigrid' in (solver, preconditioner) and coarsest > MultigridSolver.direct_size:
+                continue
+            self.solver, self.preconditioner_kind = solver, preconditioner
+            try:
+                start = perf_counter()
+                self.create_solver_and_preconditioner()
+                self.solve_linear_system(rhs, np.zeros_like(rhs))
+            except Exception as err:
+                warning(f"Field solver autotuning skips {solver} with {preconditioner} preconditioner, "
+                        f"it failed: {err!r}")
+                for k, v in best_state.items():
+                    setattr(self, k, v)
+                continue
+            setup = perf_counter() - start - self.last_report.wall_time
+            cost = setup + self.last_report.wall_time * self.expected_solves
+            costs[f"{solver}/{preconditioner}"] = cost
+            rank = (not self.last_report.converged, cost)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = (solver, preconditioner), rank
+                best_state = {k: getattr(self, k, None) for k in self._solver_state}
+        if best is None:
+            raise RuntimeError("Field solver autotuning found no working solver")
+        for k, v in best_state.items():
+            setattr(self, k, v)
+        self.options.autotuned = '/'.join(best)
+        info(f"Field solver autotuning chose {best[0]} with {best[1]} preconditioner for {self.expected_solves} "
+             f"solves, estimated total times: " + ', '.join(f"{k} {v:.3g} s" for k, v in costs.items()))
+
+    def make_direct_solver(self):
+        if self._cache.path is None:
+            return DirectSolver(self.A)
+        solver = None
+
+        def factorize():
+            nonlocal solver
+            solver = DirectSolver(self.A)
+            return solver.factors
+
+        factors = self._cache.arrays('direct', factorize)
+        # a solver loaded from the cache solves with the stored triangular factors
+        return solver if solver is not None else DirectSolver(factors=factors)
+
+    def close(self):
+        """ Stop the worker processes of the Schwarz solver, if there are any. """
+        if self._schwarz is not None:
+            self._schwarz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def eval_potential(self, spat_mesh, inner_regions):
         self.solve_poisson_eqn(spat_mesh, inner_regions)
 
     def solve_poisson_eqn(self, spat_mesh, inner_regions):
-        self.init_rhs_vector(spat_mesh, inner_regions)
-        # cusp::krylov::cg(A, phi_vec, rhs, monitor, precond)
-        self.phi_vec, info = scipy.sparse.linalg.cg(self.A, self.rhs, self.phi_vec,
-                                                    self.tol, self.maxiter)
-        if info != 0:
-            warning(f"scipy.sparse.linalg.cg info: {info}")
+        if self.solver == 'auto':
+            self.init_rhs_vector(spat_mesh, inner_regions)
+            self.autotune(self.rhs)
+        if self.options.vacuum_superposition:
+            # Potential of the electrodes and boundaries without charge is solved once,
+            # each step only solves for the space charge with zero potential on all of them.
+            charge_rhs = self.charge_rhs_vector(spat_mesh)
+            if self._vacuum_phi_vec is None:
+                self.init_vacuum_solutions(spat_mesh, inner_regions, charge_rhs)
+            vacuum_rhs, vacuum_phi_vec = self._vacuum_rhs, self._vacuum_phi_vec
+            for ir, mask, phi in self._electrode_basis:
+                vacuum_rhs = vacuum_rhs + ir.potential * mask
+                vacuum_phi_vec = vacuum_phi_vec + ir.potential * phi
+            self.rhs = vacuum_rhs + charge_rhs
+            self._charge_phi_vec = self.solve_step(charge_rhs, self._charge_phi_vec)
+            self.phi_vec = vacuum_phi_vec + self._charge_phi_vec
+        else:
+            self.init_rhs_vector(spat_mesh, inner_regions)
+            self.phi_vec = self.solve_step(self.rhs, self.phi_vec)
         self.transfer_solution_to_spat_mesh(spat_mesh)
 
+    def init_vacuum_solutions(self, spat_mesh, inner_regions, charge_rhs):
+        """
+        Solve for the potential of the boundaries and constant potential regions without space charge,
+        and for the potential of each time-dependent region at unit potential with everything else grounded.
+        """
+        self.init_rhs_vector(spat_mesh, inner_regions)
+        self._vacuum_rhs = self.rhs - charge_rhs
+        self._electrode_basis = []
+        owner = np.full(len(self.rhs), -1)
+        for i, mask in enumerate(self.region_masks(spat_mesh, inner_regions)):
+            owner[mask] = i
+        for i, ir in enumerate(inner_regions):
+            if ir.is_time_dependent:
+                mask = (owner == i).astype(float)
+                self._vacuum_rhs[owner == i] = 0
+                self._electrode_basis.append((ir, mask, self.solve_linear_system(mask, np.zeros_like(mask))))
+        self._vacuum_phi_vec = self.solve_linear_system(self._vacuum_rhs, self.phi_vec)
+
+    def solve_step(self, rhs, last_solution):
+        """
+        Per-step solve warm started from the last step's solution,
+        or from its linear extrapolation through the two last steps if the options ask for it.
+        """
+        initial = last_solution
+        if self.options.extrapolate and self._previous_solution is not None:
+            initial = 2 * last_solution - self._previous_solution
+        self._previous_solution = last_solution
+        return self.solve_linear_system(rhs, initial)
+
+    def solve_linear_system(self, rhs, initial):
+        """
+        :param rhs: right-hand side vector, potentials of the nodes inside inner regions included
+        :param initial: initial guess, used by iterative solvers
+        :return: solution vector over all interior nodes, self.last_report describes the solve
+        """
+        start = perf_counter()
+        iterations, residual, converged = 0, np.nan, True
+        if self.solver == 'dst':
+            solution = self._dst.solve(rhs)
+        elif self.solver == 'multigrid':
+            # multigrid keeps the nodes inside regions fixed itself
+            # the previous solution is a good initial guess, full multigrid only starts from scratch
+            solution = self.multigrid.solve(rhs, initial if initial.any() else None)
+            iterations = len(self.multigrid.history)
+            residual = self.multigrid.history[-1] if self.multigrid.history else 0.
+            converged = residual <= self.tol
+        else:
+            reduced = self.reduced_rhs(rhs)
+            if self.solver == 'direct':
+                free_solution = self._direct.solve(reduced)
+            elif self.solver == 'schwarz':
+                free_solution, iterations, converged = self._schwarz.solve(self.A, reduced, initial[self._free],
+                                                                           self.tol, self.maxiter)
+            else:
+                initial = initial[self._free]
+                if self._recycled is not None:
+                    initial = self._recycled.initial_guess(self.A, reduced, initial)
+                free_solution, iterations, converged = self.solve_cg(reduced, initial)
+            product = self.A @ free_solution
+            norm = np.linalg.norm(reduced)
+            residual = np.linalg.norm(reduced - product) / norm if norm else 0.
+            if self._recycled is not None:
+                self._recycled.add(free_solution, product)
+            # scatter the free node values back, nodes inside regions keep their known potentials
+            solution = np.array(rhs, dtype=float)
+            solution[self._free] = free_solution
+        self.last_report = SolveReport(self.solver, iterations, residual, perf_counter() - start, converged)
+        if converged:
+            debug(f"Field solve: {self.last_report}")
+        else:
+            warning(f"Field solver did not converge: {self.last_report}")
+        return solution
+
+    def solve_cg(self, rhs, initial):
+        """
+        :return: solution, number of iterations and whether CG converged
+        """
+        if not rhs.any():
+            # zero relative tolerance can not be reached from a non-zero initial guess
+            return np.zeros_like(rhs), 0, True
+        iterations = 0
+
+        def count(xk):
+            nonlocal iterations
+            iterations += 1
+
+        solution, info = scipy.sparse.linalg.cg(self.A, rhs, initial, tol=self.tol, atol=0,
+                                                maxiter=self.maxiter, M=self.preconditioner, callback=count)
+        return solution, iterations, info == 0
+
     def init_rhs_vector(self, spat_mesh, inner_regions):
         self.init_rhs_vector_in_full_domain(spat_mesh)
         self.set_rhs_for_nodes_inside_objects(spat_mesh, inner_regions)
@@ -99,12 +421,25 @@ class FieldSolver:
         rhs[:, :, -1] -= dx * dx * dy * dy * m.potential[1:-1, 1:-1, -1]
         self.rhs = rhs.ravel('F')
 
+    def charge_rhs_vector(self, spat_mesh):
+        """
+        :return: right-hand side for the potential of the space charge alone, zero inside inner regions
+        """
+        rhs = (-4 * np.pi * spat_mesh.cell.prod() ** 2 * spat_mesh.charge_density[1:-1, 1:-1, 1:-1]).ravel('F')
+        rhs[self._inside] = 0
+        return rhs
+
+    @staticmethod
+    def nodes_inside_each_object(spat_mesh, inner_regions):
+        """
+        :return: list of boolean arrays of shape (n_nodes - 2), interior nodes inside each of the inner regions
+        """
+        xyz = spat_mesh.node_coordinates[1:-1, 1:-1, 1:-1]
+        return [ir.check_if_points_inside(xyz.reshape(-1, 3)).reshape(xyz.shape[:3]) for ir in inner_regions]
+
     def set_rhs_for_nodes_inside_objects(self, spat_mesh, inner_regions):
-        for ir in inner_regions:
-            for n, i, j, k in self._double_index:
-                xyz = spat_mesh.cell * (i, j, k)
-                if ir.check_if_points_inside(xyz):
-                    self.rhs[n] = ir.potential  # where is dx**2 dy**2 etc?
+        for ir, mask in zip(inner_regions, self.region_masks(spat_mesh, inner_regions)):
+            self.rhs[mask] = ir.potential  # identity rows, no cell size factors
 
     def transfer_solution_to_spat_mesh(self, spat_mesh):
         spat_mesh.potential[1:-1, 1:-1, 1:-1] = self.phi_vec.reshape(spat_mesh.n_nodes - 2, order='F')
@@ -112,10 +447,4 @@ class FieldSolver:
     @staticmethod
     def eval_fields_from_potential(spat_mesh):
         e = -np.stack(np.gradient(spat_mesh.potential, *spat_mesh.cell), -1)
-        spat_mesh.electric_field = e
-
-    @staticmethod
-    def double_index(n_nodes):
-        nx, ny, nz = n_nodes - 2
-        return [(i + j * nx + k * nx * ny, i + 1, j + 1, k + 1)
-                for k in range(nz) for j in range(ny) for i in range(nx)]
+        spat_mesh.set_electric_field(e)
@@ -0,0 +1,59 @@
+import sys
+
+from ef.util.serializable_h5 import SerializableH5
+
+
+class FieldSolverOptions(SerializableH5):
+    """
+    Run-wide choices of the Poisson solver, saved with the simulation so that restarts solve the same way.
+    """
+    # 'default' is the DST solver for meshes without inner regions, CG otherwise,
+    # 'auto' benchmarks the solvers on the first solve and records the fastest one in autotuned
+    solvers = ('default', 'cg', 'dst', 'multigrid', 'direct', 'auto', 'schwarz')
+    preconditioners = ('none', 'jacobi', 'ilu', 'amg', 'multigrid', 'schwarz')
+    # 'auto' applies the stencil without a matrix when assembling one would take more than assembly_memory_limit
+    operators = ('auto', 'assembled', 'matrix_free')
+
+    def __init__(self, solver='default', preconditioner='none', tolerance=1e-10, max_iterations=1000,
+                 memory_limit=1 << 30, vacuum_superposition=True, extrapolate=False,
+                 operator='auto', cache_dir='', recycle_size=0, recycle_memory_limit=1 << 28,
+                 workers=1, subdomains=0, assembly_memory_limit=1 << 30, autotuned=''):
+        if solver not in self.solvers:
+            raise ValueError("Unexpected field solver: {}".format(solver))
+        if preconditioner not in self.preconditioners:
+            raise ValueError("Unexpected field solver preconditioner: {}".format(preconditioner))
+        if operator not in self.operators:
+            raise ValueError("Unexpected field solver operator: {}".format(operator))
+        if tolerance <= 0:
+            raise ValueError("Expect tolerance > 0")
+        if max_iterations < 1:
+            raise ValueError("Expect max_iterations >= 1")
+        if memory_limit <= 0:
+            raise ValueError("Expect memory_limit > 0")
+        if assembly_memory_limit <= 0:
+            raise ValueError("Expect assembly_memory_limit > 0")
+        if recycle_size < 0:
+            raise ValueError("Expect recycle_size >= 0")
+        if workers < 1:
+            raise ValueError("Expect workers >= 1")
+        if workers > 1 and sys.version_info < (3, 8):
+            raise ValueError("Field solver workers > 1 need Python 3.8 or newer for shared memory")
+        self.solver = solver
+        self.preconditioner = preconditioner  # CG only
+        self.tolerance = tolerance  # relative residual norm to stop iterations at
+        self.max_iterations = max_iterations  # CG iterations or multigrid cycles
+        self.memory_limit = memory_limit  # bytes, larger direct factorizations fall back to CG
+        # solve for the fixed boundary and inner region potentials once, then only for the space charge
+        self.vacuum_superposition = bool(vacuum_superposition)
+        # start iterative solves from the linear extrapolation of the two last steps instead of the last one
+        self.extrapolate = bool(extrapolate)
+        self.operator = operator
+        self.cache_dir = cache_dir  # directory for matrices and factorizations shared between runs, '' for none
+        # CG starts from the projection onto up to this many previous solutions, 0 to disable
+        self.recycle_size = recycle_size
+        self.recycle_memory_limit = recycle_memory_limit  # bytes, caps the stored previous solutions
+        self.workers = workers  # processes of the Schwarz solver
+        self.subdomains = subdomains  # z slabs of the Schwarz solver, 0 for one per worker
+        self.assembly_memory_limit = assembly_memory_limit  # bytes, the 'auto' operator assembles matrices up to it
+        # 'solver/preconditioner' chosen by the 'auto' solver, saved so that restarts do not benchmark again
+        self.autotuned = autotuned
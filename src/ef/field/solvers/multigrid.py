@@ -0,0 +1,275 @@
+import logging
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+class MultigridLevel:
+    """
+    Interior nodes of one grid of the multigrid hierarchy, stored with a layer of zero Dirichlet
+    boundary nodes around them so that the 7-point stencil is applied with array slices.
+    """
+
+    def __init__(self, shape, cell, fixed):
+        self.shape = tuple(shape)
+        self.cell = np.asarray(cell, dtype=float)
+        self.fixed = fixed  # nodes with known values, their corrections are always zero
+        self.weights = 1 / self.cell ** 2
+        self.diagonal = -2 * self.weights.sum()
+        self.padded = np.zeros([n + 2 for n in self.shape])
+        self.coarsened_axes = [axis for axis, n in enumerate(self.shape) if n % 2 == 1 and n >= 3]
+        # Nodes of each color form four sublattices with every other node along each axis,
+        # they are updated with strided slices of the padded array.
+        self.colors = [[self._sublattice(offsets) for offsets in np.ndindex(2, 2, 2) if sum(offsets) % 2 == color]
+                       for color in (0, 1)]
+
+    def _sublattice(self, offsets):
+        def padded_slice(shift):
+            return tuple(slice(1 + o + s, n + 1 + s, 2) for o, s, n in zip(offsets, shift, self.shape))
+
+        neighbors = [padded_slice(shift) for axis in range(3) for shift in (-np.eye(3, dtype=int)[axis],
+                                                                           np.eye(3, dtype=int)[axis])]
+        inner = tuple(slice(o, None, 2) for o in offsets)
+        free = np.logical_not(self.fixed[inner])
+        return padded_slice((0, 0, 0)), neighbors, inner, None if free.all() else free
+
+    @property
+    def inner(self):
+        return self.padded[1:-1, 1:-1, 1:-1]
+
+    def neighbor_sum(self, u_padded):
+        """ Off-diagonal part of the Laplacian applied to the padded array. """
+        p = u_padded
+        return self.weights[0] * (p[:-2, 1:-1, 1:-1] + p[2:, 1:-1, 1:-1]) + \
+            self.weights[1] * (p[1:-1, :-2, 1:-1] + p[1:-1, 2:, 1:-1]) + \
+            self.weights[2] * (p[1:-1, 1:-1, :-2] + p[1:-1, 1:-1, 2:])
+
+    def smooth(self, f, sweeps, reverse=False):
+        """ Red-black Gauss-Seidel sweeps on the free nodes of self.inner. """
+        colors = self.colors[::-1] if reverse else self.colors
+        p = self.padded
+        w = self.weights
+        for _ in range(sweeps):
+            for color in colors:
+                for center, n, inner, free in color:
+                    update = f[inner] - w[0] * (p[n[0]] + p[n[1]]) - w[1] * (p[n[2]] + p[n[3]]) - \
+                        w[2] * (p[n[4]] + p[n[5]])
+                    update /= self.diagonal
+                    if free is None:
+                        p[center] = update
+                    else:
+                        np.copyto(p[center], update, where=free)
+
+    def residual(self, f, u=None):
+        if u is not None:
+            self.inner[...] = u
+        r = f - self.neighbor_sum(self.padded) - self.diagonal * self.inner
+        r[self.fixed] = 0
+        return r
+
+    def restrict(self, fine):
+        """ Full weighting onto the nodes of the next coarser level. """
+        for axis in self.coarsened_axes:
+            fine = np.moveaxis(fine, axis, 0)
+            fine = np.moveaxis(0.25 * fine[:-2:2] + 0.5 * fine[1:-1:2] + 0.25 * fine[2::2], 0, axis)
+        return fine
+
+    def prolong(self, coarse):
+        """ Multilinear interpolation from the next coarser level. """
+        for axis in self.coarsened_axes:
+            coarse = np.moveaxis(coarse, axis, 0)
+            padded = np.concatenate([np.zeros_like(coarse[:1]), coarse, np.zeros_like(coarse[:1])])
+            fine = np.empty((2 * len(coarse) + 1,) + coarse.shape[1:])
+            fine[1::2] = coarse
+            fine[::2] = 0.5 * (padded[:-1] + padded[1:])
+            coarse = np.moveaxis(fine, 0, axis)
+        return coarse
+
+    def coarser(self):
+        shape, cell = list(self.shape), self.cell.copy()
+        fixed = self.fixed
+        for axis in self.coarsened_axes:
+            shape[axis] = (shape[axis] - 1) // 2
+            cell[axis] *= 2
+            fixed = np.moveaxis(np.moveaxis(fixed, axis, 0)[1::2], 0, axis)
+        return MultigridLevel(shape, cell, fixed)
+
+    def matrix(self):
+        """ Sparse Laplacian over the level nodes in C order, fixed nodes are decoupled from the others. """
+        eye = [scipy.sparse.identity(n) for n in self.shape]
+        laplacian = 0
+        for axis, n in enumerate(self.shape):
+            d2 = scipy.sparse.diags([1., -2., 1.], [-1, 0, 1], shape=(n, n))
+            factors = [d2 if a == axis else eye[a] for a in range(3)]
+            laplacian = laplacian + self.weights[axis] * \
+                scipy.sparse.kron(scipy.sparse.kron(factors[0], factors[1]), factors[2])
+        free = scipy.sparse.diags(np.logical_not(self.fixed).ravel().astype(float))
+        fixed = scipy.sparse.diags(self.diagonal * self.fixed.ravel())
+        return scipy.sparse.csc_matrix(free @ laplacian @ free + fixed)
+
+
+class MultigridSolver:
+    """
+    Geometric multigrid for the FieldSolver equations on a uniform mesh.
+
+    Grids are coarsened by dropping every other node along each axis with an odd number of interior nodes,
+    down to a grid that is solved directly. Nodes inside inner regions keep their potential on the finest grid
+    and are Dirichlet nodes with zero correction on every grid.
+    """
+    coarsest_size = 1000  # grids are coarsened until they have fewer nodes than this
+    # coarsest grids up to this size are factorized, larger ones get a fixed number of Chebyshev iterations
+    direct_size = 1 << 13
+    coarsest_tolerance = 1e-3  # error reduction the number of Chebyshev iterations is chosen for
+    pre_smoothing = 2
+    post_smoothing = 2
+
+    def __init__(self, n_interior, cell, fixed=None, tolerance=1e-10, max_cycles=100):
+        """
+        :param n_interior: numbers of unknown nodes along each axis, (n_nodes - 2)
+        :param cell: mesh cell size
+        :param fixed: optional boolean array of shape n_interior, nodes inside inner regions
+        :param tolerance: relative residual norm to stop V-cycles at
+        :param max_cycles: limit on V-cycles per solve
+        """
+        shape = tuple(int(n) for n in n_interior)
+        fixed = np.zeros(shape, dtype=bool) if fixed is None else np.asarray(fixed, dtype=bool)
+        self.tolerance = tolerance
+        self.max_cycles = max_cycles
+        self.levels = [MultigridLevel(shape, cell, fixed)]
+        while self.levels[-1].coarsened_axes and self.levels[-1].inner.size > self.coarsest_size:
+            self.levels.append(self.levels[-1].coarser())
+        coarsest = self.levels[-1]
+        self.factorized = coarsest.inner.size <= self.direct_size
+        if self.factorized:
+            self.coarsest_solve = scipy.sparse.linalg.splu(coarsest.matrix()).solve
+        else:
+            logging.warning(f"Multigrid can not coarsen the mesh below {coarsest.shape} interior nodes, "
+                            f"numbers of mesh cells divisible by a large power of 2 work best")
+            self.coarsest_solve = self.chebyshev(coarsest)
+        # FieldSolver equations are multiplied by the squared cell volume
+        self.scale = np.prod(np.asarray(cell, dtype=float)) ** 2
+        self.history = []  # relative residual norms after each cycle of the last solve
+
+    @classmethod
+    def coarsest_shape(cls, n_interior):
+        """ :return: shape of the coarsest grid for the numbers of unknown nodes along each axis """
+        shape = [int(n) for n in n_interior]
+        while np.prod(shape) > cls.coarsest_size and any(n % 2 == 1 and n >= 3 for n in shape):
+            shape = [(n - 1) // 2 if n % 2 == 1 and n >= 3 else n for n in shape]
+        return tuple(shape)
+
+    def chebyshev(self, level):
+        """
+        Coarsest grid solver for grids too large to factorize: a fixed number of Chebyshev iterations
+        from a zero initial guess, with the eigenvalue bounds of the Dirichlet Laplacian of the grid.
+        It is a fixed symmetric polynomial in the matrix, unlike CG to a tolerance,
+        so the V-cycle stays a valid CG preconditioner.
+        """
+        matrix = -level.matrix()  # positive definite
+        quarter_waves = [np.pi / (2 * (n + 1)) for n in level.shape]
+        smallest = 4 * sum(w * np.sin(q) ** 2 for w, q in zip(level.weights, quarter_waves))
+        largest = 4 * sum(w * np.cos(q) ** 2 for w, q in zip(level.weights, quarter_waves))
+        theta, delta = (largest + smallest) / 2, (largest - smallest) / 2
+        root = np.sqrt(largest / smallest)
+        iterations = int(np.ceil(np.log(2 / self.coarsest_tolerance) / np.log((root + 1) / (root - 1))))
+
+        def solve(f):
+            rhs = -f
+            solution = np.zeros_like(rhs)
+            residual = rhs.copy()
+            direction = residual / theta
+            rho = delta / theta
+            for _ in range(iterations):
+                solution += direction
+                residual -= matrix @ direction
+                rho_next = 1 / (2 * theta / delta - rho)
+                direction = rho_next * rho * direction + 2 * rho_next / delta * residual
+                rho = rho_next
+            return solution
+
+        return solve
+
+    def solve(self, rhs, initial=None, max_cycles=None, full_multigrid=None):
+        """
+        Solve FieldSolver equations: scaled Laplacian rows for free nodes, identity rows for fixed ones.
+
+        :param rhs: right-hand side vector of FieldSolver, interior nodes raveled in Fortran order
+        :param initial: optional initial guess in the same layout
+        :param max_cycles: optional override of the V-cycle limit
+        :param full_multigrid: start from a full multigrid pass, by default when there is no initial guess
+        :return: solution vector in the same layout
+        """
+        finest = self.levels[0]
+        rhs = rhs.reshape(finest.shape, order='F')
+        f = rhs / self.scale
+        u = np.zeros(finest.shape)
+        u[finest.fixed] = rhs[finest.fixed]
+        full_multigrid = initial is None if full_multigrid is None else full_multigrid
+        max_cycles = self.max_cycles if max_cycles is None else max_cycles
+        # residuals are relative to the one of the zero initial guess, as in scipy Krylov solvers
+        residual = finest.residual(f, u)
+        norm = np.linalg.norm(residual)
+        self.history = []
+        if norm == 0:
+            return u.ravel('F')
+        if initial is not None:
+            u[~finest.fixed] = initial.reshape(finest.shape, order='F')[~finest.fixed]
+            residual = finest.residual(f, u)
+            if np.linalg.norm(residual) <= self.tolerance * norm:
+                return u.ravel('F')
+        if full_multigrid:
+            u += self.full_multigrid(residual)
+            residual = finest.residual(f, u)
+            self.history.append(np.linalg.norm(residual) / norm)
+        while len(self.history) < max_cycles and (not self.history or self.history[-1] > self.tolerance):
+            u += self.v_cycle(0, residual)
+            residual = finest.residual(f, u)
+            self.history.append(np.linalg.norm(residual) / norm)
+        return u.ravel('F')
+
+    def v_cycle(self, level_number, f):
+        """
+        :return: approximate solution of the correction equation at the level, zero at fixed nodes
+        """
+        level = self.levels[level_number]
+        if level_number == len(self.levels) - 1:
+            return self.coarsest_solve(f.ravel()).reshape(level.shape)
+        level.inner[...] = 0
+        level.smooth(f, self.pre_smoothing)
+        correction = self.v_cycle(level_number + 1, level.restrict(level.residual(f)))
+        # the recursive call only used deeper levels, this level's state is intact
+        level.inner[...] += level.prolong(correction) * np.logical_not(level.fixed)
+        level.smooth(f, self.post_smoothing, reverse=True)
+        return level.inner.copy()
+
+    def full_multigrid(self, f):
+        """ Solve the correction equation from the coarsest grid up, with one V-cycle on each finer grid. """
+        rhs = [f]
+        for level in self.levels[:-1]:
+            rhs.append(level.restrict(rhs[-1]))
+        u = self.coarsest_solve(rhs[-1].ravel()).reshape(self.levels[-1].shape)
+        for level_number in range(len(self.levels) - 2, -1, -1):
+            level = self.levels[level_number]
+            u = level.prolong(u) * np.logical_not(level.fixed)
+            u += self.v_cycle(level_number, level.residual(rhs[level_number], u))
+        return u
+
+    def as_preconditioner(self, free=None):
+        """
+        One V-cycle from a zero initial guess, as a LinearOperator for scipy Krylov solvers.
+
+        :param free: optional boolean mask of the unknowns the Krylov solver works on, the free nodes in Fortran order
+        """
+        n = self.levels[0].inner.size
+        if free is None:
+            return scipy.sparse.linalg.LinearOperator(
+                (n, n), lambda r: self.solve(r, np.zeros(n), max_cycles=1, full_multigrid=False), dtype=float)
+
+        def v_cycle(r):
+            rhs = np.zeros(n)
+            rhs[free] = r.ravel()
+            return self.solve(rhs, np.zeros(n), max_cycles=1, full_multigrid=False)[free]
+
+        m = np.count_nonzero(free)
+        return scipy.sparse.linalg.LinearOperator((m, m), v_cycle, dtype=float)
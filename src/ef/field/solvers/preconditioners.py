@@ -0,0 +1,67 @@
+import logging
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+def make_preconditioner(kind, matrix):
+    """
+    Build an approximate inverse of the equation matrix once, to be reused in every solve.
+
+    :param kind: one of FieldSolverOptions.preconditioners
+    :param matrix: sparse square matrix
+    :return: LinearOperator applying the approximate inverse, or None for 'none'
+    """
+    if kind == 'none':
+        return None
+    elif kind == 'jacobi':
+        return jacobi_preconditioner(matrix)
+    elif kind == 'ilu':
+        return ilu_preconditioner(matrix)
+    elif kind == 'amg':
+        try:
+            return amg_preconditioner(matrix)
+        except ImportError:
+            logging.warning("pyamg is not installed, using ILU preconditioner instead of AMG")
+            return ilu_preconditioner(matrix)
+    raise ValueError("Unexpected field solver preconditioner: {}".format(kind))
+
+
+def jacobi_preconditioner(matrix):
+    inverse_diagonal = 1 / matrix.diagonal()
+    return scipy.sparse.linalg.LinearOperator(matrix.shape, lambda x: inverse_diagonal * x.ravel(),
+                                              dtype=matrix.dtype)
+
+
+def ilu_preconditioner(matrix, drop_tol=1e-2, fill_factor=2):
+    """
+    Incomplete factorization A ~ L U without pivoting, applied as the symmetric U^T D^-1 U,
+    D = diag(U), so that conjugate gradients stay valid whatever entries the ILU dropped.
+    """
+    return ilu_upper_preconditioner(ilu_upper_factor(matrix, drop_tol, fill_factor))
+
+
+def ilu_upper_factor(matrix, drop_tol=1e-2, fill_factor=2):
+    ilu = scipy.sparse.linalg.spilu(scipy.sparse.csc_matrix(matrix), drop_tol=drop_tol, fill_factor=fill_factor,
+                                    drop_rule='basic', permc_spec='NATURAL', diag_pivot_thresh=0)
+    return scipy.sparse.csc_matrix(ilu.U)
+
+
+def ilu_upper_preconditioner(upper):
+    """ U^T D^-1 U preconditioner from the upper ILU factor, see ilu_preconditioner. """
+    upper = scipy.sparse.csc_matrix(upper)
+    diagonal = upper.diagonal()
+    # a triangular matrix is its own LU factor, this gives fast solves with U and U^T
+    triangular = scipy.sparse.linalg.splu(upper, permc_spec='NATURAL', diag_pivot_thresh=0)
+    return scipy.sparse.linalg.LinearOperator(
+        upper.shape, lambda x: triangular.solve(triangular.solve(x.ravel(), trans='T') * diagonal),
+        dtype=np.float64)
+
+
+def amg_preconditioner(matrix):
+    import pyamg
+    # pyamg expects a positive definite matrix, the Laplacian is negative definite
+    hierarchy = pyamg.smoothed_aggregation_solver(-scipy.sparse.csr_matrix(matrix))
+    negative = hierarchy.aspreconditioner(cycle='V')
+    return scipy.sparse.linalg.LinearOperator(matrix.shape, lambda x: -negative.matvec(x), dtype=np.float64)
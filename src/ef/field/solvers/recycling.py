@@ -0,0 +1,60 @@
+import numpy as np
+
+
+class SolutionSpace:
+    """
+    Subspace of previous solutions of the same linear system, used to start CG from the best guess within it.
+
+    Solutions are kept orthonormal in the energy inner product of the negative definite FieldSolver matrix A,
+    <u, v> = -u.(A v), together with their products with A, so the projection of a new solution onto the
+    subspace only takes one matrix-vector product and dot products with the basis (Fischer, 1998).
+    When the subspace is full it restarts from the latest solution.
+    """
+
+    def __init__(self, n, size):
+        """
+        :param n: number of unknowns
+        :param size: maximum number of basis vectors
+        """
+        self.size = size
+        self.count = 0
+        self.basis = np.empty((size, n))
+        self.products = np.empty((size, n))  # A @ basis vectors
+
+    @staticmethod
+    def max_size(n, memory_limit):
+        """ Number of basis vectors of length n that fit in memory_limit bytes with their products. """
+        return int(memory_limit // (2 * 8 * n))
+
+    def initial_guess(self, matrix, rhs, initial):
+        """
+        :return: initial guess corrected by the projection of its error onto the subspace
+        """
+        if self.count == 0:
+            return initial
+        w = self.basis[:self.count]
+        residual = rhs - matrix @ initial
+        return initial - w.T @ (w @ residual)
+
+    def add(self, solution, product):
+        """
+        :param solution: new solution vector
+        :param product: matrix @ solution
+        """
+        if self.count == self.size:
+            self.count = 0
+        v, av = np.array(solution, dtype=float), np.array(product, dtype=float)
+        norm = -v @ av
+        if norm <= 0:
+            return
+        w, aw = self.basis[:self.count], self.products[:self.count]
+        for _ in range(2):  # classical Gram-Schmidt twice is as stable as the modified one
+            coefficients = -aw @ v
+            v -= w.T @ coefficients
+            av -= aw.T @ coefficients
+        remaining = -v @ av
+        if remaining <= 1e-20 * norm:
+            return  # already in the subspace up to round-off
+        self.basis[self.count] = v / np.sqrt(remaining)
+        self.products[self.count] = av / np.sqrt(remaining)
+        self.count += 1
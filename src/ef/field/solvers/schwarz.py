@@ -0,0 +1,167 @@
+import multiprocessing
+import threading
+import weakref
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+
+def _share(array):
+    """ :return: shared memory block holding a copy of the array, and the spec to attach to it """
+    from multiprocessing.shared_memory import SharedMemory
+    block = SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _serve(specs, barrier, stop_event, subdomains):
+    """
+    Worker process: factorize the (start, stop, output offset) subdomains, then solve them each time
+    the main process passes the barrier with a new residual, until it sets the stop event.
+    """
+    from multiprocessing.shared_memory import SharedMemory
+    try:
+        memory = {key: SharedMemory(name) for key, (name, shape, dtype) in specs.items()}
+        shared = {key: np.ndarray(shape, dtype, memory[key].buf) for key, (name, shape, dtype) in specs.items()}
+        matrix = scipy.sparse.csr_matrix((shared['data'], shared['indices'], shared['indptr']),
+                                         shape=(len(shared['input']),) * 2)
+        solves = [(start, stop, offset, scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(
+            matrix[start:stop, start:stop])).solve) for start, stop, offset in subdomains]
+        barrier.wait()  # factorized
+        while True:
+            barrier.wait()  # residual is ready
+            if stop_event.is_set():
+                return
+            for start, stop, offset, solve in solves:
+                shared['output'][offset:offset + stop - start] = solve(shared['input'][start:stop])
+            barrier.wait()  # slab solutions are ready
+    except BaseException:
+        barrier.abort()  # the main process gets BrokenBarrierError instead of waiting forever
+        raise
+
+
+def _release(processes, barrier, stop_event, memory):
+    stop_event.set()
+    try:
+        barrier.wait(timeout=10)
+    except threading.BrokenBarrierError:
+        pass
+    for process in processes:
+        process.join(timeout=10)
+        if process.is_alive():
+            process.terminate()
+    for block in memory:
+        block.close()
+        block.unlink()
+
+
+class SchwarzSolver:
+    """
+    Overlapping additive Schwarz method for the FieldSolver equations.
+
+    The unknowns are split into slabs of whole z layers, extended by overlap layers on both sides.
+    Each slab is solved exactly with its own LU factorization and zero values outside it,
+    and the slab solutions are summed. With several workers the matrix, the residual and the slab
+    solutions are in shared memory. Every worker process factorizes its slabs once and keeps serving them,
+    each application only synchronizes the processes on a barrier.
+    """
+    overlap = 2  # z layers added on each side of a slab
+
+    def __init__(self, matrix, layer_starts, n_subdomains, workers=1):
+        """
+        :param matrix: sparse symmetric matrix over the unknowns ordered by z layer
+        :param layer_starts: index of the first unknown of each z layer, followed by the number of unknowns
+        :param n_subdomains: number of slabs, at most the number of z layers
+        :param workers: number of processes, 1 solves the slabs in this process
+        """
+        matrix = scipy.sparse.csr_matrix(matrix)
+        layer_starts = np.asarray(layer_starts)
+        n_layers = len(layer_starts) - 1
+        bounds = np.linspace(0, n_layers, min(max(n_subdomains, 1), n_layers) + 1).round().astype(int)
+        self.ranges = [(int(layer_starts[max(first - self.overlap, 0)]),
+                        int(layer_starts[min(last + self.overlap, n_layers)]))
+                       for first, last in zip(bounds[:-1], bounds[1:])]
+        self.shape = matrix.shape
+        coverage = np.zeros(self.shape[0], dtype=int)
+        for start, stop in self.ranges:
+            coverage[start:stop] += 1
+        # damping of the standalone iteration, the preconditioned matrix has eigenvalues up to the coverage
+        self.damping = 1 / coverage.max()
+        self.offsets = [int(o) for o in np.cumsum([0] + [stop - start for start, stop in self.ranges])]
+        self.workers = max(1, min(workers, len(self.ranges)))
+        self.history = []  # relative residual norms after each iteration of the last standalone solve
+        self._processes = None
+        if self.workers == 1:
+            self._solves = [scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(matrix[start:stop, start:stop])).solve
+                            for start, stop in self.ranges]
+            return
+        shared = {'input': np.zeros(self.shape[0]), 'output': np.zeros(self.offsets[-1]),
+                  'data': matrix.data, 'indices': matrix.indices, 'indptr': matrix.indptr}
+        memory, specs = [], {}
+        for key, array in shared.items():
+            block, specs[key] = _share(array)
+            memory.append(block)
+        self._input = np.ndarray(self.shape[0], buffer=memory[0].buf)
+        self._output = np.ndarray(self.offsets[-1], buffer=memory[1].buf)
+        self._barrier = multiprocessing.Barrier(self.workers + 1)
+        stop_event = multiprocessing.Event()
+        subdomains = [(start, stop, offset) for (start, stop), offset in zip(self.ranges, self.offsets)]
+        # daemon processes do not keep the interpreter from exiting if the solver is never closed
+        self._processes = [multiprocessing.Process(target=_serve, daemon=True,
+                                                   args=(specs, self._barrier, stop_event, subdomains[w::self.workers]))
+                           for w in range(self.workers)]
+        for process in self._processes:
+            process.start()
+        self._finalizer = weakref.finalize(self, _release, self._processes, self._barrier, stop_event, memory)
+        self._synchronize()  # wait for the factorizations
+
+    def close(self):
+        """ Stop the worker processes and free the shared memory. """
+        if self._processes is not None:
+            self._finalizer()
+
+    def _synchronize(self):
+        try:
+            self._barrier.wait()
+        except threading.BrokenBarrierError as err:
+            self.close()
+            raise RuntimeError("Schwarz solver worker process failed") from err
+
+    def apply(self, residual):
+        """
+        :return: sum of the slab solutions of the equations with the residual as the right-hand side
+        """
+        residual = np.asarray(residual, dtype=float).ravel()
+        if self._processes is None:
+            pieces = [solve(residual[start:stop]) for (start, stop), solve in zip(self.ranges, self._solves)]
+        else:
+            self._input[:] = residual
+            self._synchronize()  # start
+            self._synchronize()  # done
+            pieces = [self._output[o:o + stop - start] for (start, stop), o in zip(self.ranges, self.offsets)]
+        result = np.zeros(self.shape[0])
+        for (start, stop), piece in zip(self.ranges, pieces):
+            result[start:stop] += piece
+        return result
+
+    def as_preconditioner(self):
+        return scipy.sparse.linalg.LinearOperator(self.shape, self.apply, dtype=float)
+
+    def solve(self, matrix, rhs, initial, tolerance, max_iterations):
+        """
+        Damped additive Schwarz iteration without a Krylov method.
+
+        :return: solution, number of iterations and whether the relative residual norm reached the tolerance
+        """
+        self.history = []
+        norm = np.linalg.norm(rhs)
+        if norm == 0:
+            return np.zeros_like(rhs), 0, True
+        solution = np.array(initial, dtype=float)
+        residual = rhs - matrix @ solution
+        while len(self.history) < max_iterations and np.linalg.norm(residual) > tolerance * norm:
+            solution += self.damping * self.apply(residual)
+            residual = rhs - matrix @ solution
+            self.history.append(np.linalg.norm(residual) / norm)
+        return solution, len(self.history), np.linalg.norm(residual) <= tolerance * norm
@@ -0,0 +1,59 @@
+import numpy as np
+import scipy.sparse.linalg
+
+
+class StencilOperator(scipy.sparse.linalg.LinearOperator):
+    """
+    Matrix-free FieldSolver equation matrix: the 7-point Laplacian over the free interior nodes,
+    scaled like FieldSolver.construct_laplacian_matrix, applied with array slices.
+    Its memory use is a few arrays of the mesh size instead of a sparse matrix with 7 entries per node.
+    """
+
+    def __init__(self, n_interior, cell, free=None):
+        """
+        :param n_interior: numbers of interior nodes along each axis, (n_nodes - 2)
+        :param cell: mesh cell size
+        :param free: optional boolean vector of the unknowns in Fortran order, False for eliminated region nodes
+        """
+        self.grid_shape = tuple(int(n) for n in n_interior)
+        cx, cy, cz = np.asarray(cell, dtype=float) ** 2
+        self.weights = cy * cz, cx * cz, cx * cy
+        n = int(np.prod(self.grid_shape))
+        self.free = None if free is None or np.all(free) else np.asarray(free, dtype=bool)
+        size = n if self.free is None else np.count_nonzero(self.free)
+        super().__init__(float, (size, size))
+        self._padded = np.zeros([n + 2 for n in self.grid_shape], order='F')
+        self._full = np.zeros(n)
+
+    def _matvec(self, x):
+        x = np.asarray(x, dtype=float).ravel()
+        if self.free is None:
+            return self.apply_to_full(x)
+        self._full[self.free] = x
+        return self.apply_to_full(self._full)[self.free]
+
+    def _rmatvec(self, x):
+        return self._matvec(x)  # symmetric
+
+    def apply_to_full(self, vector):
+        """
+        :param vector: values at all interior nodes in Fortran order, zero boundary values are assumed
+        :return: Laplacian stencil applied at all interior nodes, in the same layout
+        """
+        p = self._padded
+        inner = p[1:-1, 1:-1, 1:-1]
+        inner[...] = vector.reshape(self.grid_shape, order='F')
+        wx, wy, wz = self.weights
+        result = -2 * (wx + wy + wz) * inner
+        result += wx * (p[:-2, 1:-1, 1:-1] + p[2:, 1:-1, 1:-1])
+        result += wy * (p[1:-1, :-2, 1:-1] + p[1:-1, 2:, 1:-1])
+        result += wz * (p[1:-1, 1:-1, :-2] + p[1:-1, 1:-1, 2:])
+        return result.ravel('F')
+
+    def diagonal(self):
+        return np.full(self.shape[0], -2 * sum(self.weights))
+
+    @staticmethod
+    def assembly_memory(n):
+        """ Rough peak memory in bytes of assembling the sparse matrix for n unknowns, intermediates included. """
+        return 3 * 7 * 12 * n
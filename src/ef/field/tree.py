@@ -0,0 +1,165 @@
+import numpy as np
+
+from ef.field.direct_sum import coulomb_field_at_points
+from ef.particle_sorter import morton_keys
+
+_bytes_per_pair = 12 * 8  # temporary arrays of a direct (point, particle) interaction
+
+
+class Octree:
+    """
+    Barnes-Hut octree over point charges.
+
+    Every node keeps the total charge, the center of absolute charge, the dipole moment
+    and the bounding box of the charges inside it.
+    Nodes are subdivided until they hold at most leaf_size particles, down to the resolution of the Morton keys.
+    Fields are evaluated for many points at once, by walking the tree level by level with arrays of
+    (point group, node) pairs: nodes far from the whole group are approximated by their monopole and dipole fields,
+    near leaves are summed directly.
+    """
+    max_depth = 21  # Morton keys hold 21 bits per axis
+    leaf_size = 8
+    points_per_group = 8
+    points_per_batch = 1 << 12
+    memory_limit = 1 << 26  # approximate limit on temporary memory of the direct leaf interactions, bytes
+
+    def __init__(self, positions, charges):
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        charges = np.broadcast_to(np.asarray(charges, dtype=float), len(positions))
+        if len(positions) == 0:
+            raise ValueError("Cannot build an octree without particles")
+        self.origin = positions.min(axis=0)
+        self.size = (positions.max(axis=0) - self.origin).max() or 1.
+        cells = np.floor((positions - self.origin) / self.size * 2 ** self.max_depth).astype(int)
+        keys = morton_keys(np.clip(cells, 0, 2 ** self.max_depth - 1))
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        self.positions = positions[order]
+        self.charges = charges[order]
+        abs_charges = np.abs(self.charges)
+        self.levels = []
+        for level in range(self.max_depth + 1):
+            node_keys = keys >> 3 * (self.max_depth - level)
+            start = np.flatnonzero(np.concatenate(([True], node_keys[1:] != node_keys[:-1])))
+            end = np.append(start[1:], len(keys))
+            count = end - start
+            charge = np.add.reduceat(self.charges, start)
+            weight = np.add.reduceat(abs_charges, start)
+            weighted_positions = np.add.reduceat(abs_charges[:, np.newaxis] * self.positions, start)
+            mean_positions = np.add.reduceat(self.positions, start) / count[:, np.newaxis]
+            neutral = weight == 0
+            center = np.where(neutral[:, np.newaxis], mean_positions,
+                              weighted_positions / np.where(neutral, 1, weight)[:, np.newaxis])
+            offsets = self.positions - np.repeat(center, count, axis=0)
+            dipole = np.add.reduceat(self.charges[:, np.newaxis] * offsets, start)
+            low = np.minimum.reduceat(self.positions, start)
+            high = np.maximum.reduceat(self.positions, start)
+            self.levels.append(dict(start=start, end=end, count=count, charge=charge, center=center,
+                                    dipole=dipole, low=low, high=high, size=self.size / 2 ** level))
+            if count.max() <= self.leaf_size:
+                break
+        for parent, children in zip(self.levels, self.levels[1:]):
+            parent['first_child'] = np.searchsorted(children['start'], parent['start'])
+            parent['last_child'] = np.searchsorted(children['start'], parent['end'])
+
+    def field_at_points(self, points, opening_angle=0.7):
+        """
+        :param points: array of shape (np, 3)
+        :param opening_angle: nodes smaller than this fraction of the distance between the bounding box
+            of their charges and the bounding box of a point group are not opened, at most 1
+        :return: array of shape (np, 3), electric field of the tree charges, excluding coincident charges
+        """
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        result = np.empty_like(points)
+        # walk the tree with groups of nearby points, so that opening decisions are made once per group
+        cells = np.floor((points - self.origin) / self.size * 2 ** self.max_depth).astype(int)
+        order = np.argsort(morton_keys(np.clip(cells, 0, 2 ** self.max_depth - 1)), kind='stable')
+        points = points[order]
+        for start in range(0, len(points), self.points_per_batch):
+            batch = slice(start, start + self.points_per_batch)
+            result[order[batch]] = self._field_at_batch(points[batch], opening_angle)
+        return result
+
+    def _field_at_batch(self, points, opening_angle):
+        field = np.zeros_like(points)
+        group_start = np.arange(0, len(points), self.points_per_group)
+        group_count = np.diff(np.append(group_start, len(points)))
+        low = np.minimum.reduceat(points, group_start)
+        high = np.maximum.reduceat(points, group_start)
+        group_index = np.arange(len(group_start))
+        node_index = np.zeros(len(group_start), dtype=int)
+        for level_number, level in enumerate(self.levels):
+            # distance between the bounding boxes of the node charges and of the group points,
+            # zero for overlapping boxes, so nodes containing or touching the group are always opened
+            gap = np.maximum(0, np.maximum(low[group_index] - level['high'][node_index],
+                                           level['low'][node_index] - high[group_index]))
+            far = level['size'] < opening_angle * np.linalg.norm(gap, axis=-1)
+            node, point_index = self._expand(node_index[far], group_start[group_index[far]],
+                                             group_count[group_index[far]])
+            r = points[point_index] - level['center'][node]
+            self._add_multipole_field(field, point_index, r, level['charge'][node], level['dipole'][node])
+            group_index, node_index = group_index[~far], node_index[~far]
+            leaf = level['count'][node_index] <= self.leaf_size
+            if level_number == len(self.levels) - 1:
+                leaf[:] = True  # particles closer than the key resolution
+            node, point_index = self._expand(node_index[leaf], group_start[group_index[leaf]],
+                                             group_count[group_index[leaf]])
+            self._add_direct_field(field, points, point_index, level['start'][node], level['count'][node])
+            group_index, node_index = group_index[~leaf], node_index[~leaf]
+            if len(group_index) == 0:
+                break
+            first, last = level['first_child'][node_index], level['last_child'][node_index]
+            group_index, node_index = self._expand(group_index, first, last - first)
+        return field
+
+    @staticmethod
+    def _expand(index, first, count):
+        """ Pair every index with each of count consecutive indexes starting at first. """
+        offsets = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        return np.repeat(index, count), np.repeat(first, count) + offsets
+
+    @staticmethod
+    def _accumulate(field, point_index, values):
+        for k in range(3):
+            field[:, k] += np.bincount(point_index, values[:, k], minlength=len(field))
+
+    def _add_multipole_field(self, field, point_index, r, charge, dipole):
+        dist2 = np.einsum('ij,ij->i', r, r)
+        inv_dist3 = dist2 ** -1.5
+        p_dot_r = np.einsum('ij,ij->i', dipole, r)
+        e = r * ((charge + 3 * p_dot_r / dist2) * inv_dist3)[:, np.newaxis] - dipole * inv_dist3[:, np.newaxis]
+        self._accumulate(field, point_index, e)
+
+    def _add_direct_field(self, field, points, point_index, start, count):
+        """
+        Sum the fields of the leaf particles directly, in chunks of (point, leaf) pairs within the memory limit.
+        Deepest leaves with more than leaf_size particles go through coulomb_field_at_points.
+        """
+        large = count > self.leaf_size
+        for leaf_start in np.unique(start[large]):
+            leaf = slice(leaf_start, leaf_start + count[start == leaf_start][0])
+            leaf_points = point_index[start == leaf_start]
+            for q in np.unique(self.charges[leaf]):
+                field[leaf_points] += coulomb_field_at_points(self.positions[leaf][self.charges[leaf] == q], q,
+                                                              points[leaf_points], self.memory_limit)
+        point_index, start, count = point_index[~large], start[~large], count[~large]
+        step = max(1, self.memory_limit // (_bytes_per_pair * self.leaf_size))
+        for chunk in range(0, len(point_index), step):
+            pairs = slice(chunk, chunk + step)
+            pair_point, particle = self._expand(point_index[pairs], start[pairs], count[pairs])
+            r = points[pair_point] - self.positions[particle]
+            dist2 = np.einsum('ij,ij->i', r, r)
+            inv_dist3 = np.zeros_like(dist2)
+            np.power(dist2, -1.5, out=inv_dist3, where=dist2 > 0)
+            self._accumulate(field, pair_point, r * (self.charges[particle] * inv_dist3)[:, np.newaxis])
+
+    def relative_error(self, points, opening_angle=0.7):
+        """
+        Compare tree fields at given points with the direct sum.
+
+        :return: root mean square of field errors relative to root mean square of the exact field
+        """
+        exact = sum(coulomb_field_at_points(self.positions[self.charges == q], q, points)
+                    for q in np.unique(self.charges))
+        error = self.field_at_points(points, opening_angle) - exact
+        return np.sqrt(np.mean(error ** 2) / np.mean(exact ** 2))
@@ -1,25 +1,57 @@
+import math
+
 import numpy as np
+from simpleeval import SimpleEval
 
 from ef.util.serializable_h5 import SerializableH5
 
 
 class InnerRegion(SerializableH5):
 
-    def __init__(self, name, shape, potential=0.0, total_absorbed_particles=0, total_absorbed_charge=0.0, inverted=False):
+    def __init__(self, name, shape, potential=0.0, total_absorbed_particles=0, total_absorbed_charge=0.0,
+                 inverted=False, potential_expression='', potential_table=()):
+        """
+        :param potential: constant potential, or the current one if it depends on time
+        :param potential_expression: optional expression of time `t` for the potential
+        :param potential_table: optional (time, potential) pairs, interpolated linearly
+        """
         self.name = name
         self.shape = shape
         self.potential = potential
         self.total_absorbed_particles = total_absorbed_particles
         self.total_absorbed_charge = total_absorbed_charge
         self.inverted = inverted
+        self.potential_expression = potential_expression
+        self.potential_table = np.asarray(potential_table, dtype=float).reshape(-1, 2)
+        if self.potential_expression and len(self.potential_table):
+            raise ValueError("Inner region potential is either an expression or a table, not both")
+        self._ev = SimpleEval(functions={"sin": math.sin, "cos": math.cos, "exp": math.exp, "sqrt": math.sqrt},
+                              names={"pi": math.pi})
+
+    @property
+    def is_time_dependent(self):
+        return bool(self.potential_expression) or len(self.potential_table) > 0
+
+    def potential_at(self, time):
+        if self.potential_expression:
+            self._ev.names["t"] = time
+            return float(self._ev.eval(self.potential_expression))
+        elif len(self.potential_table):
+            return float(np.interp(time, self.potential_table[:, 0], self.potential_table[:, 1]))
+        return self.potential
+
+    def update_potential(self, time):
+        self.potential = self.potential_at(time)
 
     def collide_with_particles(self, particles):
         collisions = self.check_if_points_inside(particles.positions)
-        c = np.count_nonzero(collisions)
-        self.total_absorbed_particles += c
-        self.total_absorbed_charge += c * particles.charge
+        self.absorb(np.count_nonzero(collisions), particles.charge)
         particles.remove(collisions)
 
+    def absorb(self, number_of_particles, particle_charge):
+        self.total_absorbed_particles += number_of_particles
+        self.total_absorbed_charge += number_of_particles * particle_charge
+
     def check_if_points_inside(self, positions):
         pos_inside = self.shape.are_positions_inside(positions)
         if self.inverted:
@@ -18,10 +18,13 @@ def main():
     config_or_h5_file = args.config_or_h5_file
     continue_from_h5 = False
     dom, continue_from_h5 = construct_domain(config_or_h5_file)
-    if continue_from_h5:
-        dom.continue_pic_simulation()
-    else:
-        dom.start_pic_simulation()
+    try:
+        if continue_from_h5:
+            dom.continue_pic_simulation()
+        else:
+            dom.start_pic_simulation()
+    finally:
+        dom.close()
     return 0
 
 
@@ -1,5 +1,6 @@
 import numpy as np
 
+from ef.field.direct_sum import coulomb_field_at_points
 from ef.util.physical_constants import speed_of_light
 from ef.util.serializable_h5 import SerializableH5
 
@@ -20,7 +21,59 @@ def boris_update_momentums(charge, mass, momentum_arr, dt, el_field_arr, mgn_fie
     return (u_quote + half_el_force) * mass  # (n, 3) finally add the other half-velocity
 
 
+def _add_cross_product(a, b, out, work):
+    """
+    out += a x b for arrays of 3-vectors, without temporary (n, 3) arrays.
+
+    :param work: scratch array of shape (2, n)
+    """
+    for i, j, k in ((0, 1, 2), (1, 2, 0), (2, 0, 1)):
+        np.multiply(a[:, j], b[:, k], out=work[0])
+        np.multiply(a[:, k], b[:, j], out=work[1])
+        np.subtract(work[0], work[1], out=work[0])
+        np.add(out[:, i], work[0], out=out[:, i])
+
+
+def boris_update_momentums_in_place(charge, mass, momentums, dt, el_field, mgn_field, work, columns_work):
+    """
+    Same as boris_update_momentums, but updates momentums in place using preallocated scratch arrays.
+
+    :param momentums: float array of shape (n, 3), updated in place
+    :param el_field: array broadcastable to (n, 3)
+    :param mgn_field: array broadcastable to (n, 3)
+    :param work: float scratch array of shape (4, n, 3)
+    :param columns_work: float scratch array of shape (3, n)
+    """
+    half_el_force, u, s, tmp = work
+    q_quote = dt * charge / mass / 2.0
+    np.multiply(el_field, q_quote, out=half_el_force)  # (n, 3) half the dv caused by electric field
+    np.divide(momentums, mass, out=u)
+    np.add(u, half_el_force, out=u)  # (n, 3) v_minus
+    np.multiply(mgn_field, q_quote / speed_of_light, out=s)  # (n, 3) rotation vector t = qB/m * dt/2
+    h_squared, columns_work = columns_work[0], columns_work[1:]
+    np.multiply(s[:, 0], s[:, 0], out=h_squared)
+    for i in (1, 2):
+        np.multiply(s[:, i], s[:, i], out=columns_work[0])
+        np.add(h_squared, columns_work[0], out=h_squared)
+    np.add(h_squared, 1.0, out=h_squared)
+    np.divide(2.0, h_squared, out=h_squared)
+    np.copyto(tmp, u)
+    _add_cross_product(u, s, tmp, columns_work)  # (n, 3) v_prime is v_minus rotated by t
+    np.multiply(s, h_squared[:, np.newaxis], out=s)  # (n, 3) rotation vector s = 2t / (1 + t**2)
+    _add_cross_product(tmp, s, u, columns_work)  # (n, 3) v_plus = v_minus + v_prime * s
+    np.add(u, half_el_force, out=momentums)
+    np.multiply(momentums, mass, out=momentums)
+
+
 class ParticleArray(SerializableH5):
+    """
+    Particles of a single species (charge and mass) stored as a structure of arrays.
+
+    Columns ids, positions and momentums are views into the leading rows of larger buffers,
+    so that appending particles is amortized O(1) and removing particles compacts them in place.
+    """
+    _columns = ('ids', 'positions', 'momentums')
+
     def __init__(self, ids, charge, mass, positions, momentums, momentum_is_half_time_step_shifted=False):
         self.ids = np.array(ids)
         self.charge = charge
@@ -28,26 +81,122 @@ class ParticleArray(SerializableH5):
         self.positions = np.array(positions)
         self.momentums = np.array(momentums)
         self.momentum_is_half_time_step_shifted = momentum_is_half_time_step_shifted
+        self._stencil = None
+        self._buffers = {'ids': self.ids, 'positions': self.positions, 'momentums': self.momentums}
+        self._work = np.empty((4, 0, 3))
+        self._columns_work = np.empty((3, 0))
+
+    def __len__(self):
+        return self.ids.size
+
+    def is_same_species(self, other):
+        return self.charge == other.charge and self.mass == other.mass and \
+               self.momentum_is_half_time_step_shifted == other.momentum_is_half_time_step_shifted
+
+    def append(self, particles):
+        """
+        Add particles of the same species to the end of this array, growing buffers by doubling when needed.
+
+        :param particles: ParticleArray with the same charge, mass and momentum time shift
+        """
+        if not self.is_same_species(particles):
+            raise ValueError("Cannot append particles of a different species")
+        n, m = len(self), len(particles)
+        if m == 0:
+            return
+        for name in self._columns:
+            column, new = getattr(self, name), getattr(particles, name)
+            buffer = self._buffers[name]
+            shape = buffer.shape[1:] if name == 'ids' else (3,)
+            fits = (column is buffer or column.base is buffer) and buffer.ndim == len(shape) + 1 and \
+                len(buffer) >= n + m and np.can_cast(new.dtype, buffer.dtype, 'same_kind')
+            if not fits:
+                buffer = np.empty((max(n + m, 2 * n), *shape), dtype=np.result_type(column, new))
+                buffer[:n] = column.reshape(n, *shape)
+                self._buffers[name] = buffer
+            buffer[n:n + m] = new.reshape(m, *shape)
+            setattr(self, name, buffer[:n + m])
+        self._stencil = None
+
+    def mesh_stencil(self, grid):
+        """
+        Cell indices and interpolation weights of particles on a mesh grid.
+        Cached until particles are moved, so that charge deposition and every field interpolation
+        on the same grid during a time step share a single computation.
+
+        :param grid: MeshGrid
+        :return: MeshStencil of particle positions
+        """
+        if self._stencil is None or not (self._stencil.grid is grid or self._stencil.grid == grid):
+            self._stencil = grid.stencil(self.positions)
+        return self._stencil
 
     def keep(self, mask):
-        self.ids = self.ids[mask]
-        self.positions = self.positions[mask]
-        self.momentums = self.momentums[mask]
+        for name in self._columns:
+            kept = getattr(self, name)[mask]
+            buffer = self._buffers[name]
+            if buffer.shape[1:] == kept.shape[1:] and len(buffer) >= len(kept) and buffer.dtype == kept.dtype:
+                # compact into the leading rows of the existing buffer instead of allocating a new one
+                buffer[:len(kept)] = kept
+                kept = buffer[:len(kept)]
+            else:
+                self._buffers[name] = kept
+            setattr(self, name, kept)
+        if self._stencil is not None:
+            self._stencil.keep(mask)
+
+    def reorder(self, index):
+        """
+        Permute particles, keeping the cached mesh stencil in sync.
+
+        :param index: array of shape (np), a permutation of particle indexes
+        """
+        self.keep(index)
 
     def remove(self, mask):
         self.keep(np.logical_not(mask))
 
+    def _workspace(self):
+        """
+        Scratch arrays for in-place particle pushing, kept between steps and grown by doubling.
+
+        :return: arrays of shape (4, n, 3) and (3, n)
+        """
+        n = len(self)
+        if self._work.shape[1] < n:
+            capacity = max(n, 2 * self._work.shape[1])
+            self._work = np.empty((4, capacity, 3))
+            self._columns_work = np.empty((3, capacity))
+        return self._work[:, :n], self._columns_work[:, :n]
+
+    def _float_column(self, name):
+        """ Make sure a column can be updated in place with float values, return it as an (n, 3) view. """
+        column = getattr(self, name)
+        if column.dtype != np.float64:
+            column = column.astype(np.float64)
+            setattr(self, name, column)
+            self._buffers[name] = column
+        return column.reshape(-1, 3)
+
     def update_positions(self, dt):
-        self.positions += dt / self.mass * self.momentums
+        positions, momentums = self._float_column('positions'), self.momentums.reshape(-1, 3)
+        shift = self._workspace()[0][0]
+        np.multiply(momentums, dt / self.mass, out=shift)
+        np.add(positions, shift, out=positions)
+        self._stencil = None
 
-    def field_at_points(self, points):
-        diff = np.asarray(points) - self.positions[:, np.newaxis, :]
-        dist = np.linalg.norm(diff, axis=-1)
-        return self.charge * np.sum(diff / (dist ** 3)[..., np.newaxis], axis=0)
+    def field_at_points(self, points, memory_limit=1 << 26, n_threads=1):
+        return coulomb_field_at_points(self.positions, self.charge, points, memory_limit, n_threads)
 
     def boris_update_momentums(self, dt, total_el_field, total_mgn_field):
-        self.momentums = boris_update_momentums(self.charge, self.mass, self.momentums, dt, total_el_field,
-                                                total_mgn_field)
+        momentums = self._float_column('momentums')
+        work, columns_work = self._workspace()
+        boris_update_momentums_in_place(self.charge, self.mass, momentums, dt,
+                                        np.reshape(total_el_field, (-1, 3)), np.reshape(total_mgn_field, (-1, 3)),
+                                        work, columns_work)
 
     def boris_update_momentum_no_mgn(self, dt, total_el_field):
-        self.momentums += self.charge * dt * np.asarray(total_el_field)
+        momentums = self._float_column('momentums')
+        dp = self._workspace()[0][0]
+        np.multiply(np.reshape(total_el_field, (-1, 3)), self.charge * dt, out=dp)
+        np.add(momentums, dp, out=momentums)
@@ -7,6 +7,8 @@ class Model(Enum):
     noninteracting = auto()
     binary = auto()
     PIC = auto()
+    tree = auto()
+    p3m = auto()
 
     def __repr__(self):
         return f"Model.{self.name}"
@@ -25,8 +27,33 @@ class ParticleInteractionModel(SerializableH5):
     def pic(self):
         return self.particle_interaction_model == Model.PIC
 
-    def __init__(self, particle_interaction_model=Model.PIC):
+    @property
+    def tree(self):
+        return self.particle_interaction_model == Model.tree
+
+    @property
+    def p3m(self):
+        return self.particle_interaction_model == Model.p3m
+
+    @property
+    def uses_mesh_charge(self):
+        return self.pic or self.p3m
+
+    def __init__(self, particle_interaction_model=Model.PIC, binary_tile_memory=1 << 26, binary_threads=1,
+                 tree_opening_angle=0.7, p3m_cutoff=2.5):
         if isinstance(particle_interaction_model, Model):
             self.particle_interaction_model = particle_interaction_model
         else:
             self.particle_interaction_model = Model[particle_interaction_model]
+        if binary_tile_memory <= 0:
+            raise ValueError("Expect binary_tile_memory > 0")
+        if binary_threads < 1:
+            raise ValueError("Expect binary_threads >= 1")
+        if not 0 < tree_opening_angle <= 1:
+            raise ValueError("Expect 0 < tree_opening_angle <= 1")
+        if p3m_cutoff <= 0:
+            raise ValueError("Expect p3m_cutoff > 0")
+        self.binary_tile_memory = binary_tile_memory  # bytes of temporary arrays per thread for pairwise fields
+        self.binary_threads = binary_threads
+        self.tree_opening_angle = tree_opening_angle  # smaller angles open more nodes: slower, more accurate
+        self.p3m_cutoff = p3m_cutoff  # short-range correction radius, in mesh cells
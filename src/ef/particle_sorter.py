@@ -0,0 +1,51 @@
+import numpy as np
+
+from ef.util.serializable_h5 import SerializableH5
+
+
+def morton_keys(nodes):
+    """
+    Interleave bits of cell indices into Z-order (Morton) keys.
+
+    :param nodes: non-negative integer array of shape (np, 3), each index below 2**21
+    :return: array of shape (np) of int64 keys
+    """
+    keys = np.zeros(len(nodes), dtype=np.int64)
+    for axis in range(3):
+        n = nodes[:, axis].astype(np.int64)
+        n = (n | (n << 32)) & 0x1f00000000ffff
+        n = (n | (n << 16)) & 0x1f0000ff0000ff
+        n = (n | (n << 8)) & 0x100f00f00f00f00f
+        n = (n | (n << 4)) & 0x10c30c30c30c30c3
+        n = (n | (n << 2)) & 0x1249249249249249
+        keys |= n << (2 - axis)
+    return keys
+
+
+class ParticleSorter(SerializableH5):
+    """
+    Periodically reorders particles by the mesh cell they are in,
+    so that deposition and interpolation access mesh nodes in a cache-friendly order.
+    """
+    orders = ('morton', 'linear')
+
+    def __init__(self, sort_every=0, order='morton'):
+        if sort_every < 0:
+            raise ValueError("Expect sort_every >= 0")
+        if order not in self.orders:
+            raise ValueError("Unexpected particle sort order: {}".format(order))
+        self.sort_every = sort_every
+        self.order = order
+
+    def is_due(self, step):
+        return self.sort_every > 0 and step % self.sort_every == 0
+
+    def cell_keys(self, particles, grid):
+        nodes = np.clip(particles.mesh_stencil(grid).nodes, 0, np.asarray(grid.n_nodes) - 1)
+        if self.order == 'morton':
+            return morton_keys(nodes)
+        else:
+            return np.ravel_multi_index(nodes.T, grid.n_nodes)
+
+    def sort(self, particles, grid):
+        particles.reorder(np.argsort(self.cell_keys(particles, grid), kind='stable'))
@@ -1,20 +1,31 @@
+import logging
+
 import h5py
 import numpy as np
 
 from ef.field.solvers.field_solver import FieldSolver
+from ef.field.solvers.field_solver_options import FieldSolverOptions
+from ef.field.p3m import MeshPairField, ShortRangeCorrection
+from ef.field.tree import Octree
+from ef.particle_sorter import ParticleSorter
 from ef.util.serializable_h5 import SerializableH5
+from ef.util.step_timer import StepTimer
 
 
 class Simulation(SerializableH5):
+    tree_accuracy_sample_size = 100  # points compared with the direct sum when debug logging is on
 
     def __init__(self, time_grid, spat_mesh, inner_regions,
                  particle_sources,
                  electric_fields, magnetic_fields, particle_interaction_model,
-                 output_filename_prefix, outut_filename_suffix, max_id=-1, particle_arrays=()):
+                 output_filename_prefix, outut_filename_suffix, max_id=-1, particle_arrays=(),
+                 particle_sorter=None, field_solver_options=None):
         self.time_grid = time_grid
         self.spat_mesh = spat_mesh
         self.inner_regions = inner_regions
-        self._field_solver = FieldSolver(spat_mesh, inner_regions)
+        self.field_solver_options = FieldSolverOptions() if field_solver_options is None else field_solver_options
+        self._field_solver = FieldSolver(spat_mesh, inner_regions, self.field_solver_options,
+                                         time_grid.total_nodes - time_grid.current_node)
         self.particle_sources = particle_sources
         self.electric_fields = electric_fields
         self.magnetic_fields = magnetic_fields
@@ -23,13 +34,16 @@ class Simulation(SerializableH5):
         self._output_filename_suffix = outut_filename_suffix
         self.max_id = max_id
         self.particle_arrays = list(particle_arrays)
+        self.particle_sorter = ParticleSorter() if particle_sorter is None else particle_sorter
+        self._step_timer = StepTimer()
+        self._octree = None  # tree of all particles shared by the field evaluations of one push
+        self._short_range = None  # P3M correction from all particles, shared in the same way
+        self._mesh_pair_field = None  # P3M table of the mesh field between two particles, built on first use
 
     @classmethod
     def init_from_h5(cls, h5file, filename_prefix, filename_suffix):
-        domain = cls.load_h5(h5file)
-        domain._output_filename_prefix = filename_prefix
-        domain._output_filename_suffix = filename_suffix
-        return domain
+        return cls.load_h5_args(h5file, output_filename_prefix=filename_prefix,
+                                outut_filename_suffix=filename_suffix)
 
     def start_pic_simulation(self):
         self.eval_and_write_fields_without_particles()
@@ -37,11 +51,15 @@ class Simulation(SerializableH5):
             particles = src.generate_initial_particles()
             if len(particles.ids):
                 particles.ids = self.generate_particle_ids(len(particles.ids))
-                self.particle_arrays.append(particles)
+                self.add_particles(particles)
         self.prepare_recently_generated_particles_for_boris_integration()
         self.write_step_to_save()
         self.run_pic()
 
+    def close(self):
+        """ Release the field solver worker processes. """
+        self._field_solver.close()
+
     def continue_pic_simulation(self):
         self.run_pic()
 
@@ -55,23 +73,57 @@ class Simulation(SerializableH5):
             self.write_step_to_save()
 
     def prepare_recently_generated_particles_for_boris_integration(self):
-        if self.particle_interaction_model.pic:
+        if self.particle_interaction_model.uses_mesh_charge:
             self.eval_charge_density()
             self.eval_potential_and_fields()
         self.shift_new_particles_velocities_half_time_step_back()
 
     def advance_one_time_step(self):
-        self.push_particles()
-        self.apply_domain_constrains()
-        if self.particle_interaction_model.pic:
-            self.eval_charge_density()
-            self.eval_potential_and_fields()
+        timer = self._step_timer = StepTimer()
+        with timer.stage("push"):
+            self.push_particles()
+        with timer.stage("constraints"):
+            self.apply_domain_constrains()
+        if self.particle_sorter.is_due(self.time_grid.current_node):
+            with timer.stage("sort"):
+                self.sort_particles()
+        if self.particle_interaction_model.uses_mesh_charge:
+            with timer.stage("deposit"):
+                self.eval_charge_density()
+        if self.particle_interaction_model.uses_mesh_charge or self.has_time_dependent_regions:
+            with timer.stage("field solve"):
+                # particles have been pushed to the next time node, fields are needed there
+                self.update_inner_region_potentials(self.time_grid.current_time + self.time_grid.time_step_size)
+                self.eval_potential_and_fields()
         self.update_time_grid()
+        logging.info(f"Time step {self.time_grid.current_node} took {timer.total:.3g} s: {timer}")
+        if "field solve" in timer.stages and self.field_solve_report is not None:
+            report = self.field_solve_report
+            logging.info(f"Field solve ({report.solver}): {report.iterations} iterations, "
+                         f"residual {report.residual:.3g}, {report.wall_time:.3g} s")
+
+    def sort_particles(self):
+        for particles in self.particle_arrays:
+            self.particle_sorter.sort(particles, self.spat_mesh.mesh)
 
     def eval_charge_density(self):
         self.spat_mesh.clear_old_density_values()
         self.spat_mesh.weight_particles_charge_to_mesh(self.particle_arrays)
 
+    @property
+    def field_solve_report(self):
+        """ SolveReport of the latest Poisson solve, or None before the first one. """
+        return self._field_solver.last_report
+
+    @property
+    def has_time_dependent_regions(self):
+        return any(region.is_time_dependent for region in self.inner_regions)
+
+    def update_inner_region_potentials(self, time):
+        for region in self.inner_regions:
+            if region.is_time_dependent:
+                region.update_potential(time)
+
     def eval_potential_and_fields(self):
         self._field_solver.eval_potential(self.spat_mesh, self.inner_regions)
         self._field_solver.eval_fields_from_potential(self.spat_mesh)
@@ -83,51 +135,97 @@ class Simulation(SerializableH5):
         # First generate then remove.
         # This allows for overlap of source and inner region.
         self.generate_new_particles()
-        self.apply_domain_boundary_conditions()
-        self.remove_particles_inside_inner_regions()
+        self.remove_particles_outside_domain_or_inside_regions()
 
     def boris_integration(self, dt):
+        self._octree = self.make_octree() if self.particle_interaction_model.tree else None
+        self._short_range = self.make_short_range_correction() if self.particle_interaction_model.p3m else None
         for particles in self.particle_arrays:
             total_el_field, total_mgn_field = \
-                self.compute_total_fields_at_positions(particles.positions)
+                self.compute_total_fields_at_particles(particles)
             if total_mgn_field is not None and total_mgn_field.any():
                 particles.boris_update_momentums(dt, total_el_field, total_mgn_field)
             else:
                 particles.boris_update_momentum_no_mgn(dt, total_el_field)
             particles.update_positions(dt)
+        self._octree = None
+        self._short_range = None
 
     def prepare_boris_integration(self, minus_half_dt):
-        # todo: place newly generated particle_arrays into separate buffer
+        self._octree = self.make_octree() if self.particle_interaction_model.tree else None
+        self._short_range = self.make_short_range_correction() if self.particle_interaction_model.p3m else None
         for particles in self.particle_arrays:
             if not particles.momentum_is_half_time_step_shifted:
                 total_el_field, total_mgn_field = \
-                    self.compute_total_fields_at_positions(particles.positions)
+                    self.compute_total_fields_at_particles(particles)
                 if total_mgn_field is not None and total_mgn_field.any():
                     particles.boris_update_momentums(minus_half_dt, total_el_field, total_mgn_field)
                 else:
                     particles.boris_update_momentum_no_mgn(minus_half_dt, total_el_field)
                 particles.momentum_is_half_time_step_shifted = True
+        self._octree = None
+        self._short_range = None
+        self.merge_particle_arrays()
 
-    def compute_total_fields_at_positions(self, positions):
+    def compute_total_fields_at_particles(self, particles):
+        positions = particles.positions
+        time = self.time_grid.current_time
         total_el_field = np.zeros_like(positions)  # make sure shape is set, as += operators can't broadcast left side
-        total_el_field += sum(f.get_at_points(positions, self.time_grid.current_time) for f in self.electric_fields)
+        total_el_field += sum(f.get_at_particles(particles, time) for f in self.electric_fields)
         if self.particle_interaction_model.noninteracting:
             if self.inner_regions or not self.spat_mesh.is_potential_equal_on_boundaries():
-                total_el_field += self.spat_mesh.field_at_position(positions)
+                total_el_field += self.spat_mesh.field_at_particles(particles)
         elif self.particle_interaction_model.binary:
             total_el_field += self.binary_electric_field_at_positions(positions)
             if self.inner_regions or not self.spat_mesh.is_potential_equal_on_boundaries():
-                total_el_field += self.spat_mesh.field_at_position(positions)
+                total_el_field += self.spat_mesh.field_at_particles(particles)
+        elif self.particle_interaction_model.tree:
+            total_el_field += self.tree_electric_field_at_positions(positions)
+            if self.inner_regions or not self.spat_mesh.is_potential_equal_on_boundaries():
+                total_el_field += self.spat_mesh.field_at_particles(particles)
         elif self.particle_interaction_model.pic:
-            total_el_field += self.spat_mesh.field_at_position(positions)
+            total_el_field += self.spat_mesh.field_at_particles(particles)
+        elif self.particle_interaction_model.p3m:
+            total_el_field += self.spat_mesh.field_at_particles(particles)
+            total_el_field += self.short_range_electric_field_at_positions(positions)
         mgn_field = None
         if self.magnetic_fields:
-            mgn_field = sum(f.get_at_points(positions, self.time_grid.current_time) for f in self.magnetic_fields)
+            mgn_field = sum(f.get_at_particles(particles, time) for f in self.magnetic_fields)
         return total_el_field, mgn_field
 
     def binary_electric_field_at_positions(self, positions):
-        return sum(
-            np.nan_to_num(p.field_at_points(positions)) for p in self.particle_arrays)
+        model = self.particle_interaction_model
+        return sum(p.field_at_points(positions, model.binary_tile_memory, model.binary_threads)
+                   for p in self.particle_arrays)
+
+    def make_octree(self):
+        if not self.particle_arrays:
+            return None
+        return Octree(np.concatenate([p.positions for p in self.particle_arrays]),
+                      np.concatenate([np.full(len(p), p.charge) for p in self.particle_arrays]))
+
+    def tree_electric_field_at_positions(self, positions):
+        opening_angle = self.particle_interaction_model.tree_opening_angle
+        # all species of a push feel the particles at the positions they had when it started
+        tree = self._octree if self._octree is not None else self.make_octree()
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            sample = positions[:self.tree_accuracy_sample_size]
+            logging.debug(f"Tree field relative error: {tree.relative_error(sample, opening_angle):.3g}")
+        return tree.field_at_points(positions, opening_angle)
+
+    def make_short_range_correction(self):
+        cutoff = self.particle_interaction_model.p3m_cutoff * self.spat_mesh.cell.max()
+        if self._mesh_pair_field is None:
+            self._mesh_pair_field = MeshPairField.within(self.spat_mesh.cell, cutoff)
+        positions = [p.positions for p in self.particle_arrays]
+        charges = [np.full(len(p), p.charge) for p in self.particle_arrays]
+        return ShortRangeCorrection(np.concatenate(positions) if positions else np.empty((0, 3)),
+                                    np.concatenate(charges) if charges else np.empty(0),
+                                    self.spat_mesh.mesh, cutoff, self._mesh_pair_field)
+
+    def short_range_electric_field_at_positions(self, positions):
+        correction = self._short_range if self._short_range is not None else self.make_short_range_correction()
+        return correction.field_at_points(positions)
 
     #
     # Push particles
@@ -142,18 +240,23 @@ class Simulation(SerializableH5):
     # Apply domain constrains
     #
 
-    def apply_domain_boundary_conditions(self):
+    def remove_particles_outside_domain_or_inside_regions(self):
+        """
+        Remove particles that left the domain, then those inside each inner region in turn,
+        which absorbs them: builds one removal mask per particle array and compacts each array only once.
+        """
         for arr in self.particle_arrays:
-            collisions = self.out_of_bound(arr)
-            arr.remove(collisions)
+            removed = self.out_of_bound(arr)
+            for region in self.inner_regions:
+                absorbed = region.check_if_points_inside(arr.positions)
+                # particles that already left the domain or hit a previous region are not absorbed again
+                np.logical_and(absorbed, np.logical_not(removed), out=absorbed)
+                region.absorb(np.count_nonzero(absorbed), arr.charge)
+                np.logical_or(removed, absorbed, out=removed)
+            if removed.any():
+                arr.remove(removed)
         self.particle_arrays = [a for a in self.particle_arrays if len(a.ids) > 0]
 
-    def remove_particles_inside_inner_regions(self):
-        for region in self.inner_regions:
-            for p in self.particle_arrays:
-                region.collide_with_particles(p)
-            self.particle_arrays = [a for a in self.particle_arrays if len(a.ids) > 0]
-
     def out_of_bound(self, particle):
         return np.logical_or(np.any(particle.positions < 0, axis=-1),
                              np.any(particle.positions > self.spat_mesh.size, axis=-1))
@@ -163,9 +266,26 @@ class Simulation(SerializableH5):
             particles = src.generate_each_step()
             if len(particles.ids):
                 particles.ids = self.generate_particle_ids(len(particles.ids))
-                self.particle_arrays.append(particles)
+                self.add_particles(particles)
         self.shift_new_particles_velocities_half_time_step_back()
 
+    def add_particles(self, particles):
+        """
+        Append particles to the stored array of the same species, or start a new one.
+        Newly generated particles are not merged with stored ones until their momentums are shifted back
+        by half a time step, so each species ends up in a single contiguous array.
+        """
+        for stored in self.particle_arrays:
+            if stored.is_same_species(particles):
+                stored.append(particles)
+                return
+        self.particle_arrays.append(particles)
+
+    def merge_particle_arrays(self):
+        arrays, self.particle_arrays = self.particle_arrays, []
+        for particles in arrays:
+            self.add_particles(particles)
+
     def generate_particle_ids(self, num_of_particles):
         range_of_ids = range(self.max_id + 1, self.max_id + num_of_particles + 1)
         self.max_id += num_of_particles
@@ -225,6 +345,7 @@ class Simulation(SerializableH5):
 
     def eval_and_write_fields_without_particles(self):
         self.spat_mesh.clear_old_density_values()
+        self.update_inner_region_potentials(self.time_grid.current_time)
         self.eval_potential_and_fields()
         file_name_to_write = self._output_filename_prefix + "fieldsWithoutParticles" + self._output_filename_suffix
         h5file = h5py.File(file_name_to_write, mode="w")
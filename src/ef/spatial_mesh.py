@@ -6,11 +6,19 @@ import numpy as np
 from ef.util.serializable_h5 import SerializableH5
 
 
+# offsets of the 8 corners of a cell relative to its lowest node, in np.ndindex((2, 2, 2)) order
+_cell_corners = np.array(list(product((0, 1), repeat=3)))  # (8, 3)
+
+
 class MeshGrid(SerializableH5):
+    # number of particles deposited per np.bincount call, bounds the size of the temporary index arrays
+    deposition_chunk_size = 1 << 18
+
     def __init__(self, size, n_nodes, origin=(0, 0, 0)):
         self.size = size
         self.n_nodes = n_nodes
         self.origin = np.asarray(origin)
+        self._node_coordinates = None
 
     @classmethod
     def from_step(cls, size, step, origin=(0, 0, 0)):
@@ -23,38 +31,74 @@ class MeshGrid(SerializableH5):
 
     @property
     def node_coordinates(self):
-        return self.origin + \
-               np.moveaxis(np.mgrid[0:self.n_nodes[0], 0:self.n_nodes[1], 0:self.n_nodes[2]], 0, -1) * self.cell
+        """ Array of shape (nx, ny, nz, 3), computed once and cached, do not modify. """
+        if self._node_coordinates is None:
+            self._node_coordinates = self.origin + \
+                np.moveaxis(np.mgrid[0:self.n_nodes[0], 0:self.n_nodes[1], 0:self.n_nodes[2]], 0, -1) * self.cell
+            self._node_coordinates.setflags(write=False)
+        return self._node_coordinates
 
-    def distribute_scalar_at_positions(self, value, positions):
+    def stencil(self, positions):
+        """
+        Find the cells containing given points and their relative positions inside these cells.
+
+        :param positions: array of shape (np, 3)
+        :return: MeshStencil that can be reused for deposition and interpolation at these points
+        """
+        n_nodes = np.asarray(self.n_nodes)
+        nodes, remainders = np.divmod(np.asarray(positions, dtype=float).reshape(-1, 3) - self.origin, self.cell)
+        nodes = nodes.astype(int)  # (np, 3)
+        weights = remainders / self.cell  # (np, 3)
+        # points exactly on the upper boundary are attributed to the last cell with weight 1
+        on_upper_boundary = np.logical_and(nodes == n_nodes - 1, weights == 0)
+        nodes[on_upper_boundary] -= 1
+        weights[on_upper_boundary] = 1.
+        return MeshStencil(self, nodes, weights)
+
+    def distribute_scalar_at_positions(self, value, positions, out=None):
         """
         Given a set of points, distribute the scalar value's density onto the grid nodes.
 
         :param value: scalar
         :param positions: array of shape (np, 3)
-        :return: array of shape (nx, ny, nz)
+        :param out: optional array of shape (nx, ny, nz) to add the density to
+        :return: array of shape (nx, ny, nz), out if it was given
+        """
+        return self.distribute_scalar(value, self.stencil(positions), out)
+
+    def distribute_scalar(self, value, stencil, out=None):
+        """
+        Distribute the scalar value's density onto the grid nodes using a precomputed stencil.
+        Only the box of nodes spanned by the stencil is updated.
+
+        :param value: scalar
+        :param stencil: MeshStencil of np points on this grid
+        :param out: optional array of shape (nx, ny, nz) to add the density to
+        :return: array of shape (nx, ny, nz), out if it was given
         """
         volume_around_node = self.cell.prod()
         density = value / volume_around_node  # scalar
-        result = np.zeros(self.n_nodes)
-        pos = positions - self.origin
-        nodes, remainders = np.divmod(pos, self.cell)  # (np, 3)
-        nodes = nodes.astype(int)  # (np, 3)
-        weights = remainders / self.cell  # (np, 3)
-        w = np.stack([1. - weights, weights], axis=-2)  # (np, 2, 3)
-        dn = np.array(list(product((0, 1), repeat=3)))  # (8, 3)
-        weight_on_nodes = w[:, dn[:, (0, 1, 2)], (0, 1, 2)].prod(-1)  # (np, 8)
-        nodes_to_update = nodes[:, np.newaxis] + dn[np.newaxis, :]  # (np, 8, 3)
-        wf = weight_on_nodes.flatten()  # (np*8)
-        nf = nodes_to_update.reshape((-1, 3))  # (np*8, 3)
-        wz = wf[wf > 0]
-        nz = nf[wf > 0]
-        # df = pd.DataFrame.from_dict({'coords': nodes_to_update, 'weight': weight_on_nodes})
-        if np.any(np.logical_or(nz >= self.n_nodes, nz < 0)):
+        n_nodes = np.asarray(self.n_nodes)
+        if out is None:
+            out = np.zeros(n_nodes)
+        nodes = stencil.nodes  # (np, 3)
+        if len(nodes) == 0:
+            return out
+        if np.any(np.logical_or(nodes > n_nodes - 2, nodes < 0)):
             raise ValueError("Position is out of meshgrid bounds")
-        for i in range(len(wz)):
-            result[tuple(nz[i])] += wz[i] * density
-        return result
+        box_start = nodes.min(axis=0)
+        box_shape = nodes.max(axis=0) - box_start + 2
+        box_strides = np.array((box_shape[1] * box_shape[2], box_shape[2], 1))
+        corner_offsets = _cell_corners @ box_strides  # (8)
+        flat_nodes = (nodes - box_start) @ box_strides  # (np)
+        corner_weights = stencil.corner_weights  # (np, 8)
+        box = np.zeros(box_shape.prod())
+        for start in range(0, len(flat_nodes), self.deposition_chunk_size):
+            chunk = slice(start, start + self.deposition_chunk_size)
+            indexes = flat_nodes[chunk, np.newaxis] + corner_offsets  # (chunk, 8)
+            box += np.bincount(indexes.ravel(), (corner_weights[chunk] * density).ravel(), minlength=len(box))
+        out[tuple(slice(a, a + n) for a, n in zip(box_start, box_shape))] += box.reshape(box_shape)
+        return out
 
     def interpolate_field_at_positions(self, field, positions):
         """
@@ -64,19 +108,83 @@ class MeshGrid(SerializableH5):
         :param positions: array of shape (np, 3)
         :return: array of shape (np, {F})
         """
-        node, remainder = np.divmod(positions - self.origin, self.cell)
-        node = node.astype(int)  # shape is (p, 3)
-        weight = remainder / self.cell  # shape is (np, 3)
-        w = np.stack([1. - weight, weight], axis=-2)  # shape is (np, 2, 3)
-        dn = np.array(list(product((0, 1), repeat=3)))  # shape is (8, 3)
-        nodes_to_use = node[..., np.newaxis, :] + dn  # shape is (np, 8, 3)
+        return self.interpolate_field(field, self.stencil(positions))
+
+    def interpolate_field(self, field, stencil):
+        """
+        Given a field on this grid, interpolate it at points of a precomputed stencil.
+
+        :param field: array of shape (nx, ny, nz, {F})
+        :param stencil: MeshStencil of np points on this grid
+        :return: array of shape (np, {F})
+        """
+        nodes_to_use = stencil.nodes[..., np.newaxis, :] + _cell_corners  # shape is (np, 8, 3)
         field_indexes = np.moveaxis(nodes_to_use, -1, 0)  # shape is (3, np, 8)
         out_of_bounds = np.logical_or(nodes_to_use >= self.n_nodes, nodes_to_use < 0).any(axis=-1)  # (np, 8)
-        field_on_nodes = np.empty((*field.shape[3:], len(positions), 8))  # (F, np, 8)
+        field_on_nodes = np.empty((*field.shape[3:], len(stencil.nodes), 8))  # (F, np, 8)
         field_on_nodes[..., out_of_bounds] = 0  # (F, np, 8) interpolate out-of-bounds field as 0
         field_on_nodes[..., ~out_of_bounds] = field[tuple(field_indexes[:, ~out_of_bounds])].transpose()  # sorry...
-        weight_on_nodes = w[..., dn[:, (0, 1, 2)], (0, 1, 2)].prod(-1)  # shape is (np, 8)
-        return np.moveaxis((field_on_nodes * weight_on_nodes).sum(axis=-1), -1, 0)  # shape is (np, F)
+        return np.moveaxis((field_on_nodes * stencil.corner_weights).sum(axis=-1), -1, 0)  # shape is (np, F)
+
+    @staticmethod
+    def pad_with_ghost_layer(field):
+        """
+        Surround a field on this grid with a layer of zero-valued ghost nodes.
+
+        :param field: array of shape (nx, ny, nz, {F})
+        :return: array of shape (nx + 2, ny + 2, nz + 2, {F})
+        """
+        return np.pad(field, [(1, 1)] * 3 + [(0, 0)] * (field.ndim - 3), mode='constant')
+
+    def interpolate_padded_field(self, padded_field, stencil):
+        """
+        Given a field on this grid padded with a zero ghost layer, interpolate it at points of a stencil.
+        Cell corners outside of the grid are clipped onto the ghost layer, so that out-of-bounds
+        field is interpolated as 0 without masking, with a single gather from the flattened field.
+
+        :param padded_field: array of shape (nx + 2, ny + 2, nz + 2, {F}), see pad_with_ghost_layer
+        :param stencil: MeshStencil of np points on this grid
+        :return: array of shape (np, {F})
+        """
+        n_nodes = np.asarray(self.n_nodes)
+        padded_shape = n_nodes + 2
+        strides = np.array((padded_shape[1] * padded_shape[2], padded_shape[2], 1))
+        lower = (np.clip(stencil.nodes, -1, n_nodes) + 1) * strides  # (np, 3)
+        upper = (np.clip(stencil.nodes + 1, -1, n_nodes) + 1) * strides  # (np, 3)
+        fx, fy, fz = (np.stack((lower[:, i], upper[:, i]), axis=-1) for i in range(3))  # (np, 2) each
+        indexes = (fx[:, :, None, None] + fy[:, None, :, None] + fz[:, None, None, :]).reshape(-1, 8)  # (np, 8)
+        field_on_nodes = padded_field.reshape(-1, *padded_field.shape[3:])[indexes]  # (np, 8, {F})
+        return np.einsum('pc,pc...->p...', stencil.corner_weights, field_on_nodes)  # (np, {F})
+
+
+class MeshStencil:
+    """
+    Cells containing a set of points on a MeshGrid and the trilinear weights of their corners.
+    Computed once per particle positions update and shared by charge deposition and field interpolation.
+    """
+
+    def __init__(self, grid, nodes, weights):
+        self.grid = grid
+        self.nodes = nodes  # (np, 3) lowest node of the cell containing each point
+        self.weights = weights  # (np, 3) relative position of each point inside its cell
+        self._corner_weights = None
+
+    @property
+    def corner_weights(self):
+        """
+        :return: array of shape (np, 8), weights of cell corners ordered as _cell_corners
+        """
+        if self._corner_weights is None:
+            w = np.stack([1. - self.weights, self.weights], axis=-1)  # (np, 3, 2)
+            self._corner_weights = \
+                (w[:, 0, :, None, None] * w[:, 1, None, :, None] * w[:, 2, None, None, :]).reshape(-1, 8)
+        return self._corner_weights
+
+    def keep(self, mask):
+        corner_weights = self._corner_weights
+        self.__init__(self.grid, self.nodes[mask], self.weights[mask])
+        if corner_weights is not None:
+            self._corner_weights = corner_weights[mask]
 
 
 class SpatialMesh(SerializableH5):
@@ -85,6 +193,7 @@ class SpatialMesh(SerializableH5):
         self.charge_density = charge_density
         self.potential = potential
         self.electric_field = electric_field
+        self._padded_electric_field = None  # electric_field is a view of its interior once it is set
 
     @property
     def size(self):
@@ -142,11 +251,21 @@ class SpatialMesh(SerializableH5):
 
     def weight_particles_charge_to_mesh(self, particle_arrays):
         for p in particle_arrays:
-            self.charge_density += self.mesh.distribute_scalar_at_positions(p.charge, p.positions)
+            self.mesh.distribute_scalar(p.charge, p.mesh_stencil(self.mesh), out=self.charge_density)
 
     def field_at_position(self, positions):
         return self.mesh.interpolate_field_at_positions(self.electric_field, positions)
 
+    def set_electric_field(self, field):
+        """ Keep the field inside a zero ghost layer, so that gathers at particles do not pad it on every call. """
+        self._padded_electric_field = self.mesh.pad_with_ghost_layer(field)
+        self.electric_field = self._padded_electric_field[1:-1, 1:-1, 1:-1]
+
+    def field_at_particles(self, particles):
+        if self._padded_electric_field is None or self.electric_field.base is not self._padded_electric_field:
+            self.set_electric_field(self.electric_field)  # assigned directly, e.g. loaded from a file
+        return self.mesh.interpolate_padded_field(self._padded_electric_field, particles.mesh_stencil(self.mesh))
+
     def clear_old_density_values(self):
         self.charge_density.fill(0)
 
@@ -22,10 +22,12 @@ class SerializableH5(DataClass):
         return SerializableH5._subclass_dict[h5group.attrs['class']].load_h5_args(h5group)
 
     @classmethod
-    def load_h5_args(cls, h5group):
+    def load_h5_args(cls, h5group, **extra_kwargs):
+        """ :param extra_kwargs: constructor arguments that are not saved in the file """
         kwargs = {key: cls._load_value(value) for key, value in h5group.items()}
         kwargs.update(h5group.attrs)
         del kwargs['class']
+        kwargs.update(extra_kwargs)
         return cls(**kwargs)
 
     @classmethod
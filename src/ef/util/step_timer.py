@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+from time import perf_counter
+
+
+class StepTimer:
+    """ Accumulates wall time spent in named stages of a time step. """
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + perf_counter() - start
+
+    @property
+    def total(self):
+        return sum(self.stages.values())
+
+    def __str__(self):
+        return ', '.join(f"{name} {t:.3g} s" for name, t in self.stages.items())
@@ -1,11 +1,13 @@
 from configparser import ConfigParser
+import pytest
 
 from ef.config.components import *
 from ef.config.config import Config
 from ef.config.section import ConfigSection
 
 comp_list = [BoundaryConditionsConf, InnerRegionConf, OutputFileConf, ParticleInteractionModelConf,
-             ParticleSourceConf, SpatialMeshConf, TimeGridConf, ExternalFieldUniformConf]
+             ParticleSourceConf, SpatialMeshConf, TimeGridConf, ExternalFieldUniformConf, ParticleSortingConf,
+             FieldSolverConf]
 
 
 def test_components_to_conf_and_back():
@@ -42,6 +44,79 @@ class TestEfConf:
         c1 = Config.from_string(s)
         assert c1 == conf
 
+    def test_time_dependent_inner_regions(self):
+        regions = [InnerRegionConf('rf', Sphere(), potential_expression='100 * sin(2 * pi * 1e6 * t)'),
+                   InnerRegionConf('pulse', Cylinder(), potential_table=[(0, 0), (1e-9, 100), (2e-9, 0)])]
+        conf = Config(inner_regions=regions)
+        s = conf.export_to_string()
+        assert "potential_table = 0.0 0.0; 1e-09 100.0; 2e-09 0.0" in s
+        assert Config.from_string(s) == conf
+        assert "potential_expression" not in Config(inner_regions=[InnerRegionConf()]).export_to_string()
+        region = conf.make().inner_regions[1]
+        assert region.is_time_dependent and region.potential_at(1.5e-9) == pytest.approx(50)
+
+    def test_optional_sections(self):
+        s = Config().export_to_string()
+        assert "ParticleSorting" not in s
+        assert Config.from_string(s) == Config()
+        conf = Config(particle_sorting=ParticleSortingConf(10, 'linear'))
+        s = conf.export_to_string()
+        assert "[ParticleSorting]" in s
+        assert Config.from_string(s) == conf
+        assert Config.from_string(s.replace("sort_order = linear", "")) == \
+            Config(particle_sorting=ParticleSortingConf(10))
+
+    def test_field_solver_options(self):
+        assert "FieldSolver" not in Config().export_to_string()
+        conf = Config(field_solver=FieldSolverConf('cg', 'ilu', 1e-8, 50, 1 << 20))
+        s = conf.export_to_string()
+        assert "[FieldSolver]" in s
+        assert Config.from_string(s) == conf
+        options = conf.make().field_solver_options
+        assert (options.solver, options.preconditioner, options.tolerance, options.max_iterations) == \
+            ('cg', 'ilu', 1e-8, 50)
+        assert options.memory_limit == 1 << 20
+        assert Config.from_string("[FieldSolver]\npreconditioner = jacobi\n" + Config().export_to_string()) == \
+            Config(field_solver=FieldSolverConf(preconditioner='jacobi'))
+        assert conf.make().field_solver_options.extrapolate is False
+        assert Config.from_string("[FieldSolver]\nextrapolate = yes\n" + Config().export_to_string()) == \
+            Config(field_solver=FieldSolverConf(extrapolate=True))
+        conf = Config(field_solver=FieldSolverConf(operator='matrix_free', cache_dir='/tmp/ef_cache'))
+        assert Config.from_string(conf.export_to_string()) == conf
+        assert conf.make().field_solver_options.cache_dir == '/tmp/ef_cache'
+        conf = Config(field_solver=FieldSolverConf(vacuum_superposition=False))
+        assert "vacuum_superposition = False" in conf.export_to_string()
+        assert Config.from_string(conf.export_to_string()) == conf
+        assert Config.from_string("[FieldSolver]\nvacuum_superposition = no\n" + Config().export_to_string()) == conf
+        assert Config(field_solver=FieldSolverConf('auto')).make().field_solver_options.solver == 'auto'
+        conf = Config(field_solver=FieldSolverConf('cg', recycle_size=8, recycle_memory_limit=1 << 20))
+        assert Config.from_string(conf.export_to_string()) == conf
+        assert conf.make().field_solver_options.recycle_size == 8
+        conf = Config(field_solver=FieldSolverConf(assembly_memory_limit=1 << 20))
+        assert Config.from_string(conf.export_to_string()) == conf
+        assert conf.make().field_solver_options.assembly_memory_limit == 1 << 20
+
+    def test_interaction_model_options(self):
+        conf = Config(particle_interaction_model=ParticleInteractionModelConf('binary', 1000, 4))
+        s = conf.export_to_string()
+        assert "binary_threads = 4" in s
+        assert Config.from_string(s) == conf
+        model = conf.make().particle_interaction_model
+        assert model.binary and model.binary_tile_memory == 1000 and model.binary_threads == 4
+        assert "binary_threads" not in Config().export_to_string()
+        conf = Config(particle_interaction_model=ParticleInteractionModelConf('tree', tree_opening_angle=0.4))
+        assert "tree_opening_angle = 0.4" in conf.export_to_string()
+        assert Config.from_string(conf.export_to_string()) == conf
+        model = conf.make().particle_interaction_model
+        assert model.tree and model.tree_opening_angle == 0.4
+        for angle in 0, 1.5:
+            with pytest.raises(ValueError):
+                ParticleInteractionModelConf('tree', tree_opening_angle=angle)
+        conf = Config(particle_interaction_model=ParticleInteractionModelConf('p3m', p3m_cutoff=3))
+        assert "p3m_cutoff = 3.0" in conf.export_to_string()
+        assert Config.from_string(conf.export_to_string()) == conf
+        assert conf.make().particle_interaction_model.p3m_cutoff == 3
+
     def test_conf_repr(self):
         # noinspection PyUnresolvedReferences
         from numpy import array  # for use in eval
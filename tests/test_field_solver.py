@@ -1,13 +1,25 @@
+import logging
+
 import numpy as np
+import pytest
 from numpy.testing import assert_array_equal, assert_allclose
-from scipy.sparse import csr_matrix
 
 from ef.config.components import BoundaryConditionsConf, SpatialMeshConf
-from ef.config.components import Box
+from ef.config.components import Box, Sphere
+from ef.field.solvers.direct import DirectSolver
+from ef.field.solvers.stencil import StencilOperator
 from ef.field.solvers.field_solver import FieldSolver
+from ef.field.solvers.field_solver_options import FieldSolverOptions
 from ef.inner_region import InnerRegion
 
 
+def global_index(n_nodes):
+    """ (unknown number, i, j, k) of every interior node, in the Fortran order of the equation unknowns """
+    nx, ny, nz = n_nodes - 2
+    return [(i + j * nx + k * nx * ny, i + 1, j + 1, k + 1)
+            for k in range(nz) for j in range(ny) for i in range(nx)]
+
+
 class TestFieldSolver:
 
     def test_eval_field_from_potential(self):
@@ -24,18 +36,18 @@ class TestFieldSolver:
         assert_array_equal(mesh.electric_field, expected)
 
     def test_global_index(self):
-        double_index = list(FieldSolver.double_index(np.array((9, 10, 6))))
+        index = list(global_index(np.array((9, 10, 6))))
         for i in range(7):
             for j in range(8):
                 for k in range(4):
                     n = i + j * 7 + k * 7 * 8
-                    assert double_index[n] == (n, i + 1, j + 1, k + 1)
-        assert list(FieldSolver.double_index(np.array((4, 5, 3)))) == [(0, 1, 1, 1),
-                                                                       (1, 2, 1, 1),
-                                                                       (2, 1, 2, 1),
-                                                                       (3, 2, 2, 1),
-                                                                       (4, 1, 3, 1),
-                                                                       (5, 2, 3, 1)]
+                    assert index[n] == (n, i + 1, j + 1, k + 1)
+        assert list(global_index(np.array((4, 5, 3)))) == [(0, 1, 1, 1),
+                                                           (1, 2, 1, 1),
+                                                           (2, 1, 2, 1),
+                                                           (3, 2, 2, 1),
+                                                           (4, 1, 3, 1),
+                                                           (5, 2, 3, 1)]
 
     def test_init_rhs(self):
         mesh = SpatialMeshConf((4, 3, 3)).make(BoundaryConditionsConf())
@@ -80,64 +92,29 @@ class TestFieldSolver:
         solver.init_rhs_vector(mesh, [region])
         assert_array_equal(solver.rhs, [3, 3, 0, 3, 3, 0, 3, 3, 0, 3, 3, 0])
 
-    def test_zero_nondiag_inside_objects(self):
+    def test_eliminate_nodes_inside_objects(self):
         mesh = SpatialMeshConf((4, 6, 9), (1, 2, 3)).make(BoundaryConditionsConf())
-        solver = FieldSolver(mesh, [])
         region = InnerRegion('test', Box((1, 2, 3), (1, 2, 3)), 3)
+        solver = FieldSolver(mesh, [region], FieldSolverOptions('cg'))
+        free = [2, 5, 8, 11]
+        full = FieldSolver(mesh, []).A.toarray()
+        assert_array_equal(solver.A.toarray(), full[np.ix_(free, free)])
+        solver.init_rhs_vector(mesh, [region])
+        expected = solver.rhs[free] - full[free] @ np.where(solver._inside, solver.rhs, 0)
+        assert_array_equal(solver.reduced_rhs(solver.rhs), expected)
+        assert_array_equal(solver.coupling.toarray(), full[np.ix_(free, np.flatnonzero(solver._inside))])
 
-        a = csr_matrix(np.full((12, 12), 2))
-        assert_array_equal(a.toarray(), [[2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                         [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2]])
-        result = solver.zero_nondiag_for_nodes_inside_objects(a, mesh, [region])
-        assert_array_equal(result.toarray(), [[1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                              [0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0],
-                                              [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                              [0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 1, 0, 0, 0, 0],
-                                              [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0],
-                                              [2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2, 2]])
-
-        # TODO: check algorithm if on-diagonal zeros should turn into ones
-        a = csr_matrix(np.array([[4, 0, 3, 0, 0, 0, 0, 2, 0, 0, 0, 0],
-                                 [0, 0, 0, 0, 0, 0, 0, 0, 0, 3, 0, 0],
-                                 [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                 [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                 [0, 0, 0, 0, 4, 0, 0, 0, 0, 0, 0, 0],
-                                 [0, 0, 2, 0, 0, 3, 0, 0, 0, 0, 0, 0],
-                                 [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                 [0, 0, 2, 0, 0, 0, 0, 0, 0, 1, 0, 0],
-                                 [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 3],
-                                 [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                 [0, 0, 0, 0, 0, 2, 0, 0, 0, 0, 6, 0],
-                                 [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]]))
-        result = solver.zero_nondiag_for_nodes_inside_objects(a, mesh, [region])
-        assert_array_equal(result.toarray(), [[1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 2, 0, 0, 3, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 3],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1, 0],
-                                              [0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0]])
+    @pytest.mark.parametrize('preconditioner', ['none', 'jacobi', 'ilu', 'multigrid'])
+    def test_cg_with_inner_regions(self, preconditioner):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(9, 15, 2))
+        regions = [InnerRegion('a', Box((2, 2, 2), (3, 2, 2)), 3), InnerRegion('b', Sphere((7, 4, 3), 1.5), -2)]
+        FieldSolver(mesh, regions, FieldSolverOptions('direct')).eval_potential(mesh, regions)
+        expected = mesh.potential.copy()
+        solver = FieldSolver(mesh, regions, FieldSolverOptions('cg', preconditioner, tolerance=1e-12))
+        assert abs(solver.A - solver.A.T).max() == 0
+        solver.eval_potential(mesh, regions)
+        assert_allclose(mesh.potential, expected, atol=1e-9)
 
     def test_d2dx2(self):
         a = FieldSolver.construct_d2dx2_in_3d(3, 2, 2).toarray()
@@ -208,7 +185,6 @@ class TestFieldSolver:
     def test_construct_equation_matrix(self):
         mesh = SpatialMeshConf((4, 6, 9), (1, 2, 3)).make(BoundaryConditionsConf())
         solver = FieldSolver(mesh, [])
-        solver.construct_equation_matrix(mesh, [])
         d = -2 * (2 * 2 * 3 * 3 + 3 * 3 + 2 * 2)
         x = 2 * 2 * 3 * 3
         y = 3 * 3
@@ -241,3 +217,236 @@ class TestFieldSolver:
             [[0, 0, 0, 0], [0, 2, 8, 0], [0, 5, 11, 0], [0, 0, 0, 0]],
             [[0, 0, 0, 0], [0, 3, 9, 0], [0, 6, 12, 0], [0, 0, 0, 0]],
             [[0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0], [0, 0, 0, 0]]])
+
+    @pytest.mark.parametrize('preconditioner', FieldSolverOptions.preconditioners)
+    def test_preconditioners(self, preconditioner):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 1, 1)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(9, 7, 5))
+        solver = FieldSolver(mesh, [], FieldSolverOptions('cg', preconditioner, tolerance=1e-12))
+        preconditioner = solver.preconditioner
+        solver.eval_potential(mesh, [])
+        assert_allclose(solver.A @ solver.phi_vec, solver.rhs, rtol=1e-9, atol=1e-9 * np.abs(solver.rhs).max())
+        solver.eval_potential(mesh, [])
+        assert solver.preconditioner is preconditioner
+
+    def test_ilu_reduces_iterations(self):
+        mesh = SpatialMeshConf((20, 20, 20), (1, 1, 1)).make(BoundaryConditionsConf(1))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(19, 19, 19))
+        iterations = {}
+        for kind in 'none', 'ilu':
+            solver = FieldSolver(mesh, [], FieldSolverOptions('cg', kind, tolerance=1e-8))
+            solver.eval_potential(mesh, [])
+            assert solver.last_report.converged
+            iterations[kind] = solver.last_report.iterations
+        assert iterations['ilu'] < iterations['none'] / 2
+
+    def test_dst_solver(self):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(9, 15, 2))
+        solver = FieldSolver(mesh, [])
+        assert solver.solver == 'dst' and solver._A is None
+        solver.eval_potential(mesh, [])
+        dst_potential = mesh.potential.copy()
+        assert_allclose(solver.A @ solver.phi_vec, solver.rhs, atol=1e-10 * np.abs(solver.rhs).max())
+        FieldSolver(mesh, [], FieldSolverOptions('cg', tolerance=1e-12)).eval_potential(mesh, [])
+        assert_allclose(mesh.potential, dst_potential, atol=1e-9)
+
+    def test_choose_solver(self):
+        mesh = SpatialMeshConf((4, 6, 9), (1, 2, 3)).make(BoundaryConditionsConf())
+        region = InnerRegion('test', Box((1, 2, 3), (1, 2, 3)), 3)
+        assert FieldSolver(mesh, [region]).solver == 'cg'
+        assert FieldSolver(mesh, [], FieldSolverOptions('cg')).solver == 'cg'
+        with pytest.raises(ValueError):
+            FieldSolver(mesh, [region], FieldSolverOptions('dst'))
+
+    def test_direct_solver(self):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(9, 15, 2))
+        region = InnerRegion('test', Box((2, 2, 2), (3, 2, 2)), 3)
+        FieldSolver(mesh, [region], FieldSolverOptions('multigrid', tolerance=1e-12)).eval_potential(mesh, [region])
+        expected = mesh.potential.copy()
+        solver = FieldSolver(mesh, [region], FieldSolverOptions('direct'))
+        assert solver.solver == 'direct' and solver._direct.memory > 0
+        solver.eval_potential(mesh, [region])
+        assert_allclose(mesh.potential, expected, atol=1e-9)
+        solver.eval_potential(mesh, [region])
+        assert_allclose(mesh.potential, expected, atol=1e-9)
+
+    def test_direct_solver_memory_limit(self):
+        mesh = SpatialMeshConf((10, 8, 6)).make(BoundaryConditionsConf())
+        assert FieldSolver(mesh, [], FieldSolverOptions('direct', memory_limit=1000)).solver == 'cg'
+        assert DirectSolver.estimate_memory(10 ** 6) > DirectSolver.estimate_memory(10 ** 5) * 10
+
+    @pytest.mark.parametrize('kind', ['cg', 'multigrid', 'direct'])
+    def test_vacuum_superposition(self, kind):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        region = InnerRegion('test', Box((2, 2, 2), (3, 2, 2)), 3)
+        potentials = {}
+        for superposition in True, False:
+            solver = FieldSolver(mesh, [region], FieldSolverOptions(kind, tolerance=1e-12,
+                                                                  vacuum_superposition=superposition))
+            potentials[superposition] = []
+            for seed in 0, 1:
+                mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(seed).uniform(size=(9, 15, 2))
+                solver.eval_potential(mesh, [region])
+                assert_allclose(solver.A @ solver.phi_vec[solver._free], solver.reduced_rhs(solver.rhs),
+                                atol=1e-9 * np.abs(solver.rhs).max())
+                potentials[superposition].append(mesh.potential.copy())
+        assert_allclose(potentials[True], potentials[False], atol=1e-9)
+
+    def test_time_dependent_regions(self):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(9, 15, 2))
+        regions = [InnerRegion('rf', Box((2, 2, 2), (3, 2, 2)), potential_expression='10 * t'),
+                   InnerRegion('static', Box((6, 1, 0), (2, 2, 2)), 3),
+                   InnerRegion('pulse', Box((4, 1, 0), (2, 2, 2)), potential_table=[(0, 0), (1, 5), (2, 0)])]
+        solver = FieldSolver(mesh, regions, FieldSolverOptions('direct'))
+        for t in 0.5, 1, 1.5:
+            for ir in regions:
+                ir.update_potential(t)
+            solver.eval_potential(mesh, regions)
+            potential = mesh.potential.copy()
+            FieldSolver(mesh, regions, FieldSolverOptions('direct', vacuum_superposition=False)).eval_potential(
+                mesh, regions)
+            assert_allclose(potential, mesh.potential, atol=1e-9)
+        assert len(solver._electrode_basis) == 2
+
+    def test_region_masks(self):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf())
+        regions = [InnerRegion('a', Box((2, 2, 2), (3, 2, 2)), 3), InnerRegion('b', Sphere((6, 4, 3), 2), 1)]
+        solver = FieldSolver(mesh, regions)
+        assert solver.region_masks(mesh, regions) is solver._region_masks
+        assert mesh.node_coordinates is mesh.node_coordinates
+        for ir, mask in zip(regions, solver.region_masks(mesh, regions)):
+            expected = [ir.check_if_points_inside(mesh.cell * (i, j, k))
+                        for n, i, j, k in global_index(mesh.n_nodes)]
+            assert_array_equal(mask, expected)
+
+    @pytest.mark.parametrize('kind', ['cg', 'multigrid', 'direct', 'dst'])
+    def test_solve_report(self, kind):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(9, 15, 2))
+        solver = FieldSolver(mesh, [], FieldSolverOptions(kind))
+        assert solver.phi_vec.dtype == np.float64 and solver.last_report is None
+        solver.eval_potential(mesh, [])
+        report = solver.last_report
+        assert report.solver == kind and report.converged and report.wall_time > 0
+        assert (report.iterations > 0) == (kind in ('cg', 'multigrid'))
+        assert np.isnan(report.residual) if kind == 'dst' else report.residual < 1e-9
+
+    def test_extrapolated_warm_start(self):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        density = np.random.RandomState(0).uniform(size=(9, 15, 2))
+        iterations = {}
+        for extrapolate in False, True:
+            solver = FieldSolver(mesh, [], FieldSolverOptions('cg', extrapolate=extrapolate))
+            for step in range(1, 4):
+                mesh.charge_density[1:-1, 1:-1, 1:-1] = step * density
+                solver.eval_potential(mesh, [])
+            iterations[extrapolate] = solver.last_report.iterations
+        assert iterations[True] < iterations[False] / 2
+
+    def test_matrix_free_operator(self, caplog):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(9, 15, 2))
+        regions = [InnerRegion('a', Box((2, 2, 2), (3, 2, 2)), 3), InnerRegion('b', Sphere((7, 4, 3), 1.5), -2)]
+        assembled = FieldSolver(mesh, regions, FieldSolverOptions('cg', tolerance=1e-12, memory_limit=1000))
+        caplog.set_level(logging.INFO)
+        stencil = FieldSolver(mesh, regions, FieldSolverOptions('cg', 'jacobi', tolerance=1e-12,
+                                                                assembly_memory_limit=1000))
+        assert not assembled.matrix_free and stencil.matrix_free
+        assert "matrix-free operator" in caplog.text
+        assert isinstance(stencil.A, StencilOperator)
+        x = np.random.RandomState(1).uniform(size=assembled.A.shape[0])
+        assert_allclose(stencil.A @ x, assembled.A @ x)
+        assert_allclose(stencil.A.diagonal(), assembled.A.diagonal())
+        assembled.eval_potential(mesh, regions)
+        assert_allclose(stencil.reduced_rhs(assembled.rhs), assembled.reduced_rhs(assembled.rhs))
+        expected = mesh.potential.copy()
+        stencil.eval_potential(mesh, regions)
+        assert_allclose(mesh.potential, expected, atol=1e-9)
+        assert FieldSolver(mesh, regions, FieldSolverOptions('cg', 'ilu', operator='matrix_free')).matrix_free
+        with pytest.raises(ValueError):
+            FieldSolver(mesh, regions, FieldSolverOptions('direct', operator='matrix_free'))
+
+    @pytest.mark.parametrize('options', [FieldSolverOptions('direct'), FieldSolverOptions('cg', 'ilu', 1e-12)])
+    def test_cache(self, options, tmpdir):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(9, 15, 2))
+        regions = [InnerRegion('a', Box((2, 2, 2), (3, 2, 2)), 3), InnerRegion('b', Sphere((7, 4, 3), 1.5), -2)]
+        FieldSolver(mesh, regions, options).eval_potential(mesh, regions)
+        expected = mesh.potential.copy()
+        options.cache_dir = str(tmpdir)
+        first = FieldSolver(mesh, regions, options)
+        cached = FieldSolver(mesh, regions, options)
+        assert len(tmpdir.listdir()) == 1
+        assert isinstance(cached._region_masks[0], np.memmap) and not cached.A.data.flags.writeable
+        assert_array_equal(cached.A.toarray(), first.A.toarray())
+        for solver in first, cached:
+            mesh.potential[1:-1, 1:-1, 1:-1] = 0
+            solver.eval_potential(mesh, regions)
+            assert_allclose(mesh.potential, expected, atol=1e-9)
+        if options.solver == 'direct':
+            assert first._direct.method == 'lu' and cached._direct.method == 'factors'
+        other = [InnerRegion('a', Box((2, 2, 2), (3, 2, 2)), 5), InnerRegion('b', Sphere((7, 4, 3), 1), -2)]
+        assert FieldSolver.cache_key(mesh, other[:1]) == FieldSolver.cache_key(mesh, regions[:1])
+        assert FieldSolver.cache_key(mesh, other) != FieldSolver.cache_key(mesh, regions)
+
+    def test_autotune(self):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=(9, 15, 2))
+        regions = [InnerRegion('a', Box((2, 2, 2), (3, 2, 2)), 3)]
+        FieldSolver(mesh, regions, FieldSolverOptions('direct')).eval_potential(mesh, regions)
+        expected = mesh.potential.copy()
+        mesh.potential[1:-1, 1:-1, 1:-1] = 0
+        options = FieldSolverOptions('auto', tolerance=1e-12)
+        solver = FieldSolver(mesh, regions, options, expected_solves=100)
+        solver.eval_potential(mesh, regions)
+        assert_allclose(mesh.potential, expected, atol=1e-9)
+        assert (options.solver, options.preconditioner) == ('auto', 'none')
+        assert options.autotuned == f"{solver.solver}/{solver.preconditioner_kind}"
+        assert solver.solver not in ('auto', 'default', 'dst')
+        solver.eval_potential(mesh, regions)
+        assert_allclose(mesh.potential, expected, atol=1e-9)
+        restarted = FieldSolver(mesh, regions, FieldSolverOptions('auto', autotuned='cg/ilu'))
+        assert (restarted.solver, restarted.preconditioner_kind) == ('cg', 'ilu')
+
+    def test_autotune_skips_failing_candidates(self, caplog):
+        mesh = SpatialMeshConf((10, 8, 6), (1, 0.5, 2)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        regions = [InnerRegion('a', Box((2, 2, 2), (3, 2, 2)), 3)]
+        FieldSolver(mesh, regions, FieldSolverOptions('direct')).eval_potential(mesh, regions)
+        expected = mesh.potential.copy()
+        mesh.potential[1:-1, 1:-1, 1:-1] = 0
+        solver = FieldSolver(mesh, regions, FieldSolverOptions('auto', tolerance=1e-12), expected_solves=100)
+        solver.autotune_candidates = (('cg', 'jacobi'), ('cg', 'unknown'), ('direct', 'none'))
+        solver.eval_potential(mesh, regions)
+        assert_allclose(mesh.potential, expected, atol=1e-9)
+        assert solver.options.autotuned in ('cg/jacobi', 'direct/none')
+        assert "skips cg with unknown preconditioner" in caplog.text
+        solver.autotune_candidates = (('cg', 'unknown'),)
+        with pytest.raises(RuntimeError):
+            solver.autotune(solver.rhs)
+
+    def test_recycled_solutions(self):
+        mesh = SpatialMeshConf((10, 8, 6), (0.5, 0.5, 0.5)).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+        regions = [InnerRegion('a', Box((2, 2, 2), (3, 2, 2)), 3)]
+        patterns = np.random.RandomState(0).uniform(size=(2, 19, 15, 11))
+        iterations = {}
+        for size in 0, 4:
+            solver = FieldSolver(mesh, regions, FieldSolverOptions('cg', 'jacobi', 1e-10, recycle_size=size))
+            direct = FieldSolver(mesh, regions, FieldSolverOptions('direct'))
+            iterations[size] = []
+            for step in range(6):
+                mesh.charge_density[1:-1, 1:-1, 1:-1] = np.tensordot((1, np.sin(step / 3)), patterns, 1)
+                direct.eval_potential(mesh, regions)
+                expected = mesh.potential.copy()
+                solver.eval_potential(mesh, regions)
+                assert_allclose(mesh.potential, expected, atol=1e-8)
+                iterations[size].append(solver.last_report.iterations)
+        assert iterations[4][0] > 10 and max(iterations[4][3:]) <= 2
+        assert min(iterations[0][3:]) > 10
+        solver = FieldSolver(mesh, regions, FieldSolverOptions('cg', recycle_size=10,
+                                                               recycle_memory_limit=3 * 16 * solver.A.shape[0]))
+        assert solver._recycled.size == 3
+        assert FieldSolver(mesh, regions, FieldSolverOptions('cg', recycle_size=10,
+                                                             recycle_memory_limit=100))._recycled is None
@@ -4,6 +4,7 @@ from numpy.testing import assert_array_almost_equal, assert_array_equal
 from ef.external_field_expression import ExternalFieldExpression
 from ef.external_field_on_grid import ExternalFieldOnGrid
 from ef.external_field_uniform import ExternalFieldUniform
+from ef.particle_array import ParticleArray
 
 
 class TestFields:
@@ -28,3 +29,5 @@ class TestFields:
                            [(1, 1, 1), (-1, -1, -1), (3, 2, 1), (1, 1, 1)])
         assert_array_almost_equal(f.get_at_points([(.5, 1., .3), (0, .5, .7)], 5), [(0., .5, 1.), (1, 1.5, 2)])
         assert_array_equal(f.get_at_points([(-1, 1., .3), (1, 1, 10)], 3), [(0, 0, 0), (0, 0, 0)])
+        particles = ParticleArray([1, 2, 3], -1, 1, [(.5, 1., .3), (0, .5, .7), (1, 1, 10)], np.zeros((3, 3)))
+        assert_array_almost_equal(f.get_at_particles(particles, 0), [(0., .5, 1.), (1, 1.5, 2), (0, 0, 0)])
@@ -1,4 +1,7 @@
+import h5py
 import numpy as np
+import pytest
+from numpy.testing import assert_allclose
 
 from ef.inner_region import InnerRegion
 from ef.particle_array import ParticleArray
@@ -65,3 +68,25 @@ class TestInnerRegion:
         assert ir.total_absorbed_particles == 1
         assert ir.total_absorbed_charge == -2
         assert particles == ParticleArray([1], -2.0, 1.0, [(0, 0, 0)], np.zeros((1, 3)))
+
+    def test_time_dependent_potential(self):
+        ir = InnerRegion('test', Box(), 3)
+        assert not ir.is_time_dependent and ir.potential_at(1) == 3
+        ir = InnerRegion('test', Box(), potential_expression='100 * sin(2 * pi * t)')
+        assert ir.is_time_dependent
+        assert_allclose(ir.potential_at(0.25), 100)
+        ir.update_potential(0.75)
+        assert_allclose(ir.potential, -100)
+        ir = InnerRegion('test', Box(), potential_table=[(0, 0), (1, 10), (3, 0)])
+        assert ir.is_time_dependent
+        assert [ir.potential_at(t) for t in (-1, 0.5, 2, 5)] == [0, 5, 5, 0]
+        with pytest.raises(ValueError):
+            InnerRegion('test', Box(), potential_expression='t', potential_table=[(0, 0)])
+
+    def test_time_dependent_potential_h5(self, tmpdir):
+        for ir in InnerRegion('test', Box(), 3), InnerRegion('test', Box(), potential_expression='2 * t'), \
+                InnerRegion('test', Box(), potential_table=[(0, 0), (1, 10)]):
+            with h5py.File(tmpdir.join('region.h5'), 'w') as h5file:
+                ir.save_h5(h5file)
+            with h5py.File(tmpdir.join('region.h5'), 'r') as h5file:
+                assert InnerRegion.load_h5(h5file) == ir
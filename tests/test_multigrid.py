@@ -0,0 +1,106 @@
+import logging
+import time
+
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from ef.config.components import BoundaryConditionsConf, SpatialMeshConf, Box, Sphere
+from ef.field.solvers.field_solver import FieldSolver
+from ef.field.solvers.field_solver_options import FieldSolverOptions
+from ef.field.solvers.multigrid import MultigridSolver, MultigridLevel
+from ef.inner_region import InnerRegion
+
+
+def make_mesh(size, cell=(1, 1, 1)):
+    mesh = SpatialMeshConf(size, cell).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+    mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=mesh.n_nodes - 2)
+    return mesh
+
+
+class TestMultigrid:
+    def test_levels(self):
+        levels = MultigridSolver((31, 15, 8), (1, 2, 3)).levels
+        assert [level.shape for level in levels] == [(31, 15, 8), (15, 7, 8)]
+        assert_allclose(levels[1].cell, (2, 4, 3))
+        level = MultigridLevel((5, 3, 1), (1, 1, 1), np.zeros((5, 3, 1), dtype=bool))
+        assert level.coarsened_axes == [0, 1]
+        coarse = np.arange(2.).reshape(2, 1, 1)
+        assert_allclose(level.prolong(coarse)[:, 1, 0], [0, 0, 0.5, 1, 0.5])
+        assert_allclose(level.restrict(np.ones((5, 3, 1))), np.ones((2, 1, 1)))
+
+    def test_matches_dst(self):
+        mesh = make_mesh((32, 16, 24), (1, 0.5, 1))
+        solver = FieldSolver(mesh, [])
+        solver.init_rhs_vector(mesh, [])
+        multigrid = MultigridSolver(mesh.n_nodes - 2, mesh.cell, tolerance=1e-12)
+        assert_allclose(multigrid.solve(solver.rhs), solver._dst.solve(solver.rhs), atol=1e-8)
+        assert multigrid.history[-1] < 1e-12
+        assert np.all(np.diff(multigrid.history) < 0)
+        assert len(multigrid.history) < 30
+
+    def test_unsupported_coarsening(self):
+        mesh = make_mesh((33, 25, 27))
+        solver = FieldSolver(mesh, [])
+        solver.init_rhs_vector(mesh, [])
+        multigrid = MultigridSolver(mesh.n_nodes - 2, mesh.cell, tolerance=1e-10)
+        assert len(multigrid.levels) == 1
+        assert_allclose(multigrid.solve(solver.rhs), solver._dst.solve(solver.rhs), atol=1e-7)
+
+    def test_coarsest_grid_too_large_to_factorize(self):
+        mesh = make_mesh((50, 50, 50))
+        regions = [InnerRegion('a', Box((5, 5, 5), (10, 10, 10)), 3)]
+        assert MultigridSolver.coarsest_shape(mesh.n_nodes - 2) == (24, 24, 24)
+        for options in FieldSolverOptions('multigrid'), FieldSolverOptions('cg', 'multigrid'):
+            solver = FieldSolver(mesh, regions, options)
+            assert not solver.multigrid.factorized
+            solver.eval_potential(mesh, regions)
+            assert solver.last_report.converged
+            assert_allclose(solver.A @ solver.phi_vec[solver._free], solver.reduced_rhs(solver.rhs),
+                            atol=1e-8 * np.abs(solver.rhs).max())
+        preconditioner = solver.preconditioner
+        x, y = np.random.RandomState(1).uniform(size=(2, preconditioner.shape[0]))
+        assert_allclose(x @ preconditioner.matvec(y), y @ preconditioner.matvec(x))
+
+    def test_warm_start(self):
+        mesh = make_mesh((16, 16, 16))
+        solver = FieldSolver(mesh, [])
+        solver.init_rhs_vector(mesh, [])
+        multigrid = MultigridSolver(mesh.n_nodes - 2, mesh.cell)
+        exact = solver._dst.solve(solver.rhs)
+        assert_allclose(multigrid.solve(solver.rhs, exact), exact)
+        assert len(multigrid.history) == 0
+
+    def test_preconditioner_is_symmetric(self):
+        multigrid = MultigridSolver((15, 7, 15), (1, 1, 2))
+        preconditioner = multigrid.as_preconditioner()
+        x, y = np.random.RandomState(1).uniform(size=(2, 15 * 7 * 15))
+        assert_allclose(x @ preconditioner.matvec(y), y @ preconditioner.matvec(x))
+
+    def test_field_solver_with_inner_regions(self):
+        mesh = make_mesh((16, 16, 16))
+        regions = [InnerRegion('a', Box((2, 2, 2), (4, 5, 3)), 5), InnerRegion('b', Sphere((10, 10, 10), 3), -3)]
+        potentials = []
+        for options in FieldSolverOptions('multigrid'), FieldSolverOptions('cg', 'multigrid'):
+            solver = FieldSolver(mesh, regions, options)
+            solver.eval_potential(mesh, regions)
+            assert_allclose(solver.A @ solver.phi_vec[solver._free], solver.reduced_rhs(solver.rhs),
+                            atol=1e-8 * np.abs(solver.rhs).max())
+            potentials.append(mesh.potential.copy())
+        assert_allclose(potentials[0][4, 4, 3], 5)
+        assert_allclose(potentials[0], potentials[1], atol=1e-6)
+
+    @pytest.mark.slow
+    def test_scaling(self):
+        cycles = {}
+        for n in 32, 64, 128:
+            mesh = make_mesh((n, n, n))
+            solver = FieldSolver(mesh, [])
+            solver.init_rhs_vector(mesh, [])
+            multigrid = MultigridSolver(mesh.n_nodes - 2, mesh.cell)
+            start = time.perf_counter()
+            multigrid.solve(solver.rhs)
+            elapsed = time.perf_counter() - start
+            cycles[n] = len(multigrid.history)
+            logging.info(f"{n}^3 mesh: {cycles[n]} cycles, {elapsed:.3f} s, {elapsed / n ** 3 * 1e9:.0f} ns per node")
+        assert cycles[128] <= cycles[32] + 2
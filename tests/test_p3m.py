@@ -0,0 +1,54 @@
+import numpy as np
+from numpy.testing import assert_allclose
+
+from ef.config.components import BoundaryConditionsConf, SpatialMeshConf
+from ef.field.direct_sum import coulomb_field_at_points
+from ef.field.p3m import MeshPairField, ShortRangeCorrection
+from ef.field.solvers.field_solver import FieldSolver
+
+
+def test_mesh_pair_field_matches_mesh():
+    mesh = SpatialMeshConf((40, 40, 30), (1, 1, 0.75)).make(BoundaryConditionsConf())
+    pair_field = MeshPairField.within(mesh.cell, 3)
+    assert pair_field.table.shape == (9, 9, 11, 3)
+    assert_allclose(pair_field.table, -pair_field.table[::-1, ::-1, ::-1], atol=1e-12)
+    state = np.random.RandomState(0)
+    source = np.array([(20.3, 19.6, 15.2)])
+    points = source + state.uniform(-2, 2, (50, 3))
+    mesh.mesh.distribute_scalar_at_positions(1, source, out=mesh.charge_density)
+    solver = FieldSolver(mesh, [])
+    solver.eval_potential(mesh, [])
+    solver.eval_fields_from_potential(mesh)
+    expected = mesh.field_at_position(points)
+    point_stencil, source_stencil = mesh.mesh.stencil(points), mesh.mesh.stencil(np.repeat(source, 50, axis=0))
+    field = pair_field.field(point_stencil.nodes, point_stencil.weights, source_stencil.nodes, source_stencil.weights)
+    assert_allclose(field, expected, atol=2e-3 * np.abs(expected).max())
+
+
+def test_short_range_correction():
+    grid = SpatialMeshConf((10, 10, 10), (1, 1, 1)).make(BoundaryConditionsConf()).mesh
+    correction = ShortRangeCorrection([(5, 5, 5)], 2, grid, 1.5)
+    assert_allclose(correction.field_at_points([(5, 5, 5), (5, 5, 7), (7, 5, 5)]), 0)
+    stencil = grid.stencil([(5, 5, 5.5), (5, 5, 5)])
+    mesh = 2 * correction.mesh_pair_field.field(stencil.nodes[:1], stencil.weights[:1],
+                                                stencil.nodes[1:], stencil.weights[1:])
+    assert_allclose(correction.field_at_points([(5, 5, 5.5)]), [(0, 0, 2 / 0.25)] - mesh)
+
+
+def test_short_range_correction_batches():
+    grid = SpatialMeshConf((5, 5, 5), (0.5, 0.5, 0.5)).make(BoundaryConditionsConf()).mesh
+    state = np.random.RandomState(0)
+    sources, points = state.uniform(0, 5, (300, 3)), state.uniform(0, 5, (200, 3))
+    charges = state.choice([-1., 2.], 300)
+    correction = ShortRangeCorrection(sources, charges, grid, 1.5)
+    whole = correction.field_at_points(points)
+    correction.points_per_batch = 7
+    assert_allclose(correction.field_at_points(points), whole)
+    exact = coulomb_field_at_points(sources[charges < 0], -1, points) + \
+        coulomb_field_at_points(sources[charges > 0], 2, points)
+    everything = ShortRangeCorrection(sources, charges, grid, 10)
+    point_stencil, source_stencil = grid.stencil(points), grid.stencil(sources)
+    mesh = sum(q * everything.mesh_pair_field.field(point_stencil.nodes, point_stencil.weights,
+                                                    np.broadcast_to(n, (200, 3)), np.broadcast_to(w, (200, 3)))
+               for q, n, w in zip(charges, source_stencil.nodes, source_stencil.weights))
+    assert_allclose(everything.field_at_points(points) + mesh, exact, rtol=1e-8, atol=1e-8)
@@ -1,8 +1,14 @@
+import logging
+import time
+import tracemalloc
+
 import h5py
 import numpy as np
-from numpy.testing import assert_array_equal
+import pytest
+from numpy.testing import assert_array_equal, assert_allclose
 
-from ef.particle_array import ParticleArray, boris_update_momentums
+from ef.particle_array import ParticleArray, boris_update_momentums, boris_update_momentums_in_place
+from ef.spatial_mesh import MeshGrid
 from ef.util.physical_constants import speed_of_light
 
 
@@ -29,14 +35,35 @@ class TestParticle:
         assert_array_equal(p.field_at_points((2., 0., 1.)), [(-4, 0, 0)])
         assert_array_equal(p.field_at_points((2., 0., 1.)), np.array([(-4, 0, 0)]))
         assert_array_equal(p.field_at_points(np.array((2., 0., 1.))), [(-4, 0, 0)])
-        assert_array_equal(p.field_at_points((0., 0., 1.)), np.array([[np.nan, np.nan, np.nan]]))
+        assert_array_equal(p.field_at_points((0., 0., 1.)), [(0, 0, 0)])
         p = ParticleArray('12', -16.0, 2.0, [(0, 0, 1), (0, 0, 0)], np.zeros((2, 3)))
         assert_array_equal(p.field_at_points((0, 0, 0.5)), [(0, 0, 0)])
         assert_array_equal(p.field_at_points((0, 0, 2)), [(0, 0, -20)])
-        assert_array_equal(p.field_at_points((0., 0., 0)), np.array([[np.nan, np.nan, np.nan]]))  # todo: fix!
+        assert_array_equal(p.field_at_points((0., 0., 0)), [(0, 0, 16)])
         assert_array_equal(p.field_at_points([(0, 0, 0.5), (0, 0, 2), (0, 0, 2)]),
                            [(0, 0, 0), (0, 0, -20), (0, 0, -20)])
 
+    def test_field_at_points_tiled(self):
+        state = np.random.RandomState(0)
+        p = ParticleArray(range(300), -16.0, 2.0, state.uniform(0, 1, (300, 3)), np.zeros((300, 3)))
+        points = np.concatenate([state.uniform(0, 1, (200, 3)), p.positions[:50]])
+        diff = points - p.positions[:, np.newaxis]
+        dist = np.linalg.norm(diff, axis=-1)
+        expected = -16 * np.nansum(diff / (dist ** 3)[..., np.newaxis], axis=0)
+        assert_allclose(p.field_at_points(points), expected)
+        assert_allclose(p.field_at_points(points, memory_limit=1000), expected)
+        assert_allclose(p.field_at_points(points, memory_limit=400), expected)
+        assert_allclose(p.field_at_points(points, memory_limit=10000, n_threads=4), expected)
+
+    def test_field_at_points_memory_limit(self):
+        state = np.random.RandomState(0)
+        p = ParticleArray(range(3000), -16.0, 2.0, state.uniform(0, 1, (3000, 3)), np.zeros((3000, 3)))
+        tracemalloc.start()
+        p.field_at_points(p.positions, memory_limit=1 << 20)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        assert peak < 2 * (1 << 20)  # a dense (3000, 3000, 3) difference tensor would take 216 MB
+
     def test_update_momentums_no_mgn(self):
         p = ParticleArray(123, -1.0, 2.0, (0., 0., 1.), (1., 0., 3.))
         p.boris_update_momentum_no_mgn(0.1, (-1.0, 2.0, 3.0))
@@ -51,6 +78,56 @@ class TestParticle:
         p.boris_update_momentums(2, (-1.0, 2.0, 3.0), (2 * speed_of_light, 0, 0))
         assert_array_equal(p.momentums, (3, -2, -5))
 
+    def test_append(self):
+        p = ParticleArray(1, -1.0, 2.0, (0., 0., 1.), (1., 0., 3.))
+        p.append(ParticleArray([2, 3], -1.0, 2.0, [(1, 2, 3), (4, 5, 6)], [(0, 0, 0), (1, 1, 1)]))
+        assert p == ParticleArray([1, 2, 3], -1.0, 2.0, [(0, 0, 1), (1, 2, 3), (4, 5, 6)],
+                                  [(1, 0, 3), (0, 0, 0), (1, 1, 1)])
+        buffer = p.positions.base
+        assert len(buffer) == 3
+        p.append(ParticleArray([4], -1.0, 2.0, [(7, 8, 9)], [(2, 2, 2)]))
+        assert len(p) == 4
+        buffer = p.positions.base
+        assert len(buffer) == 6
+        p.append(ParticleArray([5, 6], -1.0, 2.0, [(1, 1, 1), (2, 2, 2)], np.zeros((2, 3))))
+        assert p.positions.base is buffer
+        assert_array_equal(p.ids, [1, 2, 3, 4, 5, 6])
+        assert_array_equal(p.positions[-3:], [(7, 8, 9), (1, 1, 1), (2, 2, 2)])
+        p.append(ParticleArray([], -1.0, 2.0, np.zeros((0, 3)), np.zeros((0, 3))))
+        assert len(p) == 6
+        with pytest.raises(ValueError):
+            p.append(ParticleArray([7], 1.0, 2.0, [(0, 0, 0)], [(0, 0, 0)]))
+        with pytest.raises(ValueError):
+            p.append(ParticleArray([7], -1.0, 2.0, [(0, 0, 0)], [(0, 0, 0)], True))
+
+    def test_keep_in_place(self):
+        p = ParticleArray([1, 2, 3], -1.0, 2.0, [(0, 0, 1), (1, 2, 3), (4, 5, 6)], np.eye(3))
+        positions = p.positions
+        p.keep([False, True, True])
+        assert p.positions.base is positions
+        assert p == ParticleArray([2, 3], -1.0, 2.0, [(1, 2, 3), (4, 5, 6)], [(0, 1, 0), (0, 0, 1)])
+        p.append(ParticleArray([4], -1.0, 2.0, [(7, 8, 9)], [(1, 1, 1)]))
+        assert p.positions.base is positions
+        assert p == ParticleArray([2, 3, 4], -1.0, 2.0, [(1, 2, 3), (4, 5, 6), (7, 8, 9)],
+                                  [(0, 1, 0), (0, 0, 1), (1, 1, 1)])
+
+    def test_mesh_stencil_cache(self):
+        grid = MeshGrid.from_step(np.array((4., 4., 4.)), np.array((1., 1., 1.)))
+        p = ParticleArray([1, 2, 3], -1.0, 2.0, [(0.5, 1, 1), (1, 2.5, 3), (4, 4, 4)], np.ones((3, 3)))
+        stencil = p.mesh_stencil(grid)
+        assert_array_equal(stencil.nodes, [(0, 1, 1), (1, 2, 3), (3, 3, 3)])
+        assert_array_equal(stencil.weights, [(0.5, 0, 0), (0, 0.5, 0), (1, 1, 1)])
+        assert p.mesh_stencil(grid) is stencil
+        assert p.mesh_stencil(MeshGrid.from_step(np.array((4., 4., 4.)), np.array((1., 1., 1.)))) is stencil
+        p.keep([True, False, True])
+        assert p.mesh_stencil(grid) is stencil
+        assert_array_equal(stencil.nodes, [(0, 1, 1), (3, 3, 3)])
+        assert_array_equal(stencil.corner_weights.sum(axis=-1), [1, 1])
+        p.update_positions(-1.0)
+        assert p.mesh_stencil(grid) is not stencil
+        assert_array_equal(p.mesh_stencil(grid).nodes, [(0, 0, 0), (3, 3, 3)])
+        assert_array_equal(p.mesh_stencil(grid).weights, [(0, 0.5, 0.5), (0.5, 0.5, 0.5)])
+
 
 def test_update_momentums():
     assert_array_equal(boris_update_momentums(-1, 2, (1, 0, 3), 0.1, (-1.0, 2.0, 3.0), (0, 0, 0)),
@@ -68,3 +145,54 @@ def test_update_momentums():
                                el_field_arr=[(-1.0, 2.0, 3.0)] * 10,
                                mgn_field_arr=[(2 * speed_of_light, 0, 0)] * 10),
         np.array([(3, -2, -5)] * 10))
+
+
+def test_update_momentums_in_place_matches_reference():
+    state = np.random.RandomState(0)
+    momentums, el, mgn = state.normal(size=(3, 1000, 3))
+    mgn *= speed_of_light
+    expected = boris_update_momentums(-2, 3, momentums, 0.5, el, mgn)
+    work, columns_work = np.empty((4, 1000, 3)), np.empty((3, 1000))
+    boris_update_momentums_in_place(-2, 3, momentums, 0.5, el, mgn, work, columns_work)
+    assert_array_equal(momentums, expected)
+
+
+def test_push_does_not_allocate():
+    n = 10 ** 5
+    state = np.random.RandomState(0)
+    p = ParticleArray(range(n), -1.0, 2.0, state.normal(size=(n, 3)), state.normal(size=(n, 3)))
+    el, mgn = state.normal(size=(2, n, 3))
+    p.boris_update_momentums(0.1, el, mgn)
+    p.update_positions(0.1)
+    momentums, positions = p.momentums, p.positions
+    tracemalloc.start()
+    p.boris_update_momentums(0.1, el, mgn)
+    p.boris_update_momentum_no_mgn(0.1, el)
+    p.update_positions(0.1)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < n * 8  # less than a single column, only constant-size ufunc buffers are allocated
+    assert p.momentums is momentums and p.positions is positions
+
+
+@pytest.mark.slow
+@pytest.mark.parametrize('n', [10 ** 6, 3 * 10 ** 6])
+def test_push_benchmark(n):
+    state = np.random.RandomState(0)
+    p = ParticleArray(range(n), -1.0, 2.0, state.normal(size=(n, 3)), state.normal(size=(n, 3)))
+    el, mgn = state.normal(size=(2, n, 3))
+    p.boris_update_momentums(0.1, el, mgn)
+    tracemalloc.start()
+    start = time.perf_counter()
+    boris_update_momentums(p.charge, p.mass, p.momentums, 0.1, el, mgn)
+    reference_time = time.perf_counter() - start
+    reference_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    p.boris_update_momentums(0.1, el, mgn)
+    in_place_time = time.perf_counter() - start
+    in_place_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    logging.info(f"{n} particles: reference {reference_time:.3f} s, {reference_peak / 2 ** 20:.0f} MiB; "
+                 f"in place {in_place_time:.3f} s, {in_place_peak / 2 ** 20:.0f} MiB")
+    assert in_place_peak < reference_peak / 10
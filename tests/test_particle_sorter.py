@@ -0,0 +1,59 @@
+import logging
+import time
+
+import numpy as np
+import pytest
+from numpy.testing import assert_array_equal
+
+from ef.particle_array import ParticleArray
+from ef.particle_sorter import ParticleSorter, morton_keys
+from ef.spatial_mesh import MeshGrid
+
+
+def test_morton_keys():
+    assert_array_equal(morton_keys(np.array([(0, 0, 0), (0, 0, 1), (0, 1, 0), (1, 0, 0), (1, 1, 1), (2, 0, 0),
+                                             (3, 3, 3)])),
+                       [0, 1, 2, 4, 7, 32, 63])
+    assert morton_keys(np.array([(2 ** 21 - 1,) * 3]))[0] == 2 ** 63 - 1
+
+
+class TestParticleSorter:
+    def test_init(self):
+        with pytest.raises(ValueError):
+            ParticleSorter(-1)
+        with pytest.raises(ValueError):
+            ParticleSorter(1, 'random')
+
+    def test_is_due(self):
+        assert not any(ParticleSorter().is_due(i) for i in range(10))
+        assert [ParticleSorter(3).is_due(i) for i in range(7)] == [True, False, False, True, False, False, True]
+
+    @pytest.mark.parametrize('order, expected', [('morton', [2, 0, 1, 3]), ('linear', [2, 3, 0, 1])])
+    def test_sort(self, order, expected):
+        grid = MeshGrid.from_step(np.array((4., 4., 4.)), np.array((1., 1., 1.)))
+        positions = np.array([(0.5, 1.5, 0.5), (1.5, 1.5, 0.5), (0.5, 0.5, 0.5), (0.5, 0.5, 2.5)])
+        p = ParticleArray([0, 1, 2, 3], -1.0, 2.0, positions, positions * 2)
+        ParticleSorter(1, order).sort(p, grid)
+        assert_array_equal(p.ids, expected)
+        assert_array_equal(p.positions, positions[expected])
+        assert_array_equal(p.momentums, positions[expected] * 2)
+        assert_array_equal(p.mesh_stencil(grid).nodes, grid.stencil(positions[expected]).nodes)
+
+    @pytest.mark.slow
+    def test_sorting_speeds_up_deposit_and_gather(self):
+        grid = MeshGrid.from_step(np.array((10., 10., 10.)), np.array((.1, .1, .1)))
+        positions = np.random.RandomState(0).uniform(0, 10, (4 * 10 ** 6, 3))
+        field = grid.pad_with_ghost_layer(np.random.RandomState(1).uniform(-1, 1, (*grid.n_nodes, 3)))
+        times = {}
+        for order in 'random', 'linear', 'morton':
+            p = ParticleArray(np.arange(len(positions)), -1.0, 2.0, positions, np.zeros_like(positions))
+            if order != 'random':
+                ParticleSorter(1, order).sort(p, grid)
+            stencil = grid.stencil(p.positions)
+            start = time.perf_counter()
+            for _ in range(3):
+                grid.distribute_scalar(p.charge, stencil, out=np.zeros(grid.n_nodes))
+                grid.interpolate_padded_field(field, stencil)
+            times[order] = (time.perf_counter() - start) / 3
+            logging.info(f"{order} particle order: deposit and gather in {times[order]:.3f} s")
+        assert max(times['linear'], times['morton']) < times['random']
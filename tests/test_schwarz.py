@@ -0,0 +1,68 @@
+import logging
+import os
+import time
+
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from ef.config.components import BoundaryConditionsConf, SpatialMeshConf, Box
+from ef.field.solvers.field_solver import FieldSolver
+from ef.field.solvers.field_solver_options import FieldSolverOptions
+from ef.field.solvers.schwarz import SchwarzSolver
+from ef.inner_region import InnerRegion
+
+
+def make_mesh(size, cell=(1, 1, 1)):
+    mesh = SpatialMeshConf(size, cell).make(BoundaryConditionsConf(-1, 2, 0, 1, 3, 0))
+    mesh.charge_density[1:-1, 1:-1, 1:-1] = np.random.RandomState(0).uniform(size=mesh.n_nodes - 2)
+    return mesh
+
+
+class TestSchwarz:
+    def test_subdomains(self):
+        mesh = make_mesh((4, 4, 10))
+        matrix = FieldSolver(mesh, []).construct_laplacian_matrix(mesh)
+        schwarz = SchwarzSolver(matrix, np.arange(0, 82, 9), 3)
+        assert schwarz.ranges == [(0, 45), (9, 72), (36, 81)]
+        assert schwarz.damping == 1 / 3
+        single = SchwarzSolver(matrix, np.arange(0, 82, 9), 1)
+        x = np.random.RandomState(1).uniform(size=81)
+        assert_allclose(single.apply(matrix @ x), x)
+        parallel = SchwarzSolver(matrix, np.arange(0, 82, 9), 3, workers=2)
+        assert parallel.workers == 2
+        assert_allclose(parallel.apply(x), schwarz.apply(x))
+        parallel.close()
+
+    @pytest.mark.parametrize('options', [FieldSolverOptions('cg', 'schwarz', subdomains=3),
+                                         FieldSolverOptions('cg', 'schwarz', workers=2),
+                                         FieldSolverOptions('schwarz', workers=2, subdomains=3)])
+    def test_field_solver(self, options):
+        mesh = make_mesh((10, 8, 6), (0.5, 0.5, 0.25))
+        regions = [InnerRegion('a', Box((2, 2, 2), (3, 2, 2)), 3)]
+        FieldSolver(mesh, regions, FieldSolverOptions('direct')).eval_potential(mesh, regions)
+        expected = mesh.potential.copy()
+        mesh.potential[1:-1, 1:-1, 1:-1] = 0
+        with FieldSolver(mesh, regions, options) as solver:
+            solver.eval_potential(mesh, regions)
+        assert_allclose(mesh.potential, expected, atol=1e-8)
+        assert solver.last_report.converged and 0 < solver.last_report.iterations
+        with pytest.raises(ValueError):
+            FieldSolver(mesh, regions, FieldSolverOptions('schwarz', operator='matrix_free'))
+
+    @pytest.mark.slow
+    @pytest.mark.skipif(os.cpu_count() < 2, reason="strong scaling needs several cores")
+    def test_strong_scaling(self):
+        mesh = make_mesh((64, 64, 64))
+        times = {}
+        for workers in 1, 2, 4, 8, 16, 32:
+            if workers > os.cpu_count():
+                break
+            with FieldSolver(mesh, [], FieldSolverOptions('cg', 'schwarz', workers=workers, subdomains=32)) as solver:
+                solver.init_rhs_vector(mesh, [])
+                start = time.perf_counter()
+                solver.solve_linear_system(solver.rhs, np.zeros_like(solver.rhs))
+                times[workers] = time.perf_counter() - start
+            logging.info(f"{workers} workers: {solver.last_report.iterations} iterations, {times[workers]:.2f} s, "
+                         f"speedup {times[1] / times[workers]:.1f}")
+        assert times[1] / times[max(times)] > max(1.2, 0.5 * max(times) ** 0.5)
@@ -3,11 +3,13 @@ from math import sqrt
 
 import numpy as np
 import pytest
-from numpy.testing import assert_array_almost_equal, assert_array_equal
+from numpy.testing import assert_array_almost_equal, assert_array_equal, assert_allclose
 
 from ef.external_field_expression import ExternalFieldExpression
 from ef.external_field_uniform import ExternalFieldUniform
 from ef.field.solvers.field_solver import FieldSolver
+from ef.field.p3m import ShortRangeCorrection
+from ef.field.tree import Octree
 from ef.inner_region import InnerRegion
 from ef.particle_array import ParticleArray
 from ef.particle_interaction_model import ParticleInteractionModel
@@ -83,7 +85,77 @@ class TestSimulation:
             [(1, 2, 3), (1, 2, 4), (0, 2, 3), (0, 1, 2)]),
             [(0, 0, 0), (0, 0, -4), (4, 0, 0), (4 / sqrt(27), 4 / sqrt(27), 4 / sqrt(27))])
 
-    @pytest.mark.parametrize('model', ['noninteracting', 'PIC', 'binary'])
+    def test_tree_field(self):
+        d = Config(particle_interaction_model=ParticleInteractionModelConf('tree', tree_opening_angle=0.3)).make()
+        state = np.random.RandomState(0)
+        d.particle_arrays = [ParticleArray(range(300), -1, 1, state.uniform(0, 10, (300, 3)), np.zeros((300, 3))),
+                             ParticleArray(range(300, 400), 2, 3, state.uniform(0, 10, (100, 3)), np.zeros((100, 3)))]
+        points = state.uniform(0, 10, (50, 3))
+        assert_allclose(d.tree_electric_field_at_positions(points), d.binary_electric_field_at_positions(points),
+                        rtol=1e-2, atol=1e-3)
+
+    @pytest.mark.parametrize('model, name, cls', [('tree', 'Octree', Octree),
+                                                  ('p3m', 'ShortRangeCorrection', ShortRangeCorrection)])
+    def test_sources_built_once_per_push(self, model, name, cls, monkeypatch):
+        d = Config(particle_interaction_model=ParticleInteractionModelConf(model)).make()
+        state = np.random.RandomState(0)
+        d.particle_arrays = [ParticleArray(range(30), -1, 1, state.uniform(2, 8, (30, 3)), np.zeros((30, 3))),
+                             ParticleArray(range(30, 40), 2, 3, state.uniform(2, 8, (10, 3)), np.zeros((10, 3)))]
+        expected = [d.compute_total_fields_at_particles(p)[0] for p in d.particle_arrays]
+        built = []
+        monkeypatch.setattr(f'ef.simulation.{name}', lambda *args: built.append(args) or cls(*args))
+        fields = []
+        monkeypatch.setattr(ParticleArray, 'boris_update_momentum_no_mgn', lambda self, dt, field: fields.append(field))
+        d.boris_integration(d.time_grid.time_step_size)
+        assert len(built) == 1 and d._octree is None and d._short_range is None
+        for field, e in zip(fields, expected):
+            assert_allclose(field, e)
+
+    @pytest.mark.parametrize('n_particles', [1, 20])
+    def test_p3m_field(self, n_particles):
+        def mesh_and_correction_error(model, cutoff=2.5):
+            sim = Config(spatial_mesh=SpatialMeshConf((20, 20, 20), (1, 1, 1)),
+                         particle_interaction_model=ParticleInteractionModelConf(model, p3m_cutoff=cutoff)).make()
+            state = np.random.RandomState(0)
+            positions = (10.3, 9.8, 10.1) + state.uniform(-2, 2, (n_particles, 3)) * (n_particles > 1)
+            sim.particle_arrays = [ParticleArray(range(n_particles), 1, 1, positions, np.zeros((n_particles, 3)))]
+            sim.eval_charge_density()
+            sim.eval_potential_and_fields()
+            points = np.array([(10.3, 9.8, 10.1)]) + state.uniform(-3, 3, (200, 3))
+            field = sim.spat_mesh.field_at_position(points)
+            if sim.particle_interaction_model.p3m:
+                field += sim.short_range_electric_field_at_positions(points)
+            exact = sim.binary_electric_field_at_positions(points)
+            return np.linalg.norm(field - exact) / np.linalg.norm(exact)
+
+        errors = [mesh_and_correction_error('p3m', cutoff) for cutoff in (2.5, 4, 6)]
+        assert errors[0] < 0.05 and errors[1] < 0.005 and errors[2] < 0.005
+        assert mesh_and_correction_error('PIC') > 0.2
+
+    def test_remove_particles_in_one_pass(self):
+        def make():
+            sim = Config(inner_regions=[InnerRegionConf('a', Box((2, 2, 2), (4, 4, 4))),
+                                        InnerRegionConf('b', Sphere((5, 5, 5), 2)),
+                                        InnerRegionConf('c', Box((0, 0, 0), (3, 3, 3)))]).make()
+            state = np.random.RandomState(0)
+            sim.particle_arrays = [ParticleArray(range(1000), -1, 1, state.uniform(-1, 11, (1000, 3)),
+                                                 np.zeros((1000, 3))),
+                                   ParticleArray(range(1000, 1010), 2, 3, state.uniform(-1, 11, (10, 3)),
+                                                 np.zeros((10, 3)))]
+            return sim
+
+        sequential, fused = make(), make()
+        for arr in sequential.particle_arrays:
+            arr.remove(sequential.out_of_bound(arr))
+            for region in sequential.inner_regions:
+                region.collide_with_particles(arr)
+        sequential.particle_arrays = [a for a in sequential.particle_arrays if len(a.ids) > 0]
+        fused.remove_particles_outside_domain_or_inside_regions()
+        assert fused.particle_arrays == sequential.particle_arrays
+        assert fused.inner_regions == sequential.inner_regions
+        assert [r.total_absorbed_particles for r in fused.inner_regions] != [0, 0, 0]
+
+    @pytest.mark.parametrize('model', ['noninteracting', 'PIC', 'binary', 'tree', 'p3m'])
     def test_cube_of_gas(self, model, monkeypatch, tmpdir):
         monkeypatch.chdir(tmpdir)
         Config(TimeGridConf(1.0, save_step=.5, step=.1), SpatialMeshConf((10, 10, 10), (1, 1, 1)),
@@ -91,7 +163,7 @@ class TestSimulation:
                particle_interaction_model=ParticleInteractionModelConf(model)
                ).make().start_pic_simulation()
 
-    @pytest.mark.parametrize('model', ['noninteracting', 'PIC', 'binary'])
+    @pytest.mark.parametrize('model', ['noninteracting', 'PIC', 'binary', 'tree', 'p3m'])
     def test_cube_of_gas_with_hole(self, model, monkeypatch, tmpdir):
         monkeypatch.chdir(tmpdir)
         Config(TimeGridConf(1.0, save_step=.5, step=.1), SpatialMeshConf((10, 10, 10), (1, 1, 1)),
@@ -100,6 +172,31 @@ class TestSimulation:
                particle_interaction_model=ParticleInteractionModelConf(model)
                ).make().start_pic_simulation()
 
+    def test_time_dependent_region(self, monkeypatch, tmpdir):
+        monkeypatch.chdir(tmpdir)
+        sim = Config(TimeGridConf(1.0, save_step=.5, step=.1), SpatialMeshConf((10, 10, 10), (1, 1, 1)),
+                     [ParticleSourceConf('gas', Box(size=(10, 10, 10)), 50, 0, np.zeros(3), 300)],
+                     [InnerRegionConf('rf', Box(origin=(4, 4, 4), size=(2, 2, 2)), potential_expression='10 * t')],
+                     particle_interaction_model=ParticleInteractionModelConf('noninteracting')
+                     ).make()
+        sim.start_pic_simulation()
+        assert sim.time_grid.current_time == pytest.approx(1)
+        assert sim.inner_regions[0].potential == pytest.approx(10)
+        assert sim.spat_mesh.potential[5, 5, 5] == pytest.approx(10)
+        assert sim.field_solve_report.solver == 'cg' and sim.field_solve_report.converged
+
+    @pytest.mark.parametrize('order', ['morton', 'linear'])
+    def test_cube_of_gas_sorted(self, order, monkeypatch, tmpdir):
+        monkeypatch.chdir(tmpdir)
+        sim = Config(TimeGridConf(1.0, save_step=.5, step=.1), SpatialMeshConf((10, 10, 10), (1, 1, 1)),
+                     [ParticleSourceConf('gas', Box(size=(10, 10, 10)), 50, 0, np.zeros(3), 0)],
+                     particle_interaction_model=ParticleInteractionModelConf('noninteracting'),
+                     particle_sorting=ParticleSortingConf(3, order)).make()
+        assert sim.particle_sorter.sort_every == 3
+        sim.start_pic_simulation()
+        assert "sort" in sim._step_timer.stages
+        assert sorted(sim.particle_arrays[0].ids) == list(range(50))
+
     def test_id_generation(self, monkeypatch, tmpdir):
         monkeypatch.chdir(tmpdir)
         conf = Config(TimeGridConf(0.001, save_step=.0005, step=0.0001), SpatialMeshConf((10, 10, 10), (1, 1, 1)),
@@ -113,6 +210,23 @@ class TestSimulation:
         assert len(sim.particle_arrays) == 0
         sim.start_pic_simulation()
         assert len(sim.particle_sources) == 2
+        assert len(sim.particle_arrays) == 1  # both sources emit the same species
+        assert_array_equal(sim.particle_arrays[0].ids, range(100))
+
+    def test_particle_arrays_per_species(self, monkeypatch, tmpdir):
+        monkeypatch.chdir(tmpdir)
+        conf = Config(TimeGridConf(0.001, save_step=.0005, step=0.0001), SpatialMeshConf((10, 10, 10), (1, 1, 1)),
+                      sources=[ParticleSourceConf('a', Box((4, 4, 4), size=(1, 1, 1)), 10, 10, np.zeros(3), 0.00),
+                               ParticleSourceConf('b', Box((5, 5, 5), size=(1, 1, 1)), 20, 20, np.zeros(3), 0.00,
+                                                  charge=1, mass=1),
+                               ParticleSourceConf('c', Box((4, 4, 4), size=(1, 1, 1)), 30, 30, np.zeros(3), 0.00)],
+                      particle_interaction_model=ParticleInteractionModelConf('noninteracting')
+                      )
+        sim = conf.make()
+        sim.start_pic_simulation()
         assert len(sim.particle_arrays) == 2
-        assert_array_equal(sim.particle_arrays[0].ids, range(50))
-        assert_array_equal(sim.particle_arrays[1].ids, range(50, 100))
+        a, b = sim.particle_arrays
+        assert a.charge == -1.799e-6 and b.charge == 1
+        assert len(a) == 40 * 11 and len(b) == 20 * 11
+        assert a.momentum_is_half_time_step_shifted and b.momentum_is_half_time_step_shifted
+        assert_array_equal(np.sort(np.concatenate([a.ids, b.ids])), range(60 * 11))
@@ -1,9 +1,10 @@
 import logging
+import time
 
 import h5py
 import numpy as np
 import pytest
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_allclose
 
 from ef.particle_array import ParticleArray
 from ef.spatial_mesh import SpatialMesh, MeshGrid
@@ -182,3 +183,100 @@ class TestDefaultSpatialMesh:
         mesh.electric_field[1:2, 0:2, 0:2] = np.array([[[2, 1, 0], [-3, 1, 0]],
                                                        [[0, -1, 0], [-1, 0, 0]]])
         assert_array_equal(mesh.field_at_position([(1, 1, 3)]), [(-1.25, 0.375, 0)])
+
+    def test_field_at_particles_reuses_padded_field(self):
+        mesh = SpatialMeshConf((2, 4, 8), (1, 2, 4)).make(BoundaryConditionsConf())
+        particles = ParticleArray([1, 2], -2, 4, [(1, 1, 3), (2, 4, 8)], np.zeros((2, 3)))
+        mesh.electric_field[1:2, 0:2, 0:2] = np.array([[[2, 1, 0], [-3, 1, 0]],
+                                                       [[0, -1, 0], [-1, 0, 0]]])
+        assert_array_equal(mesh.field_at_particles(particles), [(-1.25, 0.375, 0), (0, 0, 0)])
+        padded = mesh._padded_electric_field
+        mesh.field_at_particles(particles)
+        assert mesh._padded_electric_field is padded
+        mesh.electric_field[1, 0, 0] = (6, 3, 0)
+        assert_array_equal(mesh.field_at_particles(particles)[0], (-0.75, 0.625, 0))
+        assert mesh._padded_electric_field is padded
+        mesh.electric_field = np.zeros_like(mesh.electric_field)
+        assert_array_equal(mesh.field_at_particles(particles), np.zeros((2, 3)))
+
+    def test_distribute_scalar_matches_per_node_sum(self):
+        grid = MeshGrid.from_step(np.array((3., 4., 5.)), np.array((.5, 1., 1.)))
+        positions = np.random.RandomState(0).uniform(0, (3, 4, 5), (1000, 3))
+        expected = np.zeros(grid.n_nodes)
+        for p in positions:
+            node, weight = np.divmod(p, grid.cell)
+            weight = weight / grid.cell
+            for corner in np.ndindex(2, 2, 2):
+                w = np.where(corner, weight, 1 - weight).prod()
+                if w > 0:
+                    expected[tuple(node.astype(int) + corner)] += w * 2. / grid.cell.prod()
+        result = grid.distribute_scalar_at_positions(2., positions)
+        assert_allclose(result, expected)
+        assert_allclose(result.sum() * grid.cell.prod(), 2000.)
+
+    def test_distribute_scalar_chunks(self, monkeypatch):
+        grid = MeshGrid.from_step(np.array((3., 4., 5.)), np.array((.5, 1., 1.)))
+        positions = np.random.RandomState(0).uniform(0, (3, 4, 5), (1000, 3))
+        expected = grid.distribute_scalar_at_positions(2., positions)
+        monkeypatch.setattr(grid, 'deposition_chunk_size', 7)
+        assert_allclose(grid.distribute_scalar_at_positions(2., positions), expected)
+
+    @pytest.mark.slow
+    def test_distribute_scalar_scaling(self):
+        grid = MeshGrid.from_step(np.array((10., 10., 10.)), np.array((.1, .1, .1)))
+        state = np.random.RandomState(0)
+        times = {}
+        for n in (10 ** 5, 10 ** 6, 10 ** 7):
+            positions = state.uniform(0, 10, (n, 3))
+            start = time.perf_counter()
+            grid.distribute_scalar_at_positions(1., positions)
+            times[n] = time.perf_counter() - start
+            logging.info(f"deposited {n} particles in {times[n]:.3f} s, {times[n] / n * 1e9:.1f} ns per particle")
+        assert times[10 ** 7] / 10 ** 7 < 3 * times[10 ** 5] / 10 ** 5
+
+    def test_distribute_scalar_into_bounding_box(self):
+        grid = MeshGrid.from_step(np.array((3., 4., 5.)), np.array((.5, 1., 1.)))
+        positions = np.random.RandomState(0).uniform((1, 1, 2), (2, 2.5, 3), (100, 3))
+        expected = grid.distribute_scalar_at_positions(2., positions)
+        out = np.full(grid.n_nodes, np.nan)
+        out[2:5, 1:4, 2:4] = 1.
+        assert grid.distribute_scalar_at_positions(2., positions, out=out) is out
+        assert_allclose(out[2:5, 1:4, 2:4], expected[2:5, 1:4, 2:4] + 1)
+        assert np.isnan(out).sum() == out.size - 3 * 3 * 2
+        assert_array_equal(grid.distribute_scalar_at_positions(2., np.zeros((0, 3))), np.zeros(grid.n_nodes))
+
+    def test_interpolate_padded_field(self):
+        grid = MeshGrid.from_step(np.array((3., 4., 5.)), np.array((.5, 1., 1.)))
+        state = np.random.RandomState(0)
+        field = state.uniform(-1, 1, (*grid.n_nodes, 3))
+        positions = state.uniform(-2, 7, (1000, 3))
+        positions[:10] = (3, 4, 5)
+        positions[10:20] = (0, 0, 0)
+        stencil = grid.stencil(positions)
+        expected = grid.interpolate_field(field, stencil)
+        padded = grid.pad_with_ghost_layer(field)
+        assert padded.shape == (9, 7, 8, 3)
+        assert_allclose(grid.interpolate_padded_field(padded, stencil), expected)
+        assert_allclose(expected[:10], np.tile(field[-1, -1, -1], (10, 1)))
+        assert_allclose(expected[10:20], np.tile(field[0, 0, 0], (10, 1)))
+        scalar = field[..., 0]
+        assert_allclose(grid.interpolate_padded_field(grid.pad_with_ghost_layer(scalar), stencil),
+                        grid.interpolate_field(scalar, stencil))
+
+    @pytest.mark.slow
+    def test_interpolate_padded_field_benchmark(self):
+        grid = MeshGrid.from_step(np.array((10., 10., 10.)), np.array((.1, .1, .1)))
+        field = np.random.RandomState(0).uniform(-1, 1, (*grid.n_nodes, 3))
+        padded = grid.pad_with_ghost_layer(field)
+        for n in (10 ** 5, 10 ** 6):
+            stencil = grid.stencil(np.random.RandomState(1).uniform(-1, 11, (n, 3)))
+            stencil.corner_weights
+            start = time.perf_counter()
+            masked = grid.interpolate_field(field, stencil)
+            masked_time = time.perf_counter() - start
+            start = time.perf_counter()
+            result = grid.interpolate_padded_field(padded, stencil)
+            padded_time = time.perf_counter() - start
+            logging.info(f"gathered at {n} points: masked {masked_time:.3f} s, padded {padded_time:.3f} s")
+            assert_allclose(result, masked)
+            assert padded_time < masked_time
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+
+from ef.field.direct_sum import coulomb_field_at_points
+from ef.field.tree import Octree
+
+
+class TestOctree:
+    def test_single_charge(self):
+        tree = Octree([(1, 2, 3)], -1)
+        assert_allclose(tree.field_at_points([(1, 2, 3), (1, 2, 4), (0, 2, 3)]), [(0, 0, 0), (0, 0, -1), (1, 0, 0)])
+
+    def test_small_opening_angle_is_exact(self):
+        positions = np.random.RandomState(0).uniform(0, 1, (500, 3))
+        tree = Octree(positions, 2)
+        assert_allclose(tree.field_at_points(positions, 1e-3), coulomb_field_at_points(positions, 2, positions),
+                        rtol=1e-10, atol=1e-8)
+
+    def test_mixed_charges(self):
+        state = np.random.RandomState(1)
+        positions = state.normal(size=(3000, 3))
+        charges = state.choice([-1., 2.], 3000)
+        tree = Octree(positions, charges)
+        points = state.normal(size=(200, 3))
+        exact = coulomb_field_at_points(positions[charges < 0], -1, points) + \
+                coulomb_field_at_points(positions[charges > 0], 2, points)
+        assert_allclose(tree.field_at_points(points, 0.5), exact, rtol=0.05, atol=1e-2 * np.abs(exact).max())
+
+    def test_accuracy_improves_with_smaller_angle(self):
+        positions = np.random.RandomState(2).normal(size=(5000, 3))
+        tree = Octree(positions, -1)
+        errors = [tree.relative_error(positions[:200], angle) for angle in (1., 0.7, 0.4)]
+        assert errors[0] > errors[1] > errors[2]
+        assert errors[1] < 1e-2
+
+    @pytest.mark.parametrize('angle, tolerance', [(0.7, 0.01), (1., 0.025)])
+    def test_max_error(self, angle, tolerance):
+        state = np.random.RandomState(3)
+        for positions in state.uniform(size=(3000, 3)), \
+                np.column_stack([state.normal(0, 0.01, (3000, 2)), state.uniform(size=3000)]):
+            tree = Octree(positions, -1)
+            exact = coulomb_field_at_points(positions, -1, positions)
+            error = np.linalg.norm(tree.field_at_points(positions, angle) - exact, axis=-1)
+            magnitude = np.linalg.norm(exact, axis=-1)
+            # near the beam axis the field nearly cancels, the errors are bounded relative to the RMS field
+            assert np.max(error) < tolerance * np.sqrt(np.mean(magnitude ** 2))
+            if angle < 1:
+                assert np.max(error / magnitude) < 0.1
+
+    def test_dense_core(self):
+        state = np.random.RandomState(4)
+        positions = np.concatenate([state.normal(0.5, 1e-3, (3000, 3)), state.uniform(size=(1000, 3))])
+        tree = Octree(positions, -1)
+        assert len(tree.levels) > 11 and tree.levels[-1]['count'].max() <= tree.leaf_size
+        tree.memory_limit = 1 << 20
+        assert tree.relative_error(positions[::10]) < 1e-2
+
+    def test_coincident_particles(self):
+        tree = Octree(np.zeros((100, 3)), 1)
+        assert_allclose(tree.field_at_points([(0, 0, 0), (0, 0, 1)]), [(0, 0, 0), (0, 0, 100)])
+
+    def test_empty(self):
+        with pytest.raises(ValueError):
+            Octree(np.zeros((0, 3)), 1)